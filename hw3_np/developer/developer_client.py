@@ -1,6 +1,6 @@
 # developer/developer_client.py - 穩定版（自動判斷連線目標 + 版本防呆）
 
-import os, sys, json, asyncio, base64, zipfile, io, socket, re
+import os, sys, json, asyncio, base64, zipfile, io, socket, re, struct, hashlib, tempfile
 from pathlib import Path
 
 ROOT = Path(__file__).resolve().parents[1]
@@ -88,21 +88,147 @@ async def _read_json_line(reader: asyncio.StreamReader) -> dict:
     手動累積直到遇到 '\\n'，避免 StreamReader.readline 的內建限制。
     一般情況 server 都會一行一個 JSON。
     """
-    buf = b""
+    buf = bytearray()
     while True:
-        chunk = await reader.read(4096)
+        chunk = await reader.read(65536)
         if not chunk:
             if not buf:
                 raise EOFError("server closed connection with no data")
             break
         buf += chunk
-        if b"\n" in buf:
-            line, _ = buf.split(b"\n", 1)
+        if b"\n" in chunk:
             break
+    line = bytes(buf).split(b"\n", 1)[0]
     return json.loads(line.decode("utf-8"))
 
 
+class DevSession:
+    """
+    session 模式：跟 Developer Server 維持一條長連線，request 帶 id，
+    可以同時送出多個，回應依 id 對回去（不保證順序）。
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self.pending = {}      # id -> Future
+        self.next_id = 0
+        self.closed = True
+        self._reader_task = None
+
+    async def connect(self) -> bool:
+        self.loop = asyncio.get_running_loop()
+        # 回應可能很長（遊戲列表 / 評論），放寬 readline 的上限
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=16 * 1024 * 1024)
+        self.writer.write((json.dumps({"kind": "session"}) + "\n").encode("utf-8"))
+        await self.writer.drain()
+        resp = await _read_json_line(self.reader)
+        if not resp.get("session"):
+            self.writer.close()
+            return False
+        self.closed = False
+        # 留著 task 的參考：event loop 只有弱參考，沒人持有的 task 可能跑到一半被回收
+        self._reader_task = asyncio.create_task(self._read_loop())
+        return True
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line.decode("utf-8"))
+                fut = self.pending.pop(msg.get("id"), None)
+                if fut is not None and not fut.done():
+                    fut.set_result(msg)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            for fut in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("session 連線中斷"))
+            self.pending.clear()
+
+    async def request(self, obj: dict) -> dict:
+        if self.closed:
+            raise ConnectionError("session 已關閉")
+        self.next_id += 1
+        rid = self.next_id
+        fut = self.loop.create_future()
+        self.pending[rid] = fut
+        self.writer.write((json.dumps(dict(obj, id=rid)) + "\n").encode("utf-8"))
+        await self.writer.drain()
+        resp = await fut
+        resp.pop("id", None)
+        return resp
+
+    async def close(self):
+        self.closed = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+
+_SESSION = None
+_SESSION_UNSUPPORTED = False
+
+
+async def get_session():
+    """目前 event loop 上可用的 session；server 不支援或連不上時回傳 None"""
+    global _SESSION, _SESSION_UNSUPPORTED
+    if _SESSION_UNSUPPORTED:
+        return None
+    loop = asyncio.get_running_loop()
+    if _SESSION is not None and not _SESSION.closed and _SESSION.loop is loop:
+        return _SESSION
+    s = DevSession(DEV_HOST, DEV_PORT)
+    try:
+        if not await s.connect():
+            _SESSION_UNSUPPORTED = True
+            return None
+    except (OSError, ValueError, EOFError):
+        return None
+    _SESSION = s
+    return s
+
+
+# session 中斷時可以安全地用一次性連線重送的 request（只讀取、不改變 server 狀態）
+IDEMPOTENT_KINDS = {"my_games", "version_hint"}
+
+
 async def send_req(obj: dict):
+    """
+    優先走 session 長連線；server 不支援時改用一次性連線。
+    session 在 request 送出後中斷時，不知道 server 有沒有處理過：
+    只有 IDEMPOTENT_KINDS 會重送，其他（上傳、下架、登入…）直接回傳錯誤，由使用者決定要不要重試。
+    """
+    s = await get_session()
+    if s is not None:
+        try:
+            return await s.request(obj)
+        except (ConnectionError, OSError) as e:
+            if obj.get("kind") not in IDEMPOTENT_KINDS:
+                return {"ok": False, "error": f"與 Developer Server 的連線中斷（{e}），請確認結果後再試"}
+    return await send_req_oneshot(obj)
+
+
+async def close_session():
+    global _SESSION
+    if _SESSION is not None:
+        await _SESSION.close()
+        _SESSION = None
+
+
+async def send_req_oneshot(obj: dict):
     reader, writer = await asyncio.open_connection(DEV_HOST, DEV_PORT)
     line = json.dumps(obj) + "\n"
     writer.write(line.encode("utf-8"))
@@ -114,6 +240,66 @@ async def send_req(obj: dict):
     return resp_obj
 
 
+UPLOAD_CHUNK = 256 * 1024
+
+
+def build_zip(game_dir: Path) -> Path:
+    """把遊戲資料夾壓成暫存 zip 檔（不整包放記憶體），呼叫端用完要自己刪掉"""
+    fd, name = tempfile.mkstemp(prefix="upload-", suffix=".zip")
+    try:
+        with os.fdopen(fd, "wb") as f, zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as z:
+            for path in game_dir.rglob("*"):
+                if path.is_file():
+                    rel = path.relative_to(game_dir)
+                    z.write(path, rel.as_posix())
+    except BaseException:
+        Path(name).unlink(missing_ok=True)
+        raise
+    return Path(name)
+
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+async def upload_stream(header: dict, zip_path: Path, sha256: str):
+    """
+    upload_game_stream：先送 JSON header，等 server 回 ready 後，
+    以 [4 bytes 長度][資料] 分段送出 zip 檔，最後送長度 0，再讀最終結果。
+    """
+    reader, writer = await asyncio.open_connection(DEV_HOST, DEV_PORT)
+    try:
+        req = dict(header, kind="upload_game_stream", size=zip_path.stat().st_size, sha256=sha256)
+        writer.write((json.dumps(req) + "\n").encode("utf-8"))
+        await writer.drain()
+
+        ready = await _read_json_line(reader)
+        if not ready.get("ok") or not ready.get("ready"):
+            return ready
+
+        with open(zip_path, "rb") as f:
+            while True:
+                chunk = f.read(UPLOAD_CHUNK)
+                if not chunk:
+                    break
+                writer.write(struct.pack(">I", len(chunk)))
+                writer.write(chunk)
+                await writer.drain()
+        writer.write(struct.pack(">I", 0))
+        await writer.drain()
+        return await _read_json_line(reader)
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+
 def clear_screen():
     os.system("cls" if os.name == "nt" else "clear")
 
@@ -131,6 +317,13 @@ def ask_choice(prompt: str, valid: set[str]) -> str:
 
 
 async def async_main():
+    try:
+        await _menu_loop()
+    finally:
+        await close_session()
+
+
+async def _menu_loop():
     global CURRENT_TOKEN
 
     # ⭐ 外層 while True：支援「登出後回到登入畫面」
@@ -238,54 +431,48 @@ async def async_main():
                     input("\n(按 Enter 繼續) ")
                     continue
 
-                # 先把整個資料夾壓成 zip（只做一次）
-                buf = io.BytesIO()
-                with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
-                    for path in game_dir.rglob("*"):
-                        if path.is_file():
-                            rel = path.relative_to(game_dir)
-                            z.write(path, rel.as_posix())
-                zip_bytes = buf.getvalue()
-                zip_b64 = base64.b64encode(zip_bytes).decode("utf-8")
-
-                # 進入版本號輸入迴圈
-                while True:
-                    ver_input = input(f"版本號（例如 1.0.0；直接 Enter 使用建議值 {suggested}）: ").strip()
-                    if not ver_input:
-                        version = suggested
-                        print(f"→ 使用版本號：{version}")
-                    else:
-                        version = ver_input
-
-                    print(f"\n正在上傳 {game_name}@{version} ...")
-                    resp = await send_req({
-                        "kind": "upload_game",
-                        "token": token,
-                        "name": game_name,
-                        "version": version,
-                        "manifest": manifest,
-                        "zip_b64": zip_b64
-                    })
-
-                    if resp.get("ok"):
-                        print(f"✓ 上傳成功：{resp.get('name')} 最新版 {resp.get('latest')} (status={resp.get('status')})")
-                        input("\n(按 Enter 繼續) ")
-                        break  # 離開版本號輸入迴圈
-
-                    # 失敗情況 → 顯示錯誤與建議
-                    err = resp.get("error", "未知錯誤")
-                    print("✗ 上傳失敗：", err)
-
-                    latest = resp.get("latest")
-                    suggested2 = resp.get("suggested")
-                    if latest and suggested2:
-                        print(f"  目前最新版本為 {latest}，建議下一個可用版本號：{suggested2}")
-                        suggested = suggested2  # 更新建議值
-
-                    retry = ask_choice("要重新輸入版本號並重試嗎？(y/n): ", set(["y", "Y", "n", "N"]))
-                    if retry.lower() != "y":
-                        break
-
+                # 先把整個資料夾壓成暫存 zip 檔（只做一次），上傳時分段串流送出
+                zip_path = build_zip(game_dir)
+                try:
+                    zip_sha = file_sha256(zip_path)
+
+                    # 進入版本號輸入迴圈
+                    while True:
+                        ver_input = input(f"版本號（例如 1.0.0；直接 Enter 使用建議值 {suggested}）: ").strip()
+                        if not ver_input:
+                            version = suggested
+                            print(f"→ 使用版本號：{version}")
+                        else:
+                            version = ver_input
+
+                        print(f"\n正在上傳 {game_name}@{version} ...")
+                        resp = await upload_stream({
+                            "token": token,
+                            "name": game_name,
+                            "version": version,
+                            "manifest": manifest,
+                        }, zip_path, zip_sha)
+
+                        if resp.get("ok"):
+                            print(f"✓ 上傳成功：{resp.get('name')} 最新版 {resp.get('latest')} (status={resp.get('status')})")
+                            input("\n(按 Enter 繼續) ")
+                            break  # 離開版本號輸入迴圈
+
+                        # 失敗情況 → 顯示錯誤與建議
+                        err = resp.get("error", "未知錯誤")
+                        print("✗ 上傳失敗：", err)
+
+                        latest = resp.get("latest")
+                        suggested2 = resp.get("suggested")
+                        if latest and suggested2:
+                            print(f"  目前最新版本為 {latest}，建議下一個可用版本號：{suggested2}")
+                            suggested = suggested2  # 更新建議值
+
+                        retry = ask_choice("要重新輸入版本號並重試嗎？(y/n): ", set(["y", "Y", "n", "N"]))
+                        if retry.lower() != "y":
+                            break
+                finally:
+                    zip_path.unlink(missing_ok=True)
                 # 回到主選單
                 continue
 
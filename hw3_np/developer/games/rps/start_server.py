@@ -1,5 +1,6 @@
 #developer\games\rps\start_server.py
 import os, socket, threading, json, time
+from lobby_game import listen_socket, notify_ready
 
 HOST = os.getenv("GAME_HOST", "127.0.0.1")
 PORT = int(os.getenv("GAME_PORT", "0"))
@@ -433,9 +434,8 @@ def handle(conn, addr):
 
                 
 def serve():
-    s = socket.socket()
-    s.bind((HOST, PORT))
-    s.listen(5)
+    s = listen_socket(HOST, PORT, backlog=5)
+    notify_ready()
     print(f"[HB-Server] Listening...", flush=True)
     while True:
         c, a = s.accept()
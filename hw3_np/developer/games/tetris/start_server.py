@@ -11,20 +11,23 @@ import argparse, asyncio, time, random, json, subprocess, socket, sys, threading
 from typing import Dict, Optional, List
 from framing import recv_json, send_json
 from logic_tetris import TetrisEngine, PID
+from lobby_game import listen_socket, notify_ready
 
-def get_lobby_connect_host():
+def get_lobby_connect_host(env=None):
     """
     取得用於連線回 Lobby 的實際 IP：
     - 優先使用 LOBBY_CONNECT_HOST（專門用於連線的 IP）
     - 否則使用 LOBBY_HOST，但若為 0.0.0.0 則改用 127.0.0.1
+    env：host 模式下每個房間自己的環境變數（預設 os.environ）
     """
+    env = os.environ if env is None else env
     # 優先使用專門的連線位址
-    connect_host = os.getenv("LOBBY_CONNECT_HOST")
+    connect_host = env.get("LOBBY_CONNECT_HOST")
     if connect_host:
         return connect_host
     
     # 否則使用 LOBBY_HOST，但需處理 0.0.0.0
-    lobby_host = os.getenv("LOBBY_HOST")
+    lobby_host = env.get("LOBBY_HOST")
     if not lobby_host:
         return None
     
@@ -57,8 +60,6 @@ def notify_lobby_game_finished_kick_all():
     except Exception as e:
         print(f"[GameServer] notify kick_all failed: {e}", flush=True)
 
-ARGS = None
-
 TICK_MS = 50
 SNAPSHOT_MS = 150
 
@@ -74,7 +75,12 @@ class Conn:
 
 class GameRoom:
     def __init__(self, duration_sec: int = 60, drop_ms: int = 500, seed: Optional[int]=None, 
-                 gravity_mode: str = "progressive", gravity_config: Optional[dict] = None):
+                 gravity_mode: str = "progressive", gravity_config: Optional[dict] = None,
+                 room_id: str = "0", lobby_host: Optional[str] = None, lobby_port: int = 0):
+        # 🔧 房間自己記住要回報的 lobby（host 模式下同一個行程有很多房間，不能用全域參數）
+        self.room_id = room_id
+        self.lobby_host = lobby_host
+        self.lobby_port = lobby_port
         self.duration_sec = duration_sec
         self.gravity_mode = gravity_mode
         cfg = gravity_config or {}
@@ -614,8 +620,8 @@ async def broadcast_game_end(room: GameRoom):
             pass
     room.spectators.clear()
     
-    # ✅ 通知 Lobby 踢人並關房
-    notify_lobby_and_close(room)
+    # ✅ 通知 Lobby 踢人並關房（丟到執行緒做，host 模式下不會卡住同一個 loop 上的其他房間）
+    await asyncio.get_running_loop().run_in_executor(None, notify_lobby_and_close, room)
     
     # 給客戶端時間處理
     await asyncio.sleep(1.5)
@@ -624,8 +630,8 @@ async def broadcast_game_end(room: GameRoom):
 def notify_lobby_and_close(room):
     """通知 Lobby 遊戲結束並踢出所有人"""
     try:
-        lobby_host = get_lobby_connect_host() or getattr(ARGS, "lobbyHost", None)
-        lobby_port = int(getattr(ARGS, "lobbyPort", 0) or os.getenv("LOBBY_PORT", "0"))
+        lobby_host = room.lobby_host
+        lobby_port = int(room.lobby_port or 0)
         
         if not lobby_host or not lobby_port:
             print(f"[GameServer] No lobby info, skip notify", flush=True)
@@ -642,7 +648,7 @@ def notify_lobby_and_close(room):
         
         payload = {
             "kind": "game_finished",
-            "room_id": ARGS.roomId,
+            "room_id": room.room_id,
             "kick_all": True,  # ✅ 關鍵：要求踢出所有人
             "reason": room.early_end_reason or "game_end",
             "winnerRole": winner_role,
@@ -667,6 +673,64 @@ def notify_lobby_and_close(room):
     except Exception as e:
         print(f"[GameServer] Failed to notify lobby: {e}", flush=True)
         
+async def run_room(room: GameRoom, sock, ready_fd=None):
+    """在 sock 上跑一個房間，直到這局結束（單房間模式跟 host 模式共用）"""
+    async def _handle(r, w):
+        await handle_client(room, r, w)
+
+    try:
+        server = await asyncio.start_server(_handle, sock=sock)
+    except Exception:
+        if ready_fd is not None:
+            os.close(ready_fd)
+        raise
+    notify_ready(ready_fd)
+    port = sock.getsockname()[1]
+    print(f"[GameServer] Listening @ {port}  room={room.room_id}  seed={room.seed}  dropMs={room.drop_ms}  duration={room.duration_sec}s")
+
+    try:
+        # 並行運行伺服器和遊戲循環
+        async with server:
+            loop_task = asyncio.create_task(game_loop(room))
+            serve_task = asyncio.create_task(server.serve_forever())
+            
+            # 等待遊戲循環結束
+            await loop_task
+            
+            # 遊戲結束後立即關閉伺服器
+            print("[GameServer] ⚠ Closing server socket...")
+            server.close()
+            await server.wait_closed()
+            
+            # 取消 serve_forever
+            serve_task.cancel()
+            try:
+                await serve_task
+            except asyncio.CancelledError:
+                pass
+            
+            print("[GameServer] ✓ Server closed")
+            await asyncio.sleep(2.0)
+            print("[GameServer] Closing remaining connections...")
+            await close_room_conns(room)
+            print(f"[GameServer] ✓✓✓ Room {room.room_id} shutdown complete")
+    except asyncio.CancelledError:
+        # host 模式下 lobby 要求收掉這個房間
+        room.done = True
+        room.accepting_connections = False
+        await close_room_conns(room)
+        raise
+    finally:
+        server.close()
+
+async def close_room_conns(room: GameRoom):
+    for conn in [c for c in room.conns.values() if c is not None] + room.spectators:
+        try:
+            conn.writer.close()
+            await conn.writer.wait_closed()
+        except:
+            pass
+
 async def main():
     ap = argparse.ArgumentParser()
     
@@ -675,11 +739,7 @@ async def main():
     default_room_id = os.getenv("ROOM_ID", "0")
     
     # 🔧 關鍵：優先使用 LOBBY_CONNECT_HOST，並處理 0.0.0.0
-    default_lobby_host = os.getenv("LOBBY_CONNECT_HOST")
-    if not default_lobby_host:
-        default_lobby_host = os.getenv("LOBBY_HOST", "127.0.0.1")
-        if default_lobby_host == "0.0.0.0":
-            default_lobby_host = "127.0.0.1"
+    default_lobby_host = get_lobby_connect_host() or "127.0.0.1"
     
     default_lobby_port = int(os.getenv("LOBBY_PORT", "13001"))
     
@@ -695,9 +755,6 @@ async def main():
     ap.add_argument("--gravityConfig", default=None)
     args = ap.parse_args()
 
-    global ARGS
-    ARGS = args
-    
     # 🔧 驗證 port
     if args.port == 0:
         print("[GameServer] Error: No port specified (use --port or GAME_PORT env)", flush=True)
@@ -719,66 +776,112 @@ async def main():
         drop_ms=args.dropMs, 
         seed=args.seed,
         gravity_mode=args.gravityMode,
-        gravity_config=gravity_config
+        gravity_config=gravity_config,
+        room_id=args.roomId,
+        lobby_host=args.lobbyHost,
+        lobby_port=args.lobbyPort,
     )
 
-    server = None
-    
-    async def _handle(r, w):
-        await handle_client(room, r, w)
-
     try:
-        server = await asyncio.start_server(_handle, host="0.0.0.0", port=args.port)
-        print(f"[GameServer] Listening @ {args.port}  seed={room.seed}  dropMs={room.drop_ms}  duration={room.duration_sec}s")
-        
-        # 並行運行伺服器和遊戲循環
-        async with server:
-            loop_task = asyncio.create_task(game_loop(room))
-            serve_task = asyncio.create_task(server.serve_forever())
-            
-            # 等待遊戲循環結束
-            await loop_task
-            
-            # 遊戲結束後立即關閉伺服器
-            print("[GameServer] ⚠ Closing server socket...")
-            server.close()
-            await server.wait_closed()
-            
-            # 取消 serve_forever
-            serve_task.cancel()
-            try:
-                await serve_task
-            except asyncio.CancelledError:
-                pass
-            
-            print("[GameServer] ✓ Server closed")
-            await asyncio.sleep(2.0)
-            print("[GameServer] Closing remaining connections...")
-            for role, conn in room.conns.items():
-                if conn:
-                    try:
-                        conn.writer.close()
-                        await conn.writer.wait_closed()
-                    except:
-                        pass
-            print("[GameServer] ✓✓✓ Shutdown complete, exiting...")
-    
+        await run_room(room, listen_socket("0.0.0.0", args.port, backlog=100, blocking=False))
     except Exception as e:
         print(f"[GameServer] Fatal error: {e}")
         import traceback
         traceback.print_exc()
-    
     finally:
-        if server:
-            server.close()
-            try:
-                await server.wait_closed()
-            except:
-                pass
         print("[GameServer] Process terminating...")
         sys.exit(0)
 
+async def host_main(ctrl_fd: int):
+    """
+    host 模式（lobby 給了 GAME_HOST_FD）：同一個 loop 上跑很多房間。
+    lobby 從控制通道送 {"op": "open" / "close", "room_id", ...}，開房時附上該房間的
+    listening socket（與 ready pipe）；每個房間結束就回報 {"closed": room_id, "code"}。
+    lobby 關掉控制通道之後不再接新房間，現有房間都結束才離開。
+    """
+    loop = asyncio.get_running_loop()
+    ctrl = socket.socket(fileno=ctrl_fd)
+    ctrl.setblocking(False)
+    rooms: Dict[str, asyncio.Task] = {}
+    lobby_gone = asyncio.Event()
+
+    def send(obj):
+        try:
+            ctrl.send(json.dumps(obj).encode("utf-8"))
+        except OSError:
+            pass
+
+    def on_ctrl():
+        while True:
+            try:
+                msg, fds, _, _ = socket.recv_fds(ctrl, 65536, 4)
+            except BlockingIOError:
+                return
+            except OSError:
+                msg, fds = b"", []
+            if not msg:
+                loop.remove_reader(ctrl)
+                lobby_gone.set()
+                return
+            try:
+                req = json.loads(msg)
+            except ValueError:
+                req = {}
+            if req.get("op") == "open":
+                open_room(req, dict(zip(req.get("fds") or [], fds)))
+                continue
+            for fd in fds:
+                os.close(fd)
+            task = rooms.get(req.get("room_id"))
+            if req.get("op") == "close" and task is not None:
+                task.cancel()
+
+    def open_room(req, fds):
+        room_id = req.get("room_id") or "0"
+        env = dict(os.environ)
+        env.update(req.get("env") or {})
+        task = loop.create_task(host_room(room_id, env, fds.get("GAME_LISTEN_FD"), fds.get("GAME_READY_FD")))
+        rooms[room_id] = task
+        task.add_done_callback(lambda t: room_finished(room_id, t))
+        print(f"[GameHost] Opened room {room_id} ({len(rooms)} rooms)", flush=True)
+
+    def room_finished(room_id, task):
+        rooms.pop(room_id, None)
+        if task.cancelled():
+            code = -15
+        elif task.exception() is not None:
+            print(f"[GameHost] Room {room_id} failed: {task.exception()!r}", flush=True)
+            code = 1
+        else:
+            code = 0
+        print(f"[GameHost] Room {room_id} closed (code={code}, {len(rooms)} rooms left)", flush=True)
+        send({"closed": room_id, "code": code})
+
+    async def host_room(room_id, env, listen_fd, ready_fd):
+        if listen_fd is None:
+            if ready_fd is not None:
+                os.close(ready_fd)
+            raise RuntimeError("missing GAME_LISTEN_FD")
+        sock = socket.socket(fileno=listen_fd)
+        sock.setblocking(False)
+        room = GameRoom(
+            room_id=room_id,
+            lobby_host=get_lobby_connect_host(env) or "127.0.0.1",
+            lobby_port=int(env.get("LOBBY_PORT") or 0),
+        )
+        await run_room(room, sock, ready_fd)
+
+    loop.add_reader(ctrl, on_ctrl)
+    print(f"[GameHost] pid={os.getpid()} waiting for rooms", flush=True)
+    await lobby_gone.wait()
+    while rooms:
+        await asyncio.gather(*rooms.values(), return_exceptions=True)
+    print("[GameHost] No more rooms, exiting", flush=True)
+
 if __name__ == "__main__":
+    if os.getenv("GAME_HOST_FD"):
+        asyncio.run(host_main(int(os.environ.pop("GAME_HOST_FD"))))
+        sys.exit(0)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
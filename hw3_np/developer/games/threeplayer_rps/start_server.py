@@ -1,5 +1,6 @@
 # developer/games/threeplayer_rps/start_server.py - 完整版本
 import os, socket, threading, json, time
+from lobby_game import listen_socket, notify_ready
 
 HOST = os.getenv("GAME_HOST", "127.0.0.1")
 PORT = int(os.getenv("GAME_PORT", "0"))
@@ -575,9 +576,8 @@ def handle(conn, addr):
                 os._exit(0)
 
 def serve():
-    s = socket.socket()
-    s.bind((HOST, PORT))
-    s.listen(5)
+    s = listen_socket(HOST, PORT, backlog=5)
+    notify_ready()
     print(f"[RPS3-Server] Listening...", flush=True)
     while True:
         c, a = s.accept()
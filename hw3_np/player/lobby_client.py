@@ -1,6 +1,6 @@
 # player/lobby_client.py - 最終交作業版（自動判斷連線目標 + SSE 房間 UI）
 
-import os, sys, json, asyncio, base64, zipfile, io, shutil, subprocess, socket, signal
+import os, sys, json, asyncio, base64, zipfile, io, shutil, subprocess, socket, signal, hashlib
 from pathlib import Path
 
 # ✅ downloads 放在 player/ 資料夾內
@@ -139,8 +139,134 @@ def has_local_game_version(player_name: str, game: str, version: str) -> bool:
     p = DOWNLOADS_ROOT / player_name / game / version / "start_client.py"
     return p.exists()
 
+class LobbySession:
+    """
+    session 模式：跟 Lobby Server 維持一條長連線。
+      - 每個 request 帶 id，可以同時送出多個，回應依 id 對回去（不保證順序）
+      - 伺服器推播的房間事件（沒有 id 的 {"event": ...}）放進 self.events；
+        有在 self.listeners 登記的事件（例如大廳的 lobby_room）改成直接呼叫 callback
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.reader = None
+        self.writer = None
+        self.pending = {}      # id -> Future
+        self.next_id = 0
+        self.events = asyncio.Queue()
+        self.listeners = {}    # event 名稱 -> callback(msg)
+        self.closed = True
+        self._reader_task = None
+
+    async def connect(self) -> bool:
+        self.loop = asyncio.get_running_loop()
+        # 回應可能很長（遊戲列表 / 評論），放寬 readline 的上限
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, limit=16 * 1024 * 1024)
+        self.writer.write((json.dumps({"kind": "session"}) + "\n").encode("utf-8"))
+        await self.writer.drain()
+        resp = json.loads((await self.reader.readline()).decode("utf-8") or "{}")
+        if not resp.get("session"):
+            # 舊版 / threads 模式的 server 不支援，呼叫端改用一次性連線
+            self.writer.close()
+            return False
+        self.closed = False
+        self._reader_task = asyncio.create_task(self._read_loop())
+        return True
+
+    async def _read_loop(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                msg = json.loads(line.decode("utf-8"))
+                fut = self.pending.pop(msg.get("id"), None) if "id" in msg else None
+                if fut is not None:
+                    if not fut.done():
+                        fut.set_result(msg)
+                elif "event" in msg:
+                    cb = self.listeners.get(msg["event"])
+                    if cb is not None:
+                        cb(msg)
+                    else:
+                        self.events.put_nowait(msg)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        finally:
+            self.closed = True
+            self.events.put_nowait(None)   # 叫醒等事件的人：session 斷了
+            for fut in self.pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("session 連線中斷"))
+            self.pending.clear()
+
+    async def request(self, payload: dict) -> dict:
+        if self.closed:
+            raise ConnectionError("session 已關閉")
+        self.next_id += 1
+        rid = self.next_id
+        fut = self.loop.create_future()
+        self.pending[rid] = fut
+        self.writer.write((json.dumps(dict(payload, id=rid), ensure_ascii=False) + "\n").encode("utf-8"))
+        await self.writer.drain()
+        resp = await fut
+        resp.pop("id", None)
+        return resp
+
+    async def close(self):
+        self.closed = True
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
+_SESSION = None
+_SESSION_UNSUPPORTED = False
+
+async def get_session():
+    """目前 event loop 上可用的 session；server 不支援或連不上時回傳 None"""
+    global _SESSION, _SESSION_UNSUPPORTED
+    if _SESSION_UNSUPPORTED:
+        return None
+    loop = asyncio.get_running_loop()
+    if _SESSION is not None and not _SESSION.closed and _SESSION.loop is loop:
+        return _SESSION
+    s = LobbySession(LOBBY_HOST, LOBBY_PORT)
+    try:
+        if not await s.connect():
+            _SESSION_UNSUPPORTED = True
+            return None
+    except (OSError, ValueError):
+        return None
+    _SESSION = s
+    return s
+
+# session 中斷時可以安全地用一次性連線重送的 request（只讀取、不改變 server 狀態）
+IDEMPOTENT_KINDS = {"list_games", "list_rooms", "game_details"}
+
 async def send_req(payload):
-    """發送請求並接收回應（Lobby Server）"""
+    """
+    發送請求並接收回應（Lobby Server）：優先走 session 長連線，server 不支援時改用一次性連線。
+    session 在 request 送出後中斷時不知道 server 有沒有處理過，只有 IDEMPOTENT_KINDS 會重送，
+    其他（開房、加入、評分…）回傳錯誤，避免同一個動作做兩次。
+    """
+    s = await get_session()
+    if s is not None:
+        try:
+            return await s.request(payload)
+        except (ConnectionError, OSError) as e:
+            if payload.get("kind") not in IDEMPOTENT_KINDS:
+                return {"ok": False, "error": f"與大廳伺服器的連線中斷（{e}），請確認結果後再試"}
+    return await send_req_oneshot(payload)
+
+async def send_req_oneshot(payload):
+    """一次性連線：送一個 request、收一個回應就關閉（舊協定）"""
     try:
         reader, writer = await asyncio.open_connection(LOBBY_HOST, LOBBY_PORT)
         line = json.dumps(payload, ensure_ascii=False) + "\n"
@@ -157,8 +283,177 @@ async def send_req(payload):
     except Exception as e:
         return {"ok": False, "error": f"連線錯誤：{e}"}
 
-def safe_extract_zip(b: bytes, dest: Path):
-    with zipfile.ZipFile(io.BytesIO(b), "r") as z:
+DOWNLOAD_CHUNK = 256 * 1024
+DOWNLOAD_RETRIES = 3
+
+async def download_package(player: str, name: str):
+    """
+    用 download_game_stream 下載遊戲包，邊收邊寫到 downloads/<player>/.<name>.part。
+    連線中斷會帶著已收到的 offset 重新連線續傳（最多 DOWNLOAD_RETRIES 次），
+    上次沒下載完的 .part 也會沿用；收完後驗證 sha256。
+    成功回傳 (header, zip 檔路徑)，失敗回傳 ({"ok": False, ...}, None)。
+    """
+    base = DOWNLOADS_ROOT / player
+    base.mkdir(parents=True, exist_ok=True)
+    part = base / f".{name}.part"
+    meta = base / f".{name}.part.json"
+
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        prev = {}
+        if part.exists() and meta.exists():
+            try:
+                prev = json.loads(meta.read_text(encoding="utf-8"))
+            except Exception:
+                prev = {}
+        offset = part.stat().st_size if prev else 0
+
+        try:
+            reader, writer = await asyncio.open_connection(LOBBY_HOST, LOBBY_PORT)
+        except ConnectionRefusedError:
+            return {"ok": False, "error": "無法連線到大廳伺服器"}, None
+        try:
+            req = {"kind": "download_game_stream", "name": name,
+                   "offset": offset, "sha256": prev.get("sha256")}
+            writer.write((json.dumps(req, ensure_ascii=False) + "\n").encode("utf-8"))
+            await writer.drain()
+
+            header = json.loads((await reader.readline()).decode("utf-8"))
+            if not header.get("ok"):
+                return header, None
+
+            offset = header["offset"]
+            meta.write_text(json.dumps({"sha256": header["sha256"]}), encoding="utf-8")
+            with open(part, "r+b" if offset and part.exists() else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                remaining = header["size"] - offset
+                while remaining > 0:
+                    chunk = await reader.read(min(DOWNLOAD_CHUNK, remaining))
+                    if not chunk:
+                        raise ConnectionError("下載中途連線中斷")
+                    f.write(chunk)
+                    remaining -= len(chunk)
+        except (ConnectionError, asyncio.IncompleteReadError, OSError) as e:
+            if attempt < DOWNLOAD_RETRIES:
+                print(f"⚠️  {e}，{attempt + 1} 秒後從斷點續傳...")
+                await asyncio.sleep(attempt + 1)
+                continue
+            return {"ok": False, "error": f"下載失敗：{e}"}, None
+        except Exception as e:
+            return {"ok": False, "error": f"連線錯誤：{e}"}, None
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+        h = hashlib.sha256()
+        with open(part, "rb") as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK), b""):
+                h.update(chunk)
+        if h.hexdigest() != header["sha256"]:
+            # 內容壞掉就整個重下
+            part.unlink(missing_ok=True)
+            meta.unlink(missing_ok=True)
+            if attempt < DOWNLOAD_RETRIES:
+                continue
+            return {"ok": False, "error": "sha256 驗證失敗"}, None
+        meta.unlink(missing_ok=True)
+        return header, part
+
+    return {"ok": False, "error": "下載失敗"}, None
+
+def installed_version(player: str, name: str):
+    """本機目前裝的版本（downloads/<player>/<game>/ 底下有 manifest.json 的資料夾，取版本號最大的）"""
+    base = DOWNLOADS_ROOT / player / name
+    if not base.exists():
+        return None
+    def key(v):
+        try:
+            return tuple(int(x) for x in v.split("."))
+        except ValueError:
+            return ()
+    vers = [d.name for d in base.iterdir()
+            if d.is_dir() and not d.name.startswith(".") and (d / "manifest.json").exists()]
+    return max(vers, key=key) if vers else None
+
+def _safe_rel(path: str) -> Path:
+    p = Path(path)
+    if p.is_absolute() or ".." in p.parts:
+        raise ValueError(f"不合法的檔案路徑：{path}")
+    return p
+
+async def download_delta(player: str, name: str, from_version: str):
+    """
+    用 download_delta 從 from_version 升級到最新版：只收新增 / 有變動的檔案。
+    檔案先收進 .staging-<version>/ 並逐一驗證 sha256，全部成功後才把舊版資料夾改名成新版本、
+    放進新檔案、刪掉新版已不存在的檔案；中途失敗不會動到原本的安裝。
+    成功回傳 (header, 新版資料夾)，失敗回傳 ({"ok": False, ...}, None)（呼叫端改走完整下載）。
+    """
+    base = DOWNLOADS_ROOT / player / name
+    old_dir = base / from_version
+    try:
+        reader, writer = await asyncio.open_connection(LOBBY_HOST, LOBBY_PORT)
+    except ConnectionRefusedError:
+        return {"ok": False, "error": "無法連線到大廳伺服器"}, None
+
+    staging = None
+    try:
+        req = {"kind": "download_delta", "name": name, "from_version": from_version}
+        writer.write((json.dumps(req, ensure_ascii=False) + "\n").encode("utf-8"))
+        await writer.drain()
+
+        header = json.loads((await reader.readline()).decode("utf-8"))
+        if not header.get("ok"):
+            return header, None
+
+        staging = base / f".staging-{header['version']}"
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir(parents=True)
+        for item in header["files"]:
+            dst = staging / _safe_rel(item["path"])
+            dst.parent.mkdir(parents=True, exist_ok=True)
+            h = hashlib.sha256()
+            remaining = item["size"]
+            with open(dst, "wb") as f:
+                while remaining > 0:
+                    chunk = await reader.read(min(DOWNLOAD_CHUNK, remaining))
+                    if not chunk:
+                        raise ConnectionError("下載中途連線中斷")
+                    h.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            if h.hexdigest() != item["sha256"]:
+                raise ValueError(f"{item['path']} sha256 驗證失敗")
+    except Exception as e:
+        if staging is not None:
+            shutil.rmtree(staging, ignore_errors=True)
+        return {"ok": False, "error": f"差異更新失敗：{e}"}, None
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except Exception:
+            pass
+
+    # 套用：舊版資料夾原地改名成新版本，再放進新檔案 / 刪掉多餘的檔案
+    new_dir = base / header["version"]
+    if new_dir != old_dir:
+        shutil.rmtree(new_dir, ignore_errors=True)
+        os.replace(old_dir, new_dir)
+    for path in header["deleted"]:
+        (new_dir / _safe_rel(path)).unlink(missing_ok=True)
+    for item in header["files"]:
+        rel = _safe_rel(item["path"])
+        (new_dir / rel).parent.mkdir(parents=True, exist_ok=True)
+        os.replace(staging / rel, new_dir / rel)
+    shutil.rmtree(staging, ignore_errors=True)
+    return header, new_dir
+
+def safe_extract_zip(src, dest: Path):
+    """src：zip 的 bytes 或檔案路徑"""
+    with zipfile.ZipFile(io.BytesIO(src) if isinstance(src, bytes) else src, "r") as z:
         z.extractall(dest)
 
 def get_local_client_dir(player, game, version):
@@ -200,11 +495,69 @@ def print_game_menu(games: dict):
               f"最新版: {latest}  共 {len(versions)} 版  評分: {rating_str}")
     return items
 
+class LobbyDirectory:
+    """
+    大廳房間列表的本地快取：在 session 上 subscribe_lobby 一次拿到完整目錄，
+    之後只靠伺服器推播的 lobby_room 事件（created / changed / closed）更新，
+    看列表不會再送任何 request。server 不支援 session 時退回每次 list_rooms。
+    """
+
+    def __init__(self):
+        self.rooms = {}
+        self.seq = None
+        self.session = None     # 目錄是在哪個 session 上訂閱的
+        self._early = None      # 訂閱回應回來之前先到的事件
+
+    def _on_event(self, msg):
+        if self._early is not None:
+            self._early.append(msg)
+            return
+        seq = msg.get("seq")
+        if self.seq is not None and seq is not None and seq <= self.seq:
+            return
+        if msg.get("op") == "closed":
+            self.rooms.pop(msg.get("room_id"), None)
+        else:
+            self.rooms[msg.get("room_id")] = msg.get("room") or {}
+        if seq is not None:
+            self.seq = seq
+
+    async def _subscribe(self, s):
+        self._early = []
+        s.listeners["lobby_room"] = self._on_event
+        try:
+            resp = await s.request({"kind": "subscribe_lobby"})
+        except (ConnectionError, OSError):
+            resp = {"ok": False}
+        early, self._early = self._early, None
+        if not resp.get("ok"):
+            s.listeners.pop("lobby_room", None)
+            return False
+        self.rooms = resp.get("rooms", {})
+        self.seq = resp.get("seq")
+        self.session = s
+        for msg in early:
+            self._on_event(msg)
+        return True
+
+    async def get(self, token=None):
+        s = await get_session()
+        if s is not None:
+            if s is self.session:
+                # 讓已經到達、還沒處理的推播先套用（等使用者輸入時 event loop 沒在跑）
+                await asyncio.sleep(0.05)
+                return dict(self.rooms)
+            if await self._subscribe(s):
+                return dict(self.rooms)
+        resp = await send_req({"kind":"list_rooms","token":token} if token else {"kind":"list_rooms"})
+        if not resp.get("ok"):
+            print(resp); return {}
+        return resp.get("rooms", {})
+
+LOBBY_DIRECTORY = LobbyDirectory()
+
 async def fetch_rooms(token=None):
-    resp = await send_req({"kind":"list_rooms","token":token} if token else {"kind":"list_rooms"})
-    if not resp.get("ok"):
-        print(resp); return {}
-    return resp.get("rooms", {})
+    return await LOBBY_DIRECTORY.get(token)
 
 def print_room_menu(rooms: dict):
     if not rooms:
@@ -239,17 +592,32 @@ class AsyncRoomUI:
         self.reader = None
         self.writer = None
         self.last_start_state = None   # ⭐ 新增：記住上一個 start.state
+        self.session = None            # 有 session 時，房間事件從 session 的 events 收
+        self.room_seq = None           # 最後套用的房間事件 seq（重新訂閱時只補漏掉的）
         
-    async def connect_stream(self):
-        """建立持續連線以接收即時更新"""
-        self.reader, self.writer = await asyncio.open_connection(LOBBY_HOST, LOBBY_PORT)
-        line = json.dumps({"kind": "subscribe_room", "token": self.token, "room_id": self.room_id}) + "\n"
-        self.writer.write(line.encode("utf-8"))
-        await self.writer.drain()
-        
-        # 讀取初始確認訊息
-        data = await self.reader.readline()
-        resp = json.loads(data.decode("utf-8"))
+    async def connect_stream(self, resume=False):
+        """
+        建立持續連線以接收即時更新（有 session 就直接在 session 上訂閱）。
+        訂閱 delta 事件；resume=True 時帶 since_seq，伺服器只補送漏掉的事件。
+        """
+        sub = {"kind": "subscribe_room", "token": self.token, "room_id": self.room_id, "delta": True}
+        if resume and self.room_seq is not None:
+            sub["since_seq"] = self.room_seq
+        self.session = await get_session()
+        if self.session is not None:
+            # 清掉之前房間殘留的事件
+            if not resume:
+                while not self.session.events.empty():
+                    self.session.events.get_nowait()
+            resp = await self.session.request(sub)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(LOBBY_HOST, LOBBY_PORT)
+            self.writer.write((json.dumps(sub) + "\n").encode("utf-8"))
+            await self.writer.drain()
+
+            # 讀取初始確認訊息
+            data = await self.reader.readline()
+            resp = json.loads(data.decode("utf-8"))
         if not resp.get("ok"):
             print(f"訂閱失敗：{resp.get('error')}")
             return False
@@ -257,51 +625,131 @@ class AsyncRoomUI:
         # ✅ 這裡把 room 一次性塞進來，避免卡在「等待房間資料」
         if "room" in resp:
             self.room_info = resp["room"]
+        for ev in resp.get("events", []):
+            self._apply_event(ev)
+        self.room_seq = resp.get("seq")
+        if self.room_info is not None:
             self.display()
 
         return True
 
+    async def _resubscribe(self):
+        """訂閱連線斷掉 / 事件有缺號：關掉舊的訂閱，帶 since_seq 重新訂閱"""
+        prev_state = self.last_start_state
+        if self.session is None and self.writer and not self.writer.is_closing():
+            self.writer.close()
+        try:
+            if not await self.connect_stream(resume=True):
+                return False
+        except (ConnectionError, OSError, ValueError) as e:
+            print(f"\n[重新訂閱失敗] {e}")
+            return False
+        await self._on_room_changed(prev_state)
+        return True
+
+    def _apply_event(self, msg) -> str:
+        """
+        套用一筆房間事件，回傳 "applied" / "skip"（舊的或重複的）/ "gap"（中間漏了）。
+        沒有 seq 的 room_update 是舊版 server，直接整份取代。
+        """
+        seq = msg.get("seq")
+        if seq is not None and self.room_seq is not None:
+            if seq <= self.room_seq:
+                return "skip"
+            if msg.get("event") == "room_delta" and seq != self.room_seq + 1:
+                return "gap"
+        if msg.get("event") == "room_update":
+            self.room_info = msg.get("room")
+        elif msg.get("event") == "room_delta":
+            if self.room_info is None:
+                return "gap"
+            room = dict(self.room_info)
+            room.update(msg.get("set") or {})
+            for k in msg.get("del") or []:
+                room.pop(k, None)
+            self.room_info = room
+        else:
+            return "skip"
+        if seq is not None:
+            self.room_seq = seq
+        self.last_start_state = (self.room_info or {}).get("start", {}).get("state")
+        return "applied"
+
     
+    async def _next_event(self):
+        """下一個房間事件；連線結束（或離開房間）回傳 None"""
+        if self.session is not None:
+            while True:
+                msg = await self.session.events.get()
+                if msg is None or msg.get("room_id") in (None, self.room_id):
+                    return msg
+        data = await self.reader.readline()
+        return json.loads(data.decode("utf-8")) if data else None
+
+    async def _stop_stream(self):
+        if self.session is not None:
+            # 讓卡在 events.get() 的 update_loop 醒來
+            self.session.events.put_nowait(None)
+            try:
+                await self.session.request({"kind": "unsubscribe_room", "room_id": self.room_id})
+            except (ConnectionError, OSError):
+                pass
+        elif self.writer and not self.writer.is_closing():
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+
     async def update_loop(self):
         """接收伺服器推送的房間更新"""
         try:
             while self.running:
-                data = await self.reader.readline()
-                if not data:
-                    break
-                
-                msg = json.loads(data.decode("utf-8"))
-                if msg.get("event") == "room_update":
-                    # 先記錄舊的 start.state
-                    prev_state = self.last_start_state
-
-                    # 更新最新 room 狀態
-                    self.room_info = msg.get("room")
-                    self.last_start_state = (self.room_info or {}).get("start", {}).get("state")
-
-                    self.display()
-
-                    # 如果房間回到 waiting，而且沒有 start 提案，就把本地 ready 狀態也視為「未就緒」
-                    status = (self.room_info or {}).get("status")
-                    start_state = (self.room_info or {}).get("start", {}).get("state")
-                    if status == "waiting" and start_state in (None, "idle"):
-                        self.game_started = False
-                        # 讓本地標記跟 server 同步，以顯示成「像剛進來」的狀態
-                        self.player_ready = (
-                            self.player in (self.room_info or {}).get("ready_players", [])
-                        )
+                msg = await self._next_event()
+                if msg is None:
+                    # 連線斷了（房間刪除時也會）：重新訂閱，只補漏掉的事件；房間不在了就結束
                     if not self.running:
                         break
+                    await asyncio.sleep(0.2)
+                    if not self.running or not await self._resubscribe():
+                        break
+                    continue
 
-                    # 檢查是否可以啟動遊戲（只在由「非 agreed」→「agreed」那一刻觸發）
-                    if self.should_auto_start(prev_state, self.last_start_state):
-                        print("\n🎮 【所有玩家就緒！自動啟動遊戲...】")
-                        await asyncio.sleep(1)
-                        await self.start_game()
+                # 先記錄舊的 start.state
+                prev_state = self.last_start_state
+                result = self._apply_event(msg)
+                if result == "gap":
+                    if not await self._resubscribe():
+                        break
+                    continue
+                if result == "applied":
+                    await self._on_room_changed(prev_state)
 
         except Exception as e:
             if self.running:
                 print(f"\n[更新錯誤] {e}")
+
+    async def _on_room_changed(self, prev_state):
+        """room_info 更新之後：重畫畫面、同步本地 ready 狀態、必要時自動啟動遊戲"""
+        self.display()
+
+        # 如果房間回到 waiting，而且沒有 start 提案，就把本地 ready 狀態也視為「未就緒」
+        status = (self.room_info or {}).get("status")
+        start_state = (self.room_info or {}).get("start", {}).get("state")
+        if status == "waiting" and start_state in (None, "idle"):
+            self.game_started = False
+            # 讓本地標記跟 server 同步，以顯示成「像剛進來」的狀態
+            self.player_ready = (
+                self.player in (self.room_info or {}).get("ready_players", [])
+            )
+        if not self.running:
+            return
+
+        # 檢查是否可以啟動遊戲（只在由「非 agreed」→「agreed」那一刻觸發）
+        if self.should_auto_start(prev_state, self.last_start_state):
+            print("\n🎮 【所有玩家就緒！自動啟動遊戲...】")
+            await asyncio.sleep(1)
+            await self.start_game()
     
     def should_auto_start(self, prev_state, curr_state) -> bool:
         """檢查是否應該自動啟動遊戲（只在 state 從非 agreed → agreed 時啟動一次）"""
@@ -418,7 +866,15 @@ class AsyncRoomUI:
             is_owner = (owner == self.player)
             status = self.room_info.get("status", "waiting")
 
-            if status in ("waiting", "ready"):
+            if status == "starting":
+                print("\n⏳ 遊戲伺服器啟動中，請稍候…")
+
+            elif status in ("failed", "crashed"):
+                print(f"\n✗ {self.room_info.get('error') or '遊戲伺服器啟動失敗'}，按下Enter返回大廳...")
+                self.running = False
+                return
+
+            elif status in ("waiting", "ready"):
                 if start.get("state") == "idle":
                     if is_owner:
                         print("\n👉 你是房主：按 [s] 提議開始對局")
@@ -527,13 +983,7 @@ class AsyncRoomUI:
                     })
                     print("\n[系統] 已要求離開房間，返回大廳...")
                     self.running = False
-
-                    if self.writer and not self.writer.is_closing():
-                        self.writer.close()
-                        try:
-                            await self.writer.wait_closed()
-                        except Exception:
-                            pass
+                    await self._stop_stream()
                     break
 
                 elif cmd == "s":
@@ -572,12 +1022,7 @@ class AsyncRoomUI:
             print("\n正在離開房間...")
         finally:
             self.running = False
-            if self.writer:
-                self.writer.close()
-                try:
-                    await self.writer.wait_closed()
-                except Exception:
-                    pass
+            await self._stop_stream()
             
             await send_req({"kind": "leave_room", "token": self.token, "room_id": self.room_id})
 
@@ -717,20 +1162,30 @@ async def async_main():
                             idx = ask_choice("請輸入要下載的遊戲編號：", valid)
                             name, info = items[int(idx)-1]
 
+                            # 已經裝過舊版 → 先試差異更新，只下載有變動的檔案
+                            old_ver = installed_version(player, name)
+                            if old_ver:
+                                print(f"\n本機已有 {name}@{old_ver}，向伺服器請求差異更新...")
+                                resp, dest = await download_delta(player, name, old_ver)
+                                if resp.get("ok"):
+                                    if old_ver == resp["version"] and not resp["files"] and not resp["deleted"]:
+                                        print(f"✓ {name}@{old_ver} 已是最新版本。")
+                                    else:
+                                        print(f"✓ 已更新 {name}：{old_ver} → {resp['version']}"
+                                              f"（下載 {len(resp['files'])} 個檔案，刪除 {len(resp['deleted'])} 個）")
+                                        print(f"  位置：{dest}")
+                                    input("\n(按 Enter 繼續) ")
+                                    continue
+                                print(f"⚠️  {resp.get('error')}，改為完整下載。")
+
                             print(f"\n正在向伺服器請求 {name} 最新版本安裝包...")
-                            resp = await send_req({
-                                "kind": "download_game",
-                                "token": token,
-                                "name": name
-                            })
+                            resp, zip_path = await download_package(player, name)
                             if not resp.get("ok"):
                                 print("✗ 無法下載：", resp.get("error"))
                                 input("\n(按 Enter 繼續) ")
                                 continue
 
                             version = resp["version"]
-                            zip_b64 = resp["zip_b64"]
-                            data = base64.b64decode(zip_b64.encode("utf-8"))
 
                             # 目標目錄：player/downloads/<player>/<game>/<version>/
                             base_dir = DOWNLOADS_ROOT / player / name
@@ -744,7 +1199,8 @@ async def async_main():
                             dest = base_dir / version
                             dest.mkdir(parents=True, exist_ok=True)
 
-                            safe_extract_zip(data, dest)
+                            safe_extract_zip(zip_path, dest)
+                            zip_path.unlink(missing_ok=True)
 
                             print(f"✓ 已下載 {name}@{version} 到 {dest}")
                             print("  之前的舊版本已自動清除。")
@@ -800,7 +1256,7 @@ async def async_main():
                             })
                             if resp.get("ok"):
                                 room_id = resp.get("room_id")
-                                print(f"✓ 房間建立成功：{room_id}")
+                                print(f"✓ 房間建立成功：{room_id}（遊戲伺服器啟動中）")
                                 await asyncio.sleep(1)
                                 await room_interface(token, player, room_id, resp)
                             else:
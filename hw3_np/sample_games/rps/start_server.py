@@ -1,5 +1,6 @@
 # sample_games/rps/start_server.py
 import os, socket, threading, json
+from lobby_game import listen_socket, notify_ready
 
 HOST = os.getenv("GAME_HOST", "127.0.0.1")
 PORT = int(os.getenv("GAME_PORT", "0"))
@@ -77,9 +78,8 @@ def handle(conn, addr):
             if name in players: del players[name]
 
 def serve():
-    s = socket.socket()
-    s.bind((HOST, PORT))
-    s.listen(5)
+    s = listen_socket(HOST, PORT, backlog=5)
+    notify_ready()
     while True:
         c,a = s.accept()
         threading.Thread(target=handle, args=(c,a), daemon=True).start()
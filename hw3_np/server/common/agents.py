@@ -0,0 +1,295 @@
+# server/common/agents.py
+"""
+跨機器開房：lobby 連到各台機器上的 game host agent（server/host_agent.py），請它們開遊戲伺服器。
+
+  - config.json 的 "game_agents" 列出 agent 位址（"host:port"）；沒設定就跟以前一樣全部在本機開房
+  - 每個 agent 一條 TCP 長連線，一行一個 JSON；連上後 lobby 先送 {"op": "hello", "secret"}（config.json 的 "agent_secret"），
+    密碼不對 agent 直接斷線：
+      lobby → agent  {"op": "open", "id", "room_id", "sha256", "entry", "env", "supports"}
+                     {"op": "install", "sha256", "size"} + size bytes 的遊戲 zip（agent 還沒有這個版本時先送）
+                     {"op": "close", "room_id"} / {"op": "logs", "id", "room_id"}
+      agent → lobby  {"id", "ok", ...}（open / logs 的回覆）
+                     {"status": {...}}（容量回報：CPU 數、load average、房間數、可用 port、已有的版本）
+                     {"ready": room_id} / {"closed": room_id, "code", "tail"}
+  - place() 挑負載最低（(房間數 + load average) / CPU 數）且還有容量的 agent；
+    連不上的 agent 每 retry 秒才再試一次，期間不會拖慢開房
+  - 連線斷掉時，上面的房間都當成異常結束（退出碼 -1）；agent 那邊也會把這些房間收掉
+
+RemoteRoom 提供 lobby 會用到的 subprocess.Popen 介面（pid / poll / kill / wait），
+agent 回報的就緒轉成本機 ready pipe 上的 READY，所以啟動監看、逾時、當機處理都跟本機的遊戲伺服器共用。
+"""
+import itertools, json, os, socket, subprocess, threading, time
+
+CONNECT_TIMEOUT = 1.0
+REQUEST_TIMEOUT = 10.0
+
+class RemoteRoom:
+    def __init__(self, link, room_id, ready_w, on_exit=None):
+        self.link = link
+        self.room_id = room_id
+        self.pid = None
+        self.port = None
+        self.host = None
+        self.ready_fd = None        # lobby 的 room-starter 監看的那一端
+        self.returncode = None
+        self.on_exit = on_exit
+        self._ready_w = ready_w
+        self._ready_lock = threading.Lock()
+        self._done = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise subprocess.TimeoutExpired(f"room {self.room_id}@{self.link.addr}", timeout)
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            try:
+                self.link._send({"op": "close", "room_id": self.room_id})
+            except OSError:
+                pass
+
+    terminate = kill
+
+    def _ready(self):
+        with self._ready_lock:
+            if self._ready_w is not None:
+                try:
+                    os.write(self._ready_w, b"READY\n")
+                except OSError:
+                    pass
+        self._close_ready()
+
+    def _close_ready(self):
+        with self._ready_lock:
+            if self._ready_w is not None:
+                os.close(self._ready_w)
+                self._ready_w = None
+
+    def _exited(self, code, tail=""):
+        if self.returncode is not None:
+            return
+        self.returncode = code
+        self._close_ready()         # 還沒就緒就結束：room-starter 讀到 EOF
+        self._done.set()
+        if self.on_exit is not None:
+            try:
+                self.on_exit(code, tail)
+            except Exception as e:
+                print(f"[Agents] on_exit error for {self.room_id}: {e}", flush=True)
+
+class AgentLink:
+    """lobby 到一個 agent 的連線"""
+
+    def __init__(self, addr, secret, retry=5.0, tag="Agents"):
+        self.addr = addr
+        self.secret = secret
+        host, _, port = addr.rpartition(":")
+        self._target = (host, int(port))
+        self.retry = retry
+        self.tag = tag
+        self.status = {}
+        self.rooms = {}                    # room_id -> RemoteRoom
+        self.packages = set()              # agent 已經有的遊戲 zip（sha256）
+        self.lobby_ip = None               # 從 agent 那台機器連回 lobby 用的位址
+        self._sock = None
+        self._lock = threading.Lock()
+        self._wlock = threading.Lock()
+        self._replies = {}                 # request id -> [Event, 回覆]
+        self._ids = itertools.count(1)
+        self._next_try = 0.0
+
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def connect(self) -> bool:
+        with self._lock:
+            if self._sock is not None:
+                return True
+            now = time.monotonic()
+            if now < self._next_try:
+                return False
+            self._next_try = now + self.retry
+        s = None
+        try:
+            s = socket.create_connection(self._target, timeout=CONNECT_TIMEOUT)
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            s.sendall(json.dumps({"op": "hello", "secret": self.secret}).encode("utf-8") + b"\n")
+            f = s.makefile("rb")
+            first = json.loads(f.readline() or b"{}")   # agent 連上就先回報一次容量
+            if "status" not in first:
+                raise OSError("agent 沒有回報狀態（agent_secret 不一致？）")
+        except (OSError, ValueError) as e:
+            print(f"[{self.tag}] 連不上 agent {self.addr}：{e}", flush=True)
+            if s is not None:
+                s.close()
+            return False
+        s.settimeout(None)
+        self._on_status(first["status"])
+        self.lobby_ip = s.getsockname()[0]
+        with self._lock:
+            self._sock = s
+        threading.Thread(target=self._reader, args=(s, f), name=f"agent-{self.addr}", daemon=True).start()
+        print(f"[{self.tag}] 已連上 agent {self.addr}（{self.status.get('host')}，"
+              f"{self.status.get('cpus')} CPU）", flush=True)
+        return True
+
+    def load(self) -> float:
+        cpus = max(1, self.status.get("cpus") or 1)
+        return (len(self.rooms) + (self.status.get("load") or 0.0)) / cpus
+
+    def has_capacity(self) -> bool:
+        st = self.status
+        return len(self.rooms) < st.get("max_rooms", 1) and st.get("free_ports", 1) > 0
+
+    def open_room(self, room_id, sha256, size, blob_path, entry, env, supports, on_exit=None) -> RemoteRoom:
+        """請 agent 開房；agent 還沒有這個版本就先把 zip 送過去"""
+        if sha256 not in self.packages:
+            self._install(sha256, size, blob_path)
+        ready_r, ready_w = os.pipe()
+        room = RemoteRoom(self, room_id, ready_w, on_exit)
+        room.ready_fd = ready_r
+        with self._lock:
+            self.rooms[room_id] = room
+        try:
+            reply = self.request({"op": "open", "room_id": room_id, "sha256": sha256,
+                                  "entry": entry, "env": env, "supports": supports})
+            if not reply.get("ok"):
+                raise OSError(reply.get("error") or "agent 開房失敗")
+        except Exception:
+            with self._lock:
+                self.rooms.pop(room_id, None)
+            room._close_ready()
+            os.close(ready_r)
+            raise
+        room.pid = reply.get("pid")
+        room.port = reply["port"]
+        room.host = reply.get("host") or self.status.get("host") or self._target[0]
+        return room
+
+    def logs(self, room_id) -> str:
+        try:
+            return self.request({"op": "logs", "room_id": room_id}).get("log", "")
+        except OSError:
+            return ""
+
+    def request(self, obj, timeout=REQUEST_TIMEOUT) -> dict:
+        rid = next(self._ids)
+        slot = [threading.Event(), None]
+        self._replies[rid] = slot
+        try:
+            self._send({**obj, "id": rid})
+            if not slot[0].wait(timeout):
+                raise OSError(f"agent {self.addr} 沒有回應")
+        finally:
+            self._replies.pop(rid, None)
+        if slot[1] is None:
+            raise OSError(f"與 agent {self.addr} 的連線中斷")
+        return slot[1]
+
+    def stats(self) -> dict:
+        st = self.status
+        return {"connected": self.connected(), "host": st.get("host"), "rooms": len(self.rooms),
+                "cpus": st.get("cpus"), "load": st.get("load"), "free_ports": st.get("free_ports")}
+
+    def close(self):
+        s = self._sock
+        if s is not None:
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _install(self, sha256, size, path):
+        header = json.dumps({"op": "install", "sha256": sha256, "size": size}).encode("utf-8") + b"\n"
+        s = self._sock
+        if s is None:
+            raise OSError(f"與 agent {self.addr} 的連線中斷")
+        with open(path, "rb") as f, self._wlock:
+            try:
+                s.sendall(header)
+                s.sendfile(f, 0, size)
+            except OSError:
+                self.close()
+                raise
+        self.packages.add(sha256)
+        print(f"[{self.tag}] 已傳送遊戲檔案到 agent {self.addr}（{size} bytes）", flush=True)
+
+    def _send(self, obj):
+        s = self._sock
+        if s is None:
+            raise OSError(f"與 agent {self.addr} 的連線中斷")
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+        with self._wlock:
+            try:
+                s.sendall(data)
+            except OSError:
+                self.close()
+                raise
+
+    def _on_status(self, st):
+        self.status = st
+        self.packages |= set(st.get("packages") or [])
+
+    def _reader(self, s, f):
+        try:
+            for line in f:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                if "id" in msg:
+                    slot = self._replies.get(msg["id"])
+                    if slot is not None:
+                        slot[1] = msg
+                        slot[0].set()
+                elif "status" in msg:
+                    self._on_status(msg["status"])
+                elif "ready" in msg:
+                    room = self.rooms.get(msg["ready"])
+                    if room is not None:
+                        room._ready()
+                elif "closed" in msg:
+                    self._room_done(msg["closed"], msg.get("code", 0), msg.get("tail", ""))
+        except OSError:
+            pass
+
+        # 連線斷了：等回覆的 request 與還在上面的房間都結束掉，之後 connect() 再重連
+        with self._lock:
+            self._sock = None
+            self._next_try = time.monotonic() + self.retry
+            rooms = list(self.rooms)
+        s.close()
+        for slot in list(self._replies.values()):
+            slot[0].set()
+        print(f"[{self.tag}] 與 agent {self.addr} 的連線中斷（房間 {len(rooms)} 間）", flush=True)
+        for room_id in rooms:
+            self._room_done(room_id, -1, "與 game host agent 的連線中斷")
+
+    def _room_done(self, room_id, code, tail):
+        with self._lock:
+            room = self.rooms.pop(room_id, None)
+        if room is not None:
+            room._exited(code, tail)
+
+class AgentPool:
+    def __init__(self, addrs, secret, retry=5.0):
+        self.links = [AgentLink(a, secret, retry) for a in addrs]
+
+    def place(self):
+        """負載最低、還有容量的 agent；都連不上 / 都滿了回傳 None"""
+        candidates = [l for l in self.links if l.connect() and l.has_capacity()]
+        return min(candidates, key=AgentLink.load, default=None)
+
+    def get(self, addr):
+        return next((l for l in self.links if l.addr == addr), None)
+
+    def close(self):
+        for l in self.links:
+            l.close()
+
+    def stats(self) -> dict:
+        return {l.addr: l.stats() for l in self.links}
@@ -0,0 +1,192 @@
+# server/common/aioserver.py
+"""
+event loop 版的「一條連線一行 JSON request」伺服器核心，給 lobby_server / dev_server 共用。
+
+  - 所有連線都在同一個 asyncio loop 上，閒置的連線（例如房間訂閱）不佔執行緒
+  - 原本同步的 handle_* 照舊使用：丟到固定大小的 ThreadPoolExecutor 執行，
+    DB / 檔案 I/O 卡住也不會擋住 loop，執行緒數量也不會隨連線數成長
+  - handler 拿到的 AsyncConn 提供跟 socket 相同的 sendall / recv / sendfile / settimeout，
+    在 executor 執行緒裡呼叫時會轉交給 loop 執行並等它完成
+  - StreamReader 的 limit 維持小的（預設 1 MiB），緩衝超過 2 × limit 就暫停讀 socket，串流上傳才有 backpressure；
+    request 行一段一段讀，最長 max_line bytes，超過就回錯誤並斷線
+"""
+import asyncio, json, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+class LineTooLong(ValueError):
+    pass
+
+class AsyncConn:
+    """一條 asyncio 連線，包裝成 handler 熟悉的 socket 介面"""
+
+    def __init__(self, loop, reader, writer, executor, max_line=1 << 20):
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.executor = executor
+        self.addr = writer.get_extra_info("peername")
+        self.max_line = max_line
+        self.closed = False
+
+    # ---- 在 loop 上使用 ---- #
+
+    async def readline(self) -> bytes:
+        """讀一行（含換行；EOF 時可能沒有），可以比 StreamReader 的 limit 長，但最多 max_line bytes"""
+        buf = bytearray()
+        while True:
+            try:
+                buf += await self.reader.readuntil(b"\n")
+                return bytes(buf)
+            except asyncio.IncompleteReadError as e:
+                buf += e.partial
+                return bytes(buf)
+            except asyncio.LimitOverrunError as e:
+                # 緩衝裡已經有 e.consumed bytes 還沒看到換行：先拿走，讓 reader 繼續收
+                buf += await self.reader.readexactly(e.consumed)
+            if len(buf) > self.max_line:
+                raise LineTooLong(f"request 超過 {self.max_line} bytes")
+
+    def run(self, fn, *args):
+        """把同步的 handler 丟進 executor"""
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    async def send_json(self, obj):
+        self.writer.write((json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8"))
+        await self.writer.drain()
+
+    async def wait_eof(self):
+        """訂閱連線：等到對方關閉連線為止（期間不佔任何執行緒）"""
+        try:
+            while await self.reader.read(4096):
+                pass
+        except (ConnectionError, OSError):
+            pass
+        self.closed = True
+
+    # ---- 在任何執行緒使用（socket 相容介面） ---- #
+
+    def _call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _write(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendall(self, data):
+        self._call(self._write(data))
+
+    def recv(self, n):
+        return self._call(self.reader.read(n))
+
+    def sendfile(self, f, offset=0, count=None):
+        # loop.sendfile：支援的平台上走 os.sendfile（zero-copy），否則自動退回一般讀寫
+        return self._call(self.loop.sendfile(self.writer.transport, f, offset, count))
+
+    def settimeout(self, t):
+        pass
+
+async def run_session(conn, handle, max_inflight=64):
+    """
+    session 模式：同一條連線上持續讀 request（每行一個 JSON，帶 "id"）。
+    每個 request 各自執行，做完就回 {"id": ..., ...回應}，不保證順序；
+    伺服器主動推播的事件（沒有 id）也走同一條連線。
+    handle(req) 是 coroutine、回傳回應 dict。同時處理中的 request 超過 max_inflight 就先不讀下一行。
+    """
+    inflight = asyncio.Semaphore(max_inflight)
+    tasks = set()
+
+    async def one(req):
+        try:
+            resp = await handle(req)
+        except Exception as e:
+            traceback.print_exc()
+            resp = {"ok": False, "error": str(e)}
+        finally:
+            inflight.release()
+        out = dict(resp)
+        out["id"] = req.get("id")
+        try:
+            await conn.send_json(out)
+        except (ConnectionError, OSError):
+            pass
+
+    try:
+        while True:
+            line = await conn.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            try:
+                req = json.loads(line)
+            except json.JSONDecodeError:
+                await conn.send_json({"ok": False, "error": "Invalid JSON"})
+                continue
+            if not isinstance(req, dict):
+                await conn.send_json({"ok": False, "error": "Invalid request"})
+                continue
+            await inflight.acquire()
+            t = asyncio.create_task(one(req))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+    except LineTooLong as e:
+        try:
+            await conn.send_json({"ok": False, "error": str(e)})
+        except (ConnectionError, OSError):
+            pass
+    except (ConnectionError, OSError):
+        pass
+    finally:
+        conn.closed = True
+        for t in list(tasks):
+            t.cancel()
+
+async def serve_json_lines(host, port, on_request, *, tag, workers=32,
+                           stop_event=None, limit=1 << 20, max_line=1 << 20, sock=None):
+    """
+    on_request(conn, line) 是 coroutine，處理第一行 request（已去掉換行）並自行回應；
+    它結束之後連線就會被關閉。stop_event（threading.Event）被 set 時停止服務。
+    limit：StreamReader 的緩衝上限；max_line：一行 request 最長幾 bytes（可以大於 limit，分段讀）。
+    sock：呼叫端已經 bind + listen 好的 socket（有給就不再自己 bind host / port）。
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{tag}-worker")
+
+    async def client(reader, writer):
+        conn = AsyncConn(loop, reader, writer, executor, max_line)
+        try:
+            line = await conn.readline()
+            if line.strip():
+                await on_request(conn, line)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except LineTooLong as e:
+            print(f"[{tag}] ✗ {conn.addr}: {e}", flush=True)
+            try:
+                await conn.send_json({"ok": False, "error": str(e)})
+            except Exception:
+                pass
+        except Exception as e:
+            print(f"[{tag}] ✗ Error handling connection from {conn.addr}: {e}", flush=True)
+            traceback.print_exc()
+            try:
+                await conn.send_json({"ok": False, "error": str(e)})
+            except Exception:
+                pass
+        finally:
+            conn.closed = True
+            writer.close()
+
+    if sock is not None:
+        server = await asyncio.start_server(client, sock=sock, limit=limit, backlog=1024)
+    else:
+        server = await asyncio.start_server(client, host, port, limit=limit, backlog=1024)
+    print(f"[{tag}] listening on {host}:{server.sockets[0].getsockname()[1]} (asyncio, {workers} workers)", flush=True)
+    try:
+        async with server:
+            while stop_event is None or not stop_event.is_set():
+                await asyncio.sleep(0.5)
+            print(f"[{tag}] stop_event set, exiting serve loop.", flush=True)
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        print(f"[{tag}] Shutdown complete on {host}:{port}", flush=True)
@@ -3,6 +3,8 @@ import uuid
 import time
 import threading
 
+from common import db
+
 _LOCK = threading.RLock()
 
 # token -> { "user": "abc", "role": "player", "ts": 12345 }
@@ -14,6 +16,28 @@ USER_ACTIVE = {}
 # token 存活時間（None = 不檢查）
 TOKEN_TTL = None
 
+# 多行程 lobby：登入狀態改存在 db（SQLite），每個 worker 行程看到同一份
+# （SESSIONS_FILE：token -> info；ACTIVE_FILE："role:user" -> {"token"}，用 db.update 搶，兩個 worker 不會同時讓同一人登入）
+SESSIONS_FILE = "sessions.json"
+ACTIVE_FILE = "active_users.json"
+_shared = False
+
+
+def configure(shared: bool = False, reset: bool = False):
+    """
+    shared=True：session 存在 db（db 必須是跨行程的 backend，也就是 sqlite）。
+    reset=True：清掉 db 裡上次留下的登入（只在 main 啟動 worker 之前做一次）。
+    """
+    global _shared
+    _shared = shared
+    if shared and reset:
+        db.save(SESSIONS_FILE, {})
+        db.save(ACTIVE_FILE, {})
+
+
+def _expired(info) -> bool:
+    return TOKEN_TTL is not None and time.time() - info["ts"] > TOKEN_TTL
+
 
 def _cleanup_expired():
     if TOKEN_TTL is None:
@@ -41,6 +65,9 @@ def issue_token(user: str, role: str) -> str | None:
       - 如果這個 user 在這個 role 已登入 → 回傳 None（拒絕新的登入）
       - 沒登入 → 建立新登入
     """
+    if _shared:
+        return _issue_shared(user, role)
+
     _cleanup_expired()
 
     key = (role, user)
@@ -65,6 +92,12 @@ def verify_token(token: str | None, role: str | None = None):
     if not token:
         return None
 
+    if _shared:
+        info = db.get(SESSIONS_FILE, token)
+        if not info or _expired(info) or (role and info["role"] != role):
+            return None
+        return info
+
     _cleanup_expired()
 
     with _LOCK:
@@ -82,6 +115,10 @@ def revoke_token(token: str | None):
     if not token:
         return
 
+    if _shared:
+        _revoke_shared(token)
+        return
+
     with _LOCK:
         info = SESSIONS.pop(token, None)
         if not info:
@@ -90,3 +127,39 @@ def revoke_token(token: str | None):
         key = (info["role"], info["user"])
         if USER_ACTIVE.get(key) == token:
             USER_ACTIVE.pop(key, None)
+
+
+# ----------------- 多行程（session 存在 db） ----------------- #
+
+def _issue_shared(user: str, role: str) -> str | None:
+    token = uuid.uuid4().hex
+    key = f"{role}:{user}"
+
+    def _claim(rec):
+        cur = rec.get("token")
+        if cur:
+            info = db.get(SESSIONS_FILE, cur)
+            if info and not _expired(info):
+                return False
+        rec["token"] = token
+        return True
+
+    # session 先寫好再搶登入名額：搶到的那一刻 token 就能用，別的 worker 也不會把它當成過期的登入
+    db.put(SESSIONS_FILE, token, {"user": user, "role": role, "ts": time.time()})
+    if not db.update(ACTIVE_FILE, key, _claim, default={}):
+        db.delete(SESSIONS_FILE, token)
+        return None
+    return token
+
+
+def _revoke_shared(token: str):
+    info = db.get(SESSIONS_FILE, token)
+    if not info:
+        return
+    db.delete(SESSIONS_FILE, token)
+
+    def _release(rec):
+        if rec is not None and rec.get("token") == token:
+            raise db.Remove(None)
+
+    db.update(ACTIVE_FILE, f"{info['role']}:{info['user']}", _release)
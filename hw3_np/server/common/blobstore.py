@@ -0,0 +1,143 @@
+# server/common/blobstore.py
+"""
+遊戲上傳包（zip）的 content-addressed 儲存：
+  server/data/blobs/<sha256 前兩碼>/<sha256>
+
+games.json 的版本紀錄只存 {"sha256", "size", "path"}，不再內嵌整包 base64；
+同樣內容的 zip 只會存一份，檔名就是內容的 hash，寫入後不會再被修改。
+"""
+import hashlib, json, os, tempfile, threading, zipfile
+from pathlib import Path
+
+from common import db
+
+def blob_dir() -> Path:
+    # 跟著 db.DATA_DIR 走（DATA_DIR 可能在啟動時被換掉）
+    return db.DATA_DIR / "blobs"
+
+_CHUNK = 1 << 20
+
+def path_of(sha256: str) -> Path:
+    return blob_dir() / sha256[:2] / sha256
+
+def exists(sha256: str) -> bool:
+    return bool(sha256) and path_of(sha256).exists()
+
+def _info(sha256: str, size: int) -> dict:
+    return {
+        "sha256": sha256,
+        "size": size,
+        "path": str(path_of(sha256).relative_to(blob_dir())),
+    }
+
+def _commit(tmp: Path, sha256: str, size: int) -> dict:
+    """把已寫好（並 fsync）的暫存檔放到 hash 對應的位置；已存在就丟掉暫存檔"""
+    dst = path_of(sha256)
+    if dst.exists():
+        tmp.unlink(missing_ok=True)
+    else:
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp, dst)
+    return _info(sha256, size)
+
+def _tempfile():
+    d = blob_dir()
+    d.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(dir=d, prefix=".incoming-")
+    return os.fdopen(fd, "wb"), Path(name)
+
+class BlobWriter:
+    """
+    邊收邊寫的 blob：write() 直接寫進暫存檔並累加 sha256，記憶體用量與檔案大小無關。
+    commit() 之後檔案才會出現在 hash 對應的位置；中途出錯就 abort()（with 區塊內的例外會自動 abort）。
+    """
+
+    def __init__(self):
+        self._f, self._tmp = _tempfile()
+        self._h = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        self._h.update(chunk)
+        self._f.write(chunk)
+        self.size += len(chunk)
+
+    @property
+    def sha256(self) -> str:
+        return self._h.hexdigest()
+
+    def commit(self) -> dict:
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._f.close()
+        return _commit(self._tmp, self.sha256, self.size)
+
+    def abort(self):
+        try:
+            self._f.close()
+        finally:
+            self._tmp.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        return False
+
+def put_bytes(data: bytes) -> dict:
+    """存一份 blob，回傳 {"sha256", "size", "path"}"""
+    sha256 = hashlib.sha256(data).hexdigest()
+    if exists(sha256):
+        return _info(sha256, len(data))
+    with BlobWriter() as w:
+        w.write(data)
+        return w.commit()
+
+def put_file(src) -> dict:
+    """從既有檔案建立 blob，分段讀取"""
+    with BlobWriter() as w, open(src, "rb") as inp:
+        while True:
+            chunk = inp.read(_CHUNK)
+            if not chunk:
+                break
+            w.write(chunk)
+        return w.commit()
+
+def read_bytes(sha256: str) -> bytes:
+    return path_of(sha256).read_bytes()
+
+# ----------------- zip 內容清單（給差異更新用） ----------------- #
+
+_manifest_cache = {}
+_manifest_lock = threading.Lock()
+
+def file_manifest(sha256: str) -> dict:
+    """
+    blob（zip）內每個檔案的 {path: {"size", "sha256"}}。
+    blob 內容不會變，算一次就存成旁邊的 <sha256>.files.json，並留在記憶體。
+    """
+    m = _manifest_cache.get(sha256)
+    if m is not None:
+        return m
+    side = path_of(sha256).with_name(sha256 + ".files.json")
+    try:
+        m = json.loads(side.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        m = {}
+        with zipfile.ZipFile(path_of(sha256), "r") as z:
+            for info in z.infolist():
+                if info.is_dir():
+                    continue
+                h = hashlib.sha256()
+                with z.open(info) as f:
+                    for chunk in iter(lambda: f.read(_CHUNK), b""):
+                        h.update(chunk)
+                m[info.filename] = {"size": info.file_size, "sha256": h.hexdigest()}
+        tmp = side.with_name(side.name + ".tmp")
+        tmp.write_text(json.dumps(m), encoding="utf-8")
+        os.replace(tmp, side)
+    with _manifest_lock:
+        _manifest_cache[sha256] = m
+    return m
@@ -0,0 +1,142 @@
+# server/common/catalog.py
+"""
+uploaded_games/ 的記憶體索引：{game: {"versions", "latest", "version_map"}}
+
+  - 查詢（list_games / create_room）直接讀 dict，不再每次走訪整個資料夾
+  - dev_server 上傳完直接呼叫 invalidate(root, game)，只重掃那一款遊戲
+  - 備援：最多每 CHECK_INTERVAL 秒比對一次 root 與各遊戲資料夾的 mtime，
+    有人手動改了檔案（或另一個 process 上傳）也會在幾秒內反映出來
+"""
+import re, threading, time
+from pathlib import Path
+
+CHECK_INTERVAL = 2.0
+
+_lock = threading.Lock()
+_catalogs = {}   # root -> {"games": {...}, "stamp": {...}, "checked_at": float}
+
+# ----------------- 版本號正規化 ----------------- #
+
+def _semver_key(v: str):
+    """改進版：正規化版本號以統一比較"""
+    # 移除所有非數字和點的字元
+    v_clean = re.sub(r'[^0-9.]', '', v)
+    parts = v_clean.split('.')
+
+    # 補齊到至少3位，並轉換為整數
+    result = []
+    for i in range(3):
+        if i < len(parts) and parts[i]:
+            result.append(int(parts[i]))
+        else:
+            result.append(0)
+
+    return tuple(result)
+
+def normalize_version(v: str) -> str:
+    """正規化版本號：1.01 → 1.0.1, 1.1 → 1.1.0"""
+    key = _semver_key(v)
+    return f"{key[0]}.{key[1]}.{key[2]}"
+
+# ----------------- 掃描 ----------------- #
+
+def _scan_game(gdir: Path):
+    """
+    掃描一款遊戲的版本資料夾，回傳 {"versions", "latest", "version_map"}；沒有可用版本回傳 None。
+    同時正規化版本號以避免 1.0.1 和 1.01 被視為不同版本
+    """
+    versions_raw = []
+    version_map = {}  # {normalized: original_folder_name}
+
+    for vdir in gdir.iterdir():
+        if vdir.is_dir() and (vdir / "manifest.json").exists():
+            raw_version = vdir.name
+            normalized = normalize_version(raw_version)
+
+            # 如果正規化版本已存在，保留較新的資料夾
+            if normalized in version_map:
+                print(f"[Warning] 發現重複版本號：{raw_version} 和 {version_map[normalized]} 都對應到 {normalized}")
+                old_path = gdir / version_map[normalized]
+                if vdir.stat().st_mtime > old_path.stat().st_mtime:
+                    version_map[normalized] = raw_version
+            else:
+                version_map[normalized] = raw_version
+                versions_raw.append(normalized)
+
+    if not versions_raw:
+        return None
+    versions_raw.sort(key=_semver_key, reverse=True)
+    return {
+        "versions": versions_raw,
+        "latest": versions_raw[0],
+        "version_map": version_map  # 保存映射關係
+    }
+
+def _stamp_of(root: Path) -> dict:
+    """root 與每個遊戲資料夾的 mtime；新增 / 刪除版本資料夾都會改到遊戲資料夾的 mtime"""
+    if not root.exists():
+        return {}
+    stamp = {"": root.stat().st_mtime_ns}
+    for gdir in root.iterdir():
+        if gdir.is_dir():
+            stamp[gdir.name] = gdir.stat().st_mtime_ns
+    return stamp
+
+def _rescan(root: Path, cat: dict, names):
+    games = dict(cat["games"])
+    for name in names:
+        gdir = root / name
+        info = _scan_game(gdir) if gdir.is_dir() else None
+        if info:
+            games[name] = info
+        else:
+            games.pop(name, None)
+    cat["games"] = games
+
+# ----------------- 對外 API ----------------- #
+
+def games(root: Path) -> dict:
+    """目前的索引（呼叫端請當成唯讀）"""
+    root = Path(root)
+    cat = _catalogs.get(root)
+    now = time.monotonic()
+    if cat is not None and now - cat["checked_at"] < CHECK_INTERVAL:
+        return cat["games"]
+
+    with _lock:
+        cat = _catalogs.get(root)
+        if cat is None:
+            cat = {"games": {}, "stamp": {}, "checked_at": 0.0}
+            _catalogs[root] = cat
+        if now - cat["checked_at"] >= CHECK_INTERVAL:
+            stamp = _stamp_of(root)
+            old = cat["stamp"]
+            if stamp.get("") != old.get(""):
+                # 有遊戲資料夾新增 / 刪除：所有名字都重新比對
+                changed = set(stamp) | set(old)
+            else:
+                changed = {n for n in stamp if stamp[n] != old.get(n)}
+            changed.discard("")
+            if changed:
+                _rescan(root, cat, changed)
+            cat["stamp"] = stamp
+            cat["checked_at"] = time.monotonic()
+        return cat["games"]
+
+def invalidate(root: Path, game: str = None):
+    """
+    上傳 / 刪除之後呼叫：指定 game 時立刻重掃那一款遊戲，
+    否則整份索引在下次查詢時重建。
+    """
+    root = Path(root)
+    with _lock:
+        cat = _catalogs.get(root)
+        if cat is None:
+            return
+        if game is None:
+            _catalogs.pop(root, None)
+            return
+        _rescan(root, cat, [game])
+        gdir = root / game
+        if gdir.is_dir():
+            cat["stamp"][game] = gdir.stat().st_mtime_ns
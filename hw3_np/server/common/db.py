@@ -1,26 +1,1019 @@
 # server/common/db.py
-import json, threading
+import json, threading, os, copy, time, atexit, sqlite3, shutil, sys
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
 from pathlib import Path
 
 DATA_DIR = Path(__file__).resolve().parents[1] / "data"
 DATA_DIR.mkdir(exist_ok=True, parents=True)
-_lock = threading.RLock()
+
+# ----------------- 鎖 ----------------- #
+# 每個 collection（檔名）一把鎖：寫 games.json 不會擋住 rooms.json 的讀寫。
+# 每筆資料（collection, key）再 hash 到固定數量的 stripe 鎖上，給 txn() / put() / delete() 用，
+# 不同房間、不同玩家的交易可以同時進行。
+_registry_lock = threading.Lock()
+_coll_locks = {}
+
+_KEY_STRIPES = 64
+_key_locks = [threading.RLock() for _ in range(_KEY_STRIPES)]
+
+def _coll_lock(name: str):
+    lk = _coll_locks.get(name)
+    if lk is None:
+        with _registry_lock:
+            lk = _coll_locks.setdefault(name, threading.RLock())
+    return lk
+
+def _key_lock(name: str, key):
+    return _key_locks[hash((name, key)) % _KEY_STRIPES]
 
 def _path(name: str) -> Path:
     return DATA_DIR / name
 
-def load(name: str, default=None):
-    p = _path(name)
-    with _lock:
+def _empty(default):
+    return default if default is not None else {}
+
+# ----------------- backend: json（整檔覆寫，舊行為） ----------------- #
+
+class _JsonStore:
+    """每次 load 都讀檔、每次 save 都整檔重寫（原本的做法）"""
+
+    def load(self, name: str, default=None):
+        p = _path(name)
+        with _coll_lock(name):
+            if not p.exists():
+                return _empty(default)
+            try:
+                return json.loads(p.read_text(encoding="utf-8"))
+            except Exception:
+                return _empty(default)
+
+    def save(self, name: str, obj):
+        p = _path(name)
+        with _coll_lock(name):
+            p.write_text(json.dumps(obj, indent=2, ensure_ascii=False), encoding="utf-8")
+            return True
+
+    def get(self, name: str, key, default=None):
+        data = self.load(name, {})
+        return data.get(key, default) if isinstance(data, dict) else default
+
+    def put(self, name: str, key, value):
+        with _coll_lock(name):
+            data = self.load(name, {})
+            data[key] = value
+            return self.save(name, data)
+
+    def delete(self, name: str, key):
+        with _coll_lock(name):
+            data = self.load(name, {})
+            if key not in data:
+                return False
+            data.pop(key)
+            return self.save(name, data)
+
+    # JSON 檔可能被外部改寫，這裡直接用內容本身當版本號
+    def get_versioned(self, name: str, key):
+        value = self.get(name, key)
+        return value, json.dumps(value, sort_keys=True, ensure_ascii=False)
+
+    def cas(self, name: str, key, version, value, remove=False):
+        with _coll_lock(name):
+            data = self.load(name, {})
+            if json.dumps(data.get(key), sort_keys=True, ensure_ascii=False) != version:
+                return False
+            if remove:
+                data.pop(key, None)
+            else:
+                data[key] = value
+            return self.save(name, data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+# ----------------- 記憶體常駐 backend 的共用部分 ----------------- #
+
+class _MemoryStore(ABC):
+    """
+    每個 collection 第一次用到時 parse 一次，之後整份狀態留在記憶體，
+    load() / get() 只做 deepcopy，不碰磁碟。
+    所有修改都化成 {"op": "set"/"del"/"replace", ...} 記錄交給子類別的 _write()（持有 collection 鎖時呼叫）。
+    狀態中的 value 只會被整個替換、不會原地修改，所以在鎖內淺拷貝一層就能拿到一致的 snapshot。
+    """
+
+    def __init__(self):
+        self.colls = {}        # name -> 目前狀態
+        self.present = {}      # name -> 磁碟上是否已有這個 collection（沒有時 load 回傳 default）
+        # 每筆資料的版本號（給 cas() 用）：每次寫入都取一個新的遞增值，
+        # 沒記錄過的 key 用 collection 的 base 版本（整份 replace 時更新）
+        self._clock = 0
+        self.versions = {}     # name -> {key: version}
+        self.base_version = {} # name -> version
+
+    @staticmethod
+    def _read_snapshot(name: str):
+        p = _path(name)
         if not p.exists():
-            return default if default is not None else {}
+            return {}
         try:
             return json.loads(p.read_text(encoding="utf-8"))
         except Exception:
-            return default if default is not None else {}
+            return {}
 
-def save(name: str, obj):
-    p = _path(name)
-    with _lock:
-        p.write_text(json.dumps(obj, indent=2, ensure_ascii=False), encoding="utf-8")
+    @staticmethod
+    def _write_snapshot(name: str, snap):
+        # 先寫暫存檔再 rename，寫到一半 crash 也不會留下壞掉的 JSON
+        p = _path(name)
+        tmp = p.with_name(p.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as out:
+            json.dump(snap, out, indent=2, ensure_ascii=False)
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, p)
+
+    @staticmethod
+    def _snapshot_of(state):
+        return dict(state) if isinstance(state, dict) else state
+
+    @staticmethod
+    def _apply(state, rec):
+        op = rec.get("op")
+        if op == "set":
+            if not isinstance(state, dict):
+                state = {}
+            state[rec["key"]] = rec["value"]
+        elif op == "del":
+            state.pop(rec["key"], None)
+        elif op == "replace":
+            state = rec["value"]
+        return state
+
+    @staticmethod
+    def _diff(cur, obj):
+        """只列出真的有變動的 key"""
+        if not (isinstance(obj, dict) and isinstance(cur, dict)):
+            return [] if obj == cur else [{"op": "replace", "value": obj}]
+        records = []
+        for k, v in obj.items():
+            if k not in cur or cur[k] != v:
+                records.append({"op": "set", "key": k, "value": v})
+        for k in cur:
+            if k not in obj:
+                records.append({"op": "del", "key": k})
+        return records
+
+    def _ensure(self, name: str):
+        if name in self.colls:
+            return
+        self.present[name] = _path(name).exists()
+        self.colls[name] = self._read_snapshot(name)
+
+    @abstractmethod
+    def _write(self, name: str, records):
+        """把 records 套用到 self.colls[name] 並持久化（cache：標記 dirty；wal：append 到 log）"""
+
+    def _commit(self, name: str, records):
+        """寫入並更新版本號（持有 collection 鎖時呼叫）"""
+        self._write(name, records)
+        vers = self.versions.setdefault(name, {})
+        for rec in records:
+            self._clock += 1
+            if rec["op"] == "replace":
+                vers.clear()
+                self.base_version[name] = self._clock
+            else:
+                vers[rec["key"]] = self._clock
+
+    def _version(self, name: str, key):
+        return self.versions.get(name, {}).get(key, self.base_version.get(name, 0))
+
+    def load(self, name: str, default=None):
+        with _coll_lock(name):
+            self._ensure(name)
+            if not self.present[name]:
+                return _empty(default)
+            return copy.deepcopy(self.colls[name])
+
+    def save(self, name: str, obj):
+        with _coll_lock(name):
+            self._ensure(name)
+            records = self._diff(self.colls[name], obj)
+            if records:
+                self._commit(name, records)
+            return True
+
+    def get(self, name: str, key, default=None):
+        with _coll_lock(name):
+            self._ensure(name)
+            state = self.colls[name]
+            if isinstance(state, dict) and key in state:
+                return copy.deepcopy(state[key])
+        return default
+
+    def put(self, name: str, key, value):
+        with _coll_lock(name):
+            self._ensure(name)
+            self._commit(name, [{"op": "set", "key": key, "value": value}])
+            return True
+
+    def delete(self, name: str, key):
+        with _coll_lock(name):
+            self._ensure(name)
+            state = self.colls[name]
+            if not isinstance(state, dict) or key not in state:
+                return False
+            self._commit(name, [{"op": "del", "key": key}])
+            return True
+
+    def get_versioned(self, name: str, key):
+        with _coll_lock(name):
+            self._ensure(name)
+            state = self.colls[name]
+            value = copy.deepcopy(state.get(key)) if isinstance(state, dict) else None
+            return value, self._version(name, key)
+
+    def cas(self, name: str, key, version, value, remove=False):
+        """版本號沒變才寫入；只在比對 + 寫入的瞬間持有 collection 鎖"""
+        with _coll_lock(name):
+            self._ensure(name)
+            if self._version(name, key) != version:
+                return False
+            state = self.colls[name]
+            if remove:
+                if isinstance(state, dict) and key in state:
+                    self._commit(name, [{"op": "del", "key": key}])
+            else:
+                self._commit(name, [{"op": "set", "key": key, "value": value}])
+            return True
+
+# ----------------- backend: cache（記憶體為主 + write-behind） ----------------- #
+
+class _CacheStore(_MemoryStore):
+    """
+    記憶體中的狀態就是唯一的真實資料：
+      - 寫入只更新記憶體並標記 dirty
+      - 背景 writer 每 flush_interval 秒把 dirty 的 collection 整份寫回磁碟
+    crash 時最多遺失最後 flush_interval 秒內的寫入。
+    """
+
+    def __init__(self, flush_interval=1.0):
+        super().__init__()
+        self.flush_interval = float(flush_interval)
+        self.dirty = set()
+        self._dirty_lock = threading.Lock()
+        self._io = threading.Lock()   # 取 dirty + 寫檔整段序列化，避免舊 snapshot 蓋掉新的
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _write(self, name: str, records):
+        state = self.colls[name]
+        for rec in records:
+            if "value" in rec:
+                rec = dict(rec, value=copy.deepcopy(rec["value"]))   # 不和呼叫端共用物件
+            state = self._apply(state, rec)
+        self.colls[name] = state
+        self.present[name] = True
+        with self._dirty_lock:
+            self.dirty.add(name)
+
+    def _take_dirty(self):
+        with self._dirty_lock:
+            names = list(self.dirty)
+            self.dirty.clear()
+        snaps = []
+        for n in names:
+            with _coll_lock(n):
+                snaps.append((n, self._snapshot_of(self.colls[n])))
+        return snaps
+
+    def _writer(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[DB] write-behind failed: {e}", flush=True)
+
+    def flush(self):
+        with self._io:
+            for name, snap in self._take_dirty():
+                try:
+                    self._write_snapshot(name, snap)
+                except Exception:
+                    with self._dirty_lock:
+                        self.dirty.add(name)
+                    raise
+
+    def close(self):
+        """停掉背景 writer，最後寫回一次"""
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+
+# ----------------- backend: wal（append-only log + 背景 compaction） ----------------- #
+
+class _WalStore(_MemoryStore):
+    """
+    每個 collection（例如 rooms.json）：
+      - 記憶體中保留完整狀態，load() 直接從記憶體複製，不碰磁碟
+      - save() 只比對出有變動的 key，把 {"op": "set"/"del", ...} 逐行 append 到 <name>.wal
+      - 背景 flusher 每 fsync_interval 秒批次 fsync 一次
+      - log 累積超過 compact_records 筆 → 背景把狀態寫成 snapshot（<name> 本身）並清空 log
+
+    snapshot 檔案格式和 json backend 完全相同，所以兩種模式可以互相切換。
+    """
+
+    def __init__(self, fsync_interval=0.05, compact_records=2000):
+        super().__init__()
+        self.fsync_interval = float(fsync_interval)
+        self.compact_records = int(compact_records)
+        self.logs = {}         # name -> append 模式的 log 檔
+        self.log_counts = {}   # name -> 上次 snapshot 之後的 log 筆數
+        self.compacting = {}   # name -> 進行中的 compaction 執行緒
+        self.unsynced = set()  # 已 write 但還沒 fsync 的 collection
+        self._sync = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._flusher, daemon=True)
+        self._thread.start()
+
+    # ---- 檔案 ----
+    @staticmethod
+    def _wal_path(name: str) -> Path:
+        return _path(name + ".wal")
+
+    @staticmethod
+    def _old_wal_path(name: str) -> Path:
+        # compaction 進行中被換下來的舊 log（若 crash 在中途，下次載入時要一起重播）
+        return _path(name + ".wal.1")
+
+    @classmethod
+    def _replay(cls, state, p: Path):
+        if not p.exists():
+            return state, 0
+        n = 0
+        with open(p, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except Exception:
+                    # 最後一行寫到一半（crash）→ 忽略
+                    break
+                state = cls._apply(state, rec)
+                n += 1
+        return state, n
+
+    def _ensure(self, name: str):
+        """第一次用到某個 collection 時：讀 snapshot + 重播 log"""
+        if name in self.colls:
+            return
+        p = _path(name)
+        wal, old_wal = self._wal_path(name), self._old_wal_path(name)
+        self.present[name] = p.exists() or wal.exists() or old_wal.exists()
+        state = self._read_snapshot(name)
+        state, _ = self._replay(state, old_wal)
+        state, n2 = self._replay(state, wal)
+        if old_wal.exists():
+            # 上次 compaction 做到一半：先同步寫出 snapshot，避免下一次 compaction 蓋掉 .wal.1
+            self._write_snapshot(name, state)
+            old_wal.unlink()
+            wal.unlink(missing_ok=True)
+            n2 = 0
+        self.colls[name] = state
+        self.log_counts[name] = n2
+        self.logs[name] = open(wal, "a", encoding="utf-8")
+
+    def _write(self, name: str, records):
+        lines = [json.dumps(r, ensure_ascii=False) for r in records]
+        f = self.logs[name]
+        f.write("\n".join(lines) + "\n")
+        f.flush()
+
+        # 記憶體狀態用 log 內容還原，保證和磁碟一致、且不和呼叫端共用物件
+        for line in lines:
+            self.colls[name] = self._apply(self.colls[name], json.loads(line))
+        self.present[name] = True
+
+        self.log_counts[name] += len(records)
+        if self.log_counts[name] >= self.compact_records and name not in self.compacting:
+            t = self.compacting[name] = threading.Thread(target=self._compact, args=(name,), daemon=True)
+            t.start()
+        with self._sync:
+            self.unsynced.add(name)
+            self._sync.notify()
+
+    # ---- 背景工作 ----
+    def _flusher(self):
+        while True:
+            with self._sync:
+                while not self.unsynced and not self._closed:
+                    self._sync.wait()
+                if self._closed:
+                    return
+                names = list(self.unsynced)
+                self.unsynced.clear()
+            files = [self.logs[n] for n in names if n in self.logs]
+            for f in files:
+                try:
+                    os.fsync(f.fileno())
+                except (OSError, ValueError):
+                    pass
+            # 同一批次內的其他寫入會一起被下一次 fsync 帶走
+            time.sleep(self.fsync_interval)
+
+    def _compact(self, name: str):
+        try:
+            with _coll_lock(name):
+                # 換一個新的 log，舊 log 留到 snapshot 落地後再刪
+                f = self.logs[name]
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                wal, old_wal = self._wal_path(name), self._old_wal_path(name)
+                try:
+                    if old_wal.exists():
+                        # 上一次 compaction 的 snapshot 沒寫成功，.wal.1 裡還有 snapshot 之外的紀錄：
+                        # 不能蓋掉它，把目前的 log 接在後面（中途 crash 造成的重複紀錄重播兩次結果一樣）
+                        with open(wal, "rb") as src, open(old_wal, "ab") as dst:
+                            shutil.copyfileobj(src, dst)
+                            dst.flush()
+                            os.fsync(dst.fileno())
+                        wal.unlink()
+                    else:
+                        os.replace(wal, old_wal)
+                finally:
+                    # 換 log 失敗時繼續 append 到原本的 .wal
+                    self.logs[name] = open(wal, "a", encoding="utf-8")
+                self.log_counts[name] = 0
+                snap = self._snapshot_of(self.colls[name])
+
+            # 序列化與寫檔都在鎖外進行，不擋住其他讀寫
+            self._write_snapshot(name, snap)
+            try:
+                self._old_wal_path(name).unlink()
+            except FileNotFoundError:
+                pass
+            print(f"[DB] compacted {name}", flush=True)
+        except Exception as e:
+            print(f"[DB] compact {name} failed: {e}", flush=True)
+        finally:
+            with _coll_lock(name):
+                self.compacting.pop(name, None)
+
+    def flush(self):
+        for name in list(self.logs):
+            with _coll_lock(name):
+                f = self.logs[name]
+                try:
+                    f.flush()
+                    os.fsync(f.fileno())
+                except (OSError, ValueError):
+                    pass
+
+    def close(self):
+        """等進行中的 compaction 做完、停掉 flusher，fsync 並關閉所有 log"""
+        for name in list(self.compacting):
+            with _coll_lock(name):
+                t = self.compacting.get(name)
+            if t is not None:
+                t.join()
+        with self._sync:
+            self._closed = True
+            self._sync.notify()
+        self._thread.join()
+        self.flush()
+        for name in list(self.logs):
+            with _coll_lock(name):
+                self.logs.pop(name).close()
+
+# ----------------- backend: sqlite（WAL 模式 + 正規化資料表） ----------------- #
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    role     TEXT NOT NULL,
+    username TEXT NOT NULL,
+    ver      INTEGER NOT NULL DEFAULT 1,
+    data     TEXT NOT NULL,
+    PRIMARY KEY (role, username)
+);
+CREATE TABLE IF NOT EXISTS games (
+    name         TEXT PRIMARY KEY,
+    ver          INTEGER NOT NULL DEFAULT 1,
+    author       TEXT,
+    status       TEXT,
+    latest       TEXT,
+    avg_rating   REAL,
+    review_count INTEGER,
+    data         TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS games_author ON games(author);
+CREATE INDEX IF NOT EXISTS games_status ON games(status);
+CREATE TABLE IF NOT EXISTS game_versions (
+    game    TEXT NOT NULL,
+    version TEXT NOT NULL,
+    data    TEXT NOT NULL,
+    PRIMARY KEY (game, version)
+);
+CREATE TABLE IF NOT EXISTS reviews (
+    game     TEXT NOT NULL,
+    username TEXT NOT NULL,
+    rating   INTEGER,
+    text     TEXT,
+    ts       INTEGER,
+    PRIMARY KEY (game, username)
+);
+CREATE INDEX IF NOT EXISTS reviews_user ON reviews(username);
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    ver     INTEGER NOT NULL DEFAULT 1,
+    game    TEXT,
+    status  TEXT,
+    owner   TEXT,
+    data    TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rooms_game ON rooms(game);
+CREATE INDEX IF NOT EXISTS rooms_status ON rooms(status);
+CREATE TABLE IF NOT EXISTS kv (
+    coll TEXT NOT NULL,
+    key  TEXT NOT NULL,
+    ver  INTEGER NOT NULL DEFAULT 1,
+    data TEXT NOT NULL,
+    PRIMARY KEY (coll, key)
+);
+CREATE TABLE IF NOT EXISTS docs (
+    coll TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+_VERSIONED_TABLES = ("users", "games", "rooms", "kv")
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+class _RowTable:
+    """
+    一筆資料 = 一列：主鍵 + 版本號 + 幾個抽出來建索引的欄位 + 完整 JSON（data）。
+    scope 是固定條件（例如 users 表的 role、kv 表的 coll），和 key 一起組成主鍵。
+    版本號取自 meta 表裡每張表的計數器（"ver:<表名>"），每次寫入都拿新的值、永不重複：
+    刪掉再建立的同一筆資料不會拿回舊版本號，cas() 不會把舊的讀取結果寫到新資料上（ABA）。
+    """
+
+    def __init__(self, table, key_col, scope=None, columns=()):
+        self.table = table
+        self.key_col = key_col
+        self.scope = dict(scope or {})
+        self.columns = tuple(columns)
+        self._where = " AND ".join(f"{c}=?" for c in (*self.scope, key_col))
+        self._scope_where = " AND ".join(f"{c}=?" for c in self.scope) or "1"
+        cols = (*self.scope, key_col, "ver", *self.columns, "data")
+        updates = ", ".join(f"{c}=excluded.{c}" for c in ("ver", *self.columns, "data"))
+        self._upsert = (
+            f"INSERT INTO {table}({', '.join(cols)}) VALUES({', '.join('?' * len(cols))}) "
+            f"ON CONFLICT({', '.join((*self.scope, key_col))}) DO UPDATE SET {updates}"
+        )
+
+    def _args(self, key):
+        return (*self.scope.values(), key)
+
+    def _row_data(self, value):
+        return value
+
+    def get(self, c, key):
+        row = c.execute(f"SELECT data, ver FROM {self.table} WHERE {self._where}", self._args(key)).fetchone()
+        if not row:
+            return None, 0
+        return self._assemble(c, key, json.loads(row[0])), row[1]
+
+    def version(self, c, key):
+        row = c.execute(f"SELECT ver FROM {self.table} WHERE {self._where}", self._args(key)).fetchone()
+        return row[0] if row else 0
+
+    def all(self, c):
+        rows = c.execute(
+            f"SELECT {self.key_col}, data FROM {self.table} WHERE {self._scope_where}",
+            tuple(self.scope.values()),
+        )
+        return {k: json.loads(d) for k, d in rows}
+
+    def _assemble(self, c, key, data):
+        return data
+
+    def _next_version(self, c):
+        mark = f"ver:{self.table}"
+        c.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key=?", (mark,))
+        return int(c.execute("SELECT value FROM meta WHERE key=?", (mark,)).fetchone()[0])
+
+    def write(self, c, key, value):
+        extra = [value.get(col) if isinstance(value, dict) else None for col in self.columns]
+        c.execute(self._upsert, (*self._args(key), self._next_version(c), *extra, _dumps(self._row_data(value))))
+
+    def delete(self, c, key):
+        return c.execute(f"DELETE FROM {self.table} WHERE {self._where}", self._args(key)).rowcount > 0
+
+class _GameTable(_RowTable):
+    """games.json：遊戲本體一列，版本與評論各自拆到 game_versions / reviews 表"""
+
+    def __init__(self):
+        super().__init__("games", "name", columns=("author", "status", "latest", "avg_rating", "review_count"))
+
+    def _row_data(self, value):
+        return {k: v for k, v in value.items() if k not in ("versions", "reviews")}
+
+    def _versions_of(self, c, name):
+        return {v: d for v, d in c.execute("SELECT version, data FROM game_versions WHERE game=?", (name,))}
+
+    def _reviews_of(self, c, name):
+        rows = c.execute("SELECT username, rating, text, ts FROM reviews WHERE game=?", (name,))
+        return {u: {"rating": r, "text": t, "ts": ts} for u, r, t, ts in rows}
+
+    def _assemble(self, c, key, data):
+        data["versions"] = {v: json.loads(d) for v, d in self._versions_of(c, key).items()}
+        data["reviews"] = self._reviews_of(c, key)
+        return data
+
+    def all(self, c):
+        games = {k: json.loads(d) for k, d in c.execute("SELECT name, data FROM games")}
+        for g in games.values():
+            g["versions"], g["reviews"] = {}, {}
+        for name, ver, d in c.execute("SELECT game, version, data FROM game_versions"):
+            if name in games:
+                games[name]["versions"][ver] = json.loads(d)
+        for name, u, r, t, ts in c.execute("SELECT game, username, rating, text, ts FROM reviews"):
+            if name in games:
+                games[name]["reviews"][u] = {"rating": r, "text": t, "ts": ts}
+        return games
+
+    def write(self, c, key, value):
+        super().write(c, key, value)
+
+        # 版本：只寫真的有變的列（內容相同就不重寫）
+        old = self._versions_of(c, key)
+        new = {v: _dumps(d) for v, d in (value.get("versions") or {}).items()}
+        c.executemany(
+            "INSERT INTO game_versions(game, version, data) VALUES(?,?,?) "
+            "ON CONFLICT(game, version) DO UPDATE SET data=excluded.data",
+            [(key, v, d) for v, d in new.items() if old.get(v) != d],
+        )
+        c.executemany("DELETE FROM game_versions WHERE game=? AND version=?",
+                      [(key, v) for v in old if v not in new])
+
+        reviews = value.get("reviews")
+        reviews = reviews if isinstance(reviews, dict) else {}
+        old_r = self._reviews_of(c, key)
+        c.executemany(
+            "INSERT INTO reviews(game, username, rating, text, ts) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(game, username) DO UPDATE SET rating=excluded.rating, text=excluded.text, ts=excluded.ts",
+            [(key, u, r.get("rating"), r.get("text"), r.get("ts"))
+             for u, r in reviews.items() if old_r.get(u) != r],
+        )
+        c.executemany("DELETE FROM reviews WHERE game=? AND username=?",
+                      [(key, u) for u in old_r if u not in reviews])
+
+    def delete(self, c, key):
+        c.execute("DELETE FROM game_versions WHERE game=?", (key,))
+        c.execute("DELETE FROM reviews WHERE game=?", (key,))
+        return super().delete(c, key)
+
+def _table_for(name: str) -> _RowTable:
+    if name == "games.json":
+        return _GameTable()
+    if name == "rooms.json":
+        return _RowTable("rooms", "room_id", columns=("game", "status", "owner"))
+    if name == "dev_users.json":
+        return _RowTable("users", "username", scope={"role": "developer"})
+    if name == "player_users.json":
+        return _RowTable("users", "username", scope={"role": "player"})
+    return _RowTable("kv", "key", scope={"coll": name})
+
+class _SqliteStore:
+    """
+    SQLite（WAL 模式）：每筆資料獨立一列，get/put/cas 只碰那一列。
+    load()/save() 仍回傳 / 接受整份 dict，讓還沒改成逐筆存取的 handler 照常運作
+    （save 會先比對，只寫有變動的列）；不是 dict 的 collection（例如 list）整份存在 docs 表的一列。
+    每個執行緒一條連線；讀取用 deferred 交易拿一致的 snapshot，寫入用 BEGIN IMMEDIATE。
+    第一次開啟時會自動把 data_dir 下既有的 JSON 檔匯入（migrate_json_to_sqlite）。
+    """
+
+    def __init__(self, path="store.sqlite3", migrate=True):
+        p = Path(path)
+        self.path = p if p.is_absolute() else DATA_DIR / p
+        self._local = threading.local()
+        self._conns = []       # 所有執行緒的連線（close() 用）
+        self._conns_lock = threading.Lock()
+        self._tables = {}
+        self._conn().executescript(_SCHEMA)
+        with self._tx() as c:
+            # 版本號計數器從既有資料的最大版本號接著算
+            for table in _VERSIONED_TABLES:
+                c.execute(f"INSERT OR IGNORE INTO meta(key, value) SELECT ?, COALESCE(MAX(ver), 0) FROM {table}",
+                          (f"ver:{table}",))
+        if migrate:
+            migrate_json_to_sqlite(self)
+
+    def _conn(self):
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            # 每條連線只在建立它的執行緒使用；check_same_thread=False 只是讓 close() 能從別的執行緒關掉它
+            c = sqlite3.connect(str(self.path), timeout=30, isolation_level=None, check_same_thread=False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            c.execute("PRAGMA busy_timeout=30000")
+            self._local.conn = c
+            with self._conns_lock:
+                self._conns.append(c)
+        return c
+
+    def _table(self, name: str) -> _RowTable:
+        t = self._tables.get(name)
+        if t is None:
+            t = self._tables.setdefault(name, _table_for(name))
+        return t
+
+    @contextmanager
+    def _tx(self, write=True):
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield c
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+
+    @staticmethod
+    def _doc(c, name):
+        row = c.execute("SELECT data FROM docs WHERE coll=?", (name,)).fetchone()
+        return row and json.loads(row[0])
+
+    @staticmethod
+    def _drop_doc(c, name):
+        # 逐筆寫入會把整份非 dict 的 collection 換成 dict（跟記憶體 backend 的 set 一樣）
+        c.execute("DELETE FROM docs WHERE coll=?", (name,))
+
+    def load(self, name: str, default=None):
+        with self._tx(write=False) as c:
+            doc = self._doc(c, name)
+            if doc is not None:
+                return doc
+            data = self._table(name).all(c)
+        return data if data else _empty(default)
+
+    def save(self, name: str, obj):
+        t = self._table(name)
+        with self._tx() as c:
+            if not isinstance(obj, dict):
+                for key in t.all(c):
+                    t.delete(c, key)
+                c.execute("INSERT OR REPLACE INTO docs(coll, data) VALUES(?, ?)", (name, _dumps(obj)))
+                return True
+            self._drop_doc(c, name)
+            for rec in _MemoryStore._diff(t.all(c), obj):
+                if rec["op"] == "set":
+                    t.write(c, rec["key"], rec["value"])
+                else:
+                    t.delete(c, rec["key"])
+        return True
+
+    def get(self, name: str, key, default=None):
+        with self._tx(write=False) as c:
+            value, _ = self._table(name).get(c, key)
+        return default if value is None else value
+
+    def put(self, name: str, key, value):
+        with self._tx() as c:
+            self._drop_doc(c, name)
+            self._table(name).write(c, key, value)
+        return True
+
+    def delete(self, name: str, key):
+        with self._tx() as c:
+            return self._table(name).delete(c, key)
+
+    def get_versioned(self, name: str, key):
+        with self._tx(write=False) as c:
+            return self._table(name).get(c, key)
+
+    def cas(self, name: str, key, version, value, remove=False):
+        t = self._table(name)
+        with self._tx() as c:
+            if t.version(c, key) != version:
+                return False
+            if remove:
+                t.delete(c, key)
+            else:
+                self._drop_doc(c, name)
+                t.write(c, key, value)
         return True
+
+    def flush(self):
+        try:
+            self._conn().execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except sqlite3.Error:
+            pass
+
+    def close(self):
+        self.flush()
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for c in conns:
+            try:
+                c.close()
+            except sqlite3.Error:
+                pass
+
+def migrate_json_to_sqlite(store: _SqliteStore, force=False):
+    """
+    一次性把 DATA_DIR 下的 *.json（含 wal 模式尚未 compaction 的 log）匯入 SQLite。
+    每個檔案匯入後記在 meta 表，之後不會重複匯入；force=True 則覆蓋重匯。
+    原本的 JSON 檔保留不動，可當備份。
+    """
+    c = store._conn()
+    names = set()
+    for p in DATA_DIR.iterdir():
+        for suffix in (".json", ".json.wal", ".json.wal.1"):
+            if p.name.endswith(suffix):
+                names.add(p.name[: len(p.name) - len(suffix)] + ".json")
+    for name in sorted(names):
+        mark = f"migrated:{name}"
+        if not force and c.execute("SELECT 1 FROM meta WHERE key=?", (mark,)).fetchone():
+            continue
+        state = _MemoryStore._read_snapshot(name)
+        state, _ = _WalStore._replay(state, _WalStore._old_wal_path(name))
+        state, _ = _WalStore._replay(state, _WalStore._wal_path(name))
+        if isinstance(state, dict):
+            t = store._table(name)
+            with store._tx() as tc:
+                for k, v in state.items():
+                    t.write(tc, k, v)
+                tc.execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)", (mark, str(int(time.time()))))
+            print(f"[DB] migrated {name} → sqlite ({len(state)} records)", flush=True)
+        else:
+            store.save(name, state)
+            c.execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)", (mark, str(int(time.time()))))
+            print(f"[DB] migrated {name} → sqlite (whole document)", flush=True)
+
+# ----------------- 對外 API ----------------- #
+
+BACKENDS = {
+    "json": _JsonStore,
+    "cache": _CacheStore,
+    "wal": _WalStore,
+    "sqlite": _SqliteStore,
+}
+
+_store = _JsonStore()
+
+def configure(backend: str = "json", **opts):
+    """
+    選擇儲存模式（由 server/main.py 依 config.json 的 "db" 區塊呼叫）：
+      - "json"：每次整檔覆寫（預設，與舊版相同）
+      - "cache"：記憶體為主，背景每 flush_interval 秒把有變動的 collection 寫回
+      - "wal" ：append-only log + 批次 fsync + 背景 compaction
+      - "sqlite"：SQLite（WAL 模式）資料表，path 相對於 server/data；第一次啟動會自動匯入既有 JSON
+    必須在任何 load/save 之前呼叫。
+    """
+    global _store
+    cls = BACKENDS.get(backend)
+    if cls is None:
+        raise ValueError(f"unknown db backend: {backend}")
+    with _registry_lock:
+        _store.close()      # 舊 store 的背景執行緒停掉、檔案 / 連線關閉，資料都寫進磁碟
+        _store = cls(**opts)
+    print(f"[DB] backend = {backend} {opts if opts else ''}", flush=True)
+
+def load(name: str, default=None):
+    return _store.load(name, default)
+
+def save(name: str, obj):
+    """整份 collection 寫回；和同一 collection 上的 txn() / put() 併用時，後寫的會蓋掉先寫的"""
+    return _store.save(name, obj)
+
+def get(name: str, key, default=None):
+    """只讀一筆資料（回傳副本），記憶體 backend 下不需要複製整份 collection"""
+    return _store.get(name, key, default)
+
+def put(name: str, key, value):
+    with _key_lock(name, key):
+        return _store.put(name, key, value)
+
+# 每個執行緒目前所在的 txn（讓 txn 內呼叫 delete() 時，離開 txn 不會又把資料寫回去）
+_local = threading.local()
+
+def delete(name: str, key):
+    with _key_lock(name, key):
+        for frame in getattr(_local, "txns", []):
+            if frame["name"] == name and frame["key"] == key:
+                frame["deleted"] = True
+        return _store.delete(name, key)
+
+@contextmanager
+def txn(name: str, key, default=None):
+    """
+    單筆資料的交易：
+
+        with db.txn("rooms.json", room_id) as room:
+            room["status"] = "ready"
+
+      - 整個 with 期間持有這筆資料的鎖（不同 key 互不影響）
+      - room 是副本；資料不存在時拿到 default 的副本（default 為 None 則拿到 None）
+      - 正常離開且內容有變 → 寫回（內容仍等於 default 的新資料不會被建立）；with 內丟出例外 → 不寫入
+      - with 內呼叫 db.delete(name, key) 會刪除這筆資料，離開時不再寫回
+    不要在 txn 內再開另一個 key 的 txn（可能和別的執行緒互相等待）。
+    """
+    with _key_lock(name, key):
+        rec = _store.get(name, key)
+        if rec is None and default is not None:
+            rec = copy.deepcopy(default)
+        before = copy.deepcopy(rec)
+
+        frame = {"name": name, "key": key, "deleted": False}
+        stack = _local.__dict__.setdefault("txns", [])
+        stack.append(frame)
+        try:
+            yield rec
+        finally:
+            stack.remove(frame)
+
+        if frame["deleted"] or rec is None:
+            return
+        if rec != before:
+            _store.put(name, key, rec)
+
+# ----------------- 樂觀並行控制（compare-and-swap） ----------------- #
+
+class Remove(Exception):
+    """在 update() 的 fn 裡丟出：刪除這筆資料，update() 回傳 result"""
+    def __init__(self, result=None):
+        super().__init__(result)
+        self.result = result
+
+class Conflict(Exception):
+    """update() 重試次數用完仍一直和別人衝突"""
+
+def get_versioned(name: str, key):
+    """回傳 (資料副本, 版本號)；資料不存在時為 (None, 版本號)"""
+    return _store.get_versioned(name, key)
+
+def cas(name: str, key, version, value):
+    """只有在版本號仍是 version 時才寫入 value；成功回傳 True"""
+    return _store.cas(name, key, version, value)
+
+def update(name: str, key, fn, default=None, retries=100):
+    """
+    單筆資料的 read-modify-write，不持有任何鎖執行 fn：
+
+        def _join(room):
+            if room is None:
+                return {"ok": False, "error": "房間不存在"}
+            room["players"].append(player)
+            return {"ok": True}
+
+        resp = db.update("rooms.json", room_id, _join)
+
+      - fn(rec) 直接修改 rec（副本；不存在時是 default 的副本或 None），回傳值就是 update() 的回傳值
+      - rec 沒有被改動就不寫入（錯誤回應直接 return 即可）
+      - 要刪除這筆資料：raise db.Remove(result)
+      - 寫回時若發現別人已經改過（版本號不同）→ 重新讀取並重跑 fn，所以 fn 不能有副作用
+        （例如廣播要等 update() 回傳之後再做）
+    """
+    for _ in range(retries):
+        rec, ver = _store.get_versioned(name, key)
+        if rec is None and default is not None:
+            rec = copy.deepcopy(default)
+        before = copy.deepcopy(rec)
+        try:
+            result = fn(rec)
+        except Remove as rm:
+            if before is None or _store.cas(name, key, ver, None, remove=True):
+                return rm.result
+            continue
+        if rec == before or rec is None:
+            return result
+        if _store.cas(name, key, ver, rec):
+            return result
+    raise Conflict(f"{name}[{key}] 更新衝突次數過多")
+
+def flush():
+    """把尚未寫入 / fsync 的資料寫進磁碟（關機前呼叫）"""
+    _store.flush()
+
+atexit.register(flush)
+
+if __name__ == "__main__":
+    # 手動匯入：python server/common/db.py migrate [sqlite 檔名] [--force]
+    if len(sys.argv) >= 2 and sys.argv[1] == "migrate":
+        args = [a for a in sys.argv[2:] if a != "--force"]
+        store = _SqliteStore(args[0] if args else "store.sqlite3", migrate=False)
+        migrate_json_to_sqlite(store, force="--force" in sys.argv)
+    else:
+        print("usage: python server/common/db.py migrate [sqlite 檔名] [--force]")
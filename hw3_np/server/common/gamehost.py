@@ -0,0 +1,230 @@
+# server/common/gamehost.py
+"""
+多房間的遊戲 host 行程（manifest 宣告 "supports": ["host"] 的遊戲）：
+
+  - 一個 host 行程在同一個 asyncio loop 上跑很多房間，不再一個房間一個 Python 行程
+  - lobby 跟 host 之間是一條 AF_UNIX 控制通道（環境變數 GAME_HOST_FD）：
+      lobby → host  {"op": "open", "room_id", "env"} + SCM_RIGHTS [listen socket, ready pipe?]
+                    {"op": "close", "room_id"}
+      host → lobby  {"closed": room_id, "code": 0 / 非 0}
+    每個房間仍然有自己的 listening socket（lobby 預先 bind），就緒通知也沿用 ready pipe
+  - 同一款遊戲最多開 max_hosts 個 host（預設 CPU 核心數），每個 host 綁一個核心；
+    新房間放到房間數最少的 host，最少的也已經有 rooms_per_host 個房間時才再開一個 host
+  - lobby 關掉控制通道（close()）之後 host 不再接新房間，房間都結束就自己離開
+
+HostedRoom 提供 lobby 會用到的 subprocess.Popen 介面（pid / poll / kill / wait），
+所以房間啟動監看、逾時處理都跟一般遊戲伺服器共用。
+
+控制通道一定要是 SOCK_SEQPACKET：DGRAM 收不到對方關閉的 EOF，host 掛掉時房間永遠不會結束，
+所以平台不支援時直接失敗（lobby 會改用一般方式開房間）。
+"""
+import json, os, socket, subprocess, sys, threading, time
+
+MAX_MSG = 64 * 1024
+
+class HostedRoom:
+    def __init__(self, host, room_id, on_exit=None):
+        self.host = host
+        self.room_id = room_id
+        self.pid = host.proc.pid
+        self.returncode = None
+        self.on_exit = on_exit
+        self._done = threading.Event()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise subprocess.TimeoutExpired(f"room {self.room_id}", timeout)
+        return self.returncode
+
+    def kill(self):
+        """只收掉這個房間，host 上其他房間不受影響"""
+        if self.returncode is None:
+            self.host._send({"op": "close", "room_id": self.room_id})
+
+    terminate = kill
+
+    def _exited(self, code):
+        if self.returncode is not None:
+            return
+        self.returncode = code
+        self._done.set()
+        if self.on_exit is not None:
+            try:
+                self.on_exit(self, code)
+            except Exception as e:
+                print(f"[GameHost] on_exit error for {self.room_id}: {e}", flush=True)
+
+class GameHost:
+    def __init__(self, key, cwd, entry, spawn=None, cpu=None, tag="GameHost"):
+        self.key = key
+        self.tag = tag
+        self.rooms = {}                    # room_id -> HostedRoom
+        self.idle_since = time.monotonic()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._sock, child = _socketpair()
+        env = os.environ.copy()
+        env["GAME_HOST_FD"] = str(child.fileno())
+        spawn = spawn or subprocess.Popen
+        try:
+            self.proc = spawn([sys.executable, entry], cwd=str(cwd), env=env,
+                              stdin=subprocess.DEVNULL, pass_fds=(child.fileno(),))
+        except Exception:
+            self._sock.close()
+            raise
+        finally:
+            child.close()
+        if cpu is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(self.proc.pid, {cpu})
+            except OSError:
+                pass
+        threading.Thread(target=self._reader, name=f"{key}-reader", daemon=True).start()
+
+    def load(self) -> int:
+        return len(self.rooms)
+
+    def alive(self) -> bool:
+        return not self._closed
+
+    def open_room(self, room_id, env: dict, fds: dict, on_exit=None) -> HostedRoom:
+        """
+        在這個 host 上開一個房間。fds 是 {環境變數名稱: fd}（GAME_LISTEN_FD 必須有），
+        host 會在房間的環境裡換成它收到的 fd 號碼；呼叫端自己的 fd 照舊由呼叫端關閉。
+        on_exit(room, code) 在房間結束時呼叫。
+        """
+        room = HostedRoom(self, room_id, on_exit)
+        with self._lock:
+            if self._closed:
+                raise OSError("game host 已結束")
+            self.rooms[room_id] = room
+        msg = {"op": "open", "room_id": room_id, "env": env, "fds": list(fds)}
+        try:
+            socket.send_fds(self._sock, [json.dumps(msg).encode("utf-8")], list(fds.values()))
+        except OSError:
+            with self._lock:
+                self.rooms.pop(room_id, None)
+            raise
+        return room
+
+    def close(self):
+        """不再放新房間；已經在跑的房間照常，結束後 host 自己離開"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._send(None)
+
+    def _send(self, obj):
+        try:
+            self._sock.send(b"" if obj is None else json.dumps(obj).encode("utf-8"))
+        except OSError:
+            pass
+
+    def _reader(self):
+        while True:
+            try:
+                data = self._sock.recv(MAX_MSG)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            try:
+                msg = json.loads(data)
+            except ValueError:
+                continue
+            if "closed" in msg:
+                self._room_done(msg["closed"], msg.get("code", 0))
+
+        # host 結束了：還在上面的房間都跟著結束（退出碼用 host 的）
+        with self._lock:
+            self._closed = True
+        try:
+            code = self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            code = -1
+        print(f"[{self.tag}] {self.key} exited (code={code}, rooms={len(self.rooms)})", flush=True)
+        for room_id in list(self.rooms):
+            self._room_done(room_id, code if code else -1)
+        self._sock.close()
+
+    def _room_done(self, room_id, code):
+        with self._lock:
+            room = self.rooms.pop(room_id, None)
+            if not self.rooms:
+                self.idle_since = time.monotonic()
+        if room is not None:
+            room._exited(code)
+
+class GameHostPool:
+    """一款遊戲（一個版本資料夾）的 host 們；place() 把房間放到房間最少的 host，需要時再開新的"""
+
+    def __init__(self, name, cwd, entry, max_hosts=None, rooms_per_host=8, spawn=None):
+        self.name = name
+        self.cwd = cwd
+        self.entry = entry
+        self.max_hosts = max_hosts or os.cpu_count() or 1
+        self.rooms_per_host = rooms_per_host
+        self.spawn = spawn
+        self.hosts = []
+        self._lock = threading.Lock()
+        self._next = 0
+        self._closed = False
+
+    def place(self, room_id, env: dict, fds: dict, on_exit=None) -> HostedRoom:
+        """
+        挑 host 並在上面開房間（參數同 GameHost.open_room）。整段都拿著 pool 的鎖：
+        房間登記到 host 之前 retire_idle() 看到的 load() 還是 0，放開鎖再開房的話 host 可能先被收掉
+        """
+        with self._lock:
+            if self._closed:
+                raise OSError(f"{self.name} 的 host pool 已關閉")
+            self.hosts = [h for h in self.hosts if h.alive()]
+            best = min(self.hosts, key=GameHost.load, default=None)
+            if best is None or (best.load() >= self.rooms_per_host and len(self.hosts) < self.max_hosts):
+                cpu = _pick_cpu(self._next)
+                key = f"host:{self.name}:{self._next}"
+                self._next += 1
+                best = GameHost(key, self.cwd, self.entry,
+                                spawn=(lambda args, **kw: self.spawn(key, args, **kw)) if self.spawn else None,
+                                cpu=cpu)
+                self.hosts.append(best)
+                print(f"[GameHost] 啟動 {key}（CPU {cpu}）", flush=True)
+            return best.open_room(room_id, env, fds, on_exit)
+
+    def retire_idle(self, ttl):
+        """空了超過 ttl 秒的 host 收掉（至少留一個）"""
+        now = time.monotonic()
+        with self._lock:
+            keep = []
+            for h in self.hosts:
+                if h.alive() and keep and h.load() == 0 and now - h.idle_since > ttl:
+                    h.close()
+                elif h.alive():
+                    keep.append(h)
+            self.hosts = keep
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for h in self.hosts:
+                h.close()
+            self.hosts = []
+
+    def stats(self) -> dict:
+        return {h.key: h.load() for h in self.hosts if h.alive()}
+
+def _pick_cpu(n):
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    return cpus[n % len(cpus)] if cpus else None
+
+def _socketpair():
+    # SOCK_SEQPACKET 保留訊息邊界並且讀得到 EOF；沒有的平台（macOS）不能用 game host
+    if not hasattr(socket, "SOCK_SEQPACKET"):
+        raise OSError("平台不支援 SOCK_SEQPACKET，無法使用 game host")
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
@@ -0,0 +1,15 @@
+# server/common/gamesdk.py
+"""
+遊戲伺服器共用的 helper 放在 server/game_sdk/（lobby_game.py：listen_socket / notify_ready）。
+lobby 與 host agent 啟動時呼叫 export()，把它加進自己的 PYTHONPATH，
+之後開的遊戲伺服器、zygote、host 行程都繼承這個環境變數，遊戲裡直接 import lobby_game 即可。
+"""
+import os
+from pathlib import Path
+
+SDK_DIR = Path(__file__).resolve().parents[1] / "game_sdk"
+
+def export():
+    sdk = str(SDK_DIR)
+    rest = [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p and p != sdk]
+    os.environ["PYTHONPATH"] = os.pathsep.join([sdk, *rest])
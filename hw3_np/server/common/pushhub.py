@@ -0,0 +1,406 @@
+# server/common/pushhub.py
+"""
+房間訂閱（SSE 風格推播）的集中管理。
+
+  - topic（例如 room_id）→ 訂閱者；publish() 把同一份 bytes 排進每個訂閱者的送出佇列，
+    本身不做任何 I/O，呼叫端不會被慢的 client 卡住
+  - 同一個 topic 還沒送出的訊息直接換成最新的一份（coalesce）：房間狀態連續變動時，
+    慢的 client 只會收到最新狀態，不會累積一堆過期的更新
+  - 每個訂閱者的待送資料有上限（high-water mark，bytes / 則數）：超過，或是有資料要送卻
+    max_stall 秒都送不出去（client 太慢或已經不收），就直接斷線退訂，不會無限吃記憶體
+  - 一般 socket（threads 模式）的訂閱連線交給一條 selector 執行緒：
+    可寫時送佇列、可讀時偵測 EOF → 自動退訂，不再每條連線停一個睡覺的執行緒
+  - AsyncConn（asyncio 模式）的訂閱由它的 event loop 送出（排一個 callback 把佇列寫進 transport）；
+    EOF 由連線本身的 wait_eof 處理
+  - close_topic()：房間刪除時移除所有訂閱；專用的訂閱連線送完剩下的資料後會被關閉
+  - live_subscribers() / stats()：目前的訂閱者數量等 gauge
+
+dedicated=True 表示這條連線只用來收推播（一次性的 subscribe_room 連線）：
+訂閱後先「暫停」，等 release(conn, first) 把訂閱回應送出去之後才開始送事件，
+確保 client 第一行一定讀到回應；所有 topic 都退訂後連線會被關閉。
+session 連線（dedicated=False）則不暫停、也不會因為退訂而關閉。
+"""
+import selectors, socket, threading, time
+from collections import deque
+from common import aioserver
+
+class _Sub:
+    def __init__(self, conn, dedicated):
+        self.conn = conn
+        self.dedicated = dedicated
+        self.topics = set()
+        self.held = dedicated
+        self.queue = deque()    # [topic, data]，還沒送出的訊息
+        self.latest = {}        # topic -> queue 裡該 topic 的那一筆（coalesce 用）
+        self.queued_bytes = 0
+        self.closing = False
+
+    def enqueue(self, topic, data, coalesce):
+        """排進佇列；同 topic 已有還沒送出的訊息就直接換成新的。回傳是否被合併"""
+        entry = self.latest.get(topic) if coalesce else None
+        if entry is not None:
+            self.queued_bytes += len(data) - len(entry[1])
+            entry[1] = data
+            return True
+        entry = [topic, data]
+        self.queue.append(entry)
+        self.queued_bytes += len(data)
+        if coalesce:
+            self.latest[topic] = entry
+        return False
+
+    def dequeue(self) -> bytes:
+        topic, data = entry = self.queue.popleft()
+        if self.latest.get(topic) is entry:
+            del self.latest[topic]
+        self.queued_bytes -= len(data)
+        return data
+
+    def clear(self):
+        self.queue.clear()
+        self.latest.clear()
+        self.queued_bytes = 0
+
+class _SocketSub(_Sub):
+    def __init__(self, conn, dedicated):
+        super().__init__(conn, dedicated)
+        self.out = b""          # 目前這則訊息還沒送完的部分
+        self.registered = False
+        self.progress_at = time.monotonic()   # 上次成功送出資料的時間
+
+class _AsyncSub(_Sub):
+    def __init__(self, conn, dedicated):
+        super().__init__(conn, dedicated)
+        self.scheduled = False  # 已經排了 _drain_async 還沒執行
+
+class PushHub:
+    def __init__(self, max_queue=256, max_buffer_bytes=1 << 20, max_stall=15.0):
+        self.max_queue = max_queue                  # 每個訂閱者最多排幾則訊息
+        self.max_buffer_bytes = max_buffer_bytes    # 每個訂閱者待送的 bytes 上限（含 kernel 之外的 transport 緩衝）
+        self.max_stall = max_stall                  # socket 訂閱者：有資料待送卻完全送不出去的秒數上限
+        self._lock = threading.RLock()
+        self._topics = {}     # topic -> set(sub)
+        self._subs = {}       # conn -> sub
+        self.published = 0
+        self.coalesced = 0    # 被新訊息取代、沒有送出的舊訊息數
+        self.dropped = 0      # 因為佇列塞滿 / 送出失敗被斷線的次數
+
+        self._sel = None
+        self._ops = deque()   # 交給 selector 執行緒處理的 (op, sub)
+        self._wake_r = self._wake_w = None
+
+    # ----------------- 訂閱管理 ----------------- #
+
+    def subscribe(self, topic, conn, dedicated=False):
+        with self._lock:
+            sub = self._subs.get(conn)
+            if sub is None:
+                is_async = isinstance(conn, aioserver.AsyncConn)
+                sub = (_AsyncSub if is_async else _SocketSub)(conn, dedicated)
+                self._subs[conn] = sub
+            sub.topics.add(topic)
+            self._topics.setdefault(topic, set()).add(sub)
+        return sub
+
+    def release(self, conn, first: bytes = None):
+        """dedicated 訂閱：先送 first（訂閱回應），再開始送暫存的事件"""
+        with self._lock:
+            sub = self._subs.get(conn)
+            if sub is None:
+                return
+            if first is not None:
+                sub.queue.appendleft([None, first])
+                sub.queued_bytes += len(first)
+            sub.held = False
+            if isinstance(sub, _SocketSub):
+                sub.progress_at = time.monotonic()
+                conn.setblocking(False)
+                self._post("add", sub)
+            else:
+                self._schedule_async(sub)
+
+    def unsubscribe(self, topic, conn):
+        with self._lock:
+            sub = self._subs.get(conn)
+            if sub is None:
+                return
+            self._detach(sub, topic)
+            if not sub.topics:
+                if sub.dedicated:
+                    self._close_when_flushed(sub)
+                else:
+                    self._subs.pop(conn, None)
+
+    def cancel(self, conn):
+        """還沒 release 就放棄的訂閱（例如房間不存在）：移除但不動連線，連線仍由呼叫端處理"""
+        with self._lock:
+            sub = self._subs.pop(conn, None)
+            if sub is not None:
+                for topic in list(sub.topics):
+                    self._detach(sub, topic)
+
+    def drop(self, conn):
+        """連線已經斷了（或要強制斷線）：退訂所有 topic"""
+        with self._lock:
+            sub = self._subs.get(conn)
+            if sub is not None:
+                self._remove(sub)
+
+    def close_topic(self, topic):
+        """topic 不再存在（房間刪除）：所有訂閱者退訂"""
+        with self._lock:
+            for sub in list(self._topics.get(topic, ())):
+                self.unsubscribe(topic, sub.conn)
+            self._topics.pop(topic, None)
+
+    def has_subscribers(self, topic) -> bool:
+        return bool(self._topics.get(topic))
+
+    # ----------------- 推播 ----------------- #
+
+    def publish(self, topic, data: bytes, coalesce=True):
+        """
+        data 已經序列化好，所有訂閱者共用同一份 bytes。
+        coalesce=True：data 是完整狀態，可以取代同 topic 還沒送出的舊訊息。
+        """
+        with self._lock:
+            subs = list(self._topics.get(topic, ()))
+            self.published += 1
+            for sub in subs:
+                if self._stalled(sub):
+                    self._drop_slow(sub, f"no progress for {self.max_stall}s")
+                    continue
+                if sub.enqueue(topic, data, coalesce):
+                    self.coalesced += 1
+                    continue    # 舊訊息還在佇列裡，已經排過送出
+                if len(sub.queue) > self.max_queue or sub.queued_bytes > self.max_buffer_bytes:
+                    self._drop_slow(sub, f"{len(sub.queue)} msgs / {sub.queued_bytes} bytes queued on {topic}")
+                    continue
+                if sub.held:
+                    continue
+                if isinstance(sub, _SocketSub):
+                    self._post("write", sub)
+                else:
+                    self._schedule_async(sub)
+
+    def _stalled(self, sub) -> bool:
+        if not isinstance(sub, _SocketSub) or sub.held or not (sub.out or sub.queue):
+            return False
+        return time.monotonic() - sub.progress_at > self.max_stall
+
+    def _drop_slow(self, sub, why):
+        print(f"[PushHub] drop slow subscriber {getattr(sub.conn, 'addr', None) or sub.conn}: {why}", flush=True)
+        self.dropped += 1
+        self._remove(sub, force_close=True)
+
+    # ----------------- AsyncConn 訂閱者 ----------------- #
+
+    def _schedule_async(self, sub):
+        if sub.scheduled:
+            return
+        sub.scheduled = True
+        try:
+            sub.conn.loop.call_soon_threadsafe(self._drain_async, sub)
+        except RuntimeError:
+            self._remove(sub)   # loop 已經結束
+
+    def _drain_async(self, sub):
+        """在 event loop 上：把佇列寫進 transport（不等對方收）"""
+        with self._lock:
+            sub.scheduled = False
+            if self._subs.get(sub.conn) is not sub and not sub.closing:
+                return
+            writer = sub.conn.writer
+            if writer.is_closing() or (sub.conn.closed and not sub.closing):
+                self._remove(sub)
+                return
+            buffered = writer.transport.get_write_buffer_size()
+            if buffered > self.max_buffer_bytes:
+                self._drop_slow(sub, f"{buffered} bytes buffered")
+                return
+            while sub.queue:
+                writer.write(sub.dequeue())
+            if sub.closing:
+                writer.close()
+
+    # ----------------- gauge ----------------- #
+
+    def live_subscribers(self) -> int:
+        return len(self._subs)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subs),
+                "topics": sum(1 for s in self._topics.values() if s),
+                "queued": sum(len(s.queue) for s in self._subs.values()),
+                "queued_bytes": sum(s.queued_bytes for s in self._subs.values()),
+                "published": self.published,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+            }
+
+    # ----------------- 內部：移除 / 關閉 ----------------- #
+
+    def _detach(self, sub, topic):
+        sub.topics.discard(topic)
+        subs = self._topics.get(topic)
+        if subs is not None:
+            subs.discard(sub)
+            if not subs:
+                self._topics.pop(topic, None)
+
+    def _remove(self, sub, force_close=False):
+        for topic in list(sub.topics):
+            self._detach(sub, topic)
+        self._subs.pop(sub.conn, None)
+        sub.clear()
+        if isinstance(sub, _SocketSub):
+            self._post("close", sub)
+        elif force_close or sub.dedicated:
+            self._close_async(sub)
+
+    def _close_when_flushed(self, sub):
+        self._subs.pop(sub.conn, None)
+        if sub.held:
+            sub.clear()
+            if isinstance(sub, _SocketSub):
+                self._post("close", sub)
+            else:
+                self._close_async(sub)
+            return
+        # 剩下的資料送完再關
+        sub.closing = True
+        if isinstance(sub, _SocketSub):
+            self._post("write", sub)
+        else:
+            self._schedule_async(sub)
+
+    @staticmethod
+    def _close_async(sub):
+        conn = sub.conn
+        conn.closed = True
+        try:
+            conn.loop.call_soon_threadsafe(conn.writer.close)
+        except RuntimeError:
+            pass   # loop 已經結束
+
+    # ----------------- selector 執行緒（socket 訂閱者） ----------------- #
+
+    def _post(self, op, sub):
+        if self._sel is None:
+            self._start()
+        self._ops.append((op, sub))
+        try:
+            self._wake_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass   # 已經有還沒處理的喚醒
+
+    def _start(self):
+        with self._lock:
+            if self._sel is not None:
+                return
+            self._wake_r, self._wake_w = socket.socketpair()
+            self._wake_r.setblocking(False)
+            self._wake_w.setblocking(False)
+            sel = selectors.DefaultSelector()
+            sel.register(self._wake_r, selectors.EVENT_READ, None)
+            self._sel = sel
+            threading.Thread(target=self._loop, name="pushhub", daemon=True).start()
+
+    def _loop(self):
+        sel = self._sel
+        while True:
+            for key, mask in sel.select():
+                sub = key.data
+                if sub is None:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ and not self._on_readable(sub):
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._flush(sub)
+            while self._ops:
+                op, sub = self._ops.popleft()
+                if op == "close":
+                    self._close_socket(sub)
+                elif sub.registered or op in ("add", "write"):
+                    self._flush(sub)
+
+    def _on_readable(self, sub) -> bool:
+        try:
+            data = sub.conn.recv(4096)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b""
+        if data:
+            return True   # 訂閱連線上 client 送的東西一律忽略
+        with self._lock:
+            if self._subs.get(sub.conn) is sub:
+                self._remove(sub)
+        self._close_socket(sub)
+        return False
+
+    def _flush(self, sub):
+        """在 selector 執行緒：盡量把佇列送出去，送不完就等 EVENT_WRITE"""
+        if sub.conn.fileno() < 0:
+            self._closed_elsewhere(sub)
+            return
+        with self._lock:
+            try:
+                while sub.out or sub.queue:
+                    if not sub.out:
+                        sub.out = sub.dequeue()
+                    n = sub.conn.send(sub.out)
+                    sub.out = sub.out[n:]
+                    sub.progress_at = time.monotonic()
+            except BlockingIOError:
+                pass
+            except OSError:
+                self._subs.pop(sub.conn, None)
+                self._remove(sub)
+                self._close_socket(sub)
+                return
+            pending = bool(sub.out or sub.queue)
+            if not pending and sub.closing:
+                self._close_socket(sub)
+                return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if pending else 0)
+        try:
+            if sub.registered:
+                self._sel.modify(sub.conn, events, sub)
+            else:
+                try:
+                    self._sel.register(sub.conn, events, sub)
+                except KeyError:
+                    # 同一個 fd 號碼還登記著一條沒退訂就被關掉的舊連線：換成這條
+                    self._sel.unregister(sub.conn.fileno())
+                    self._sel.register(sub.conn, events, sub)
+                sub.registered = True
+        except (ValueError, OSError):
+            self._closed_elsewhere(sub)
+
+    def _closed_elsewhere(self, sub):
+        """連線在別的執行緒被關掉了（還沒退訂）：當成斷線，不能讓 selector 執行緒跟著掛掉"""
+        with self._lock:
+            if self._subs.get(sub.conn) is sub:
+                self._remove(sub)
+                return
+        self._close_socket(sub)
+
+    def _close_socket(self, sub):
+        if sub.registered:
+            try:
+                self._sel.unregister(sub.conn)
+            except (KeyError, ValueError, OSError):
+                pass
+            sub.registered = False
+        try:
+            sub.conn.close()
+        except OSError:
+            pass
@@ -0,0 +1,237 @@
+# server/common/supervisor.py
+"""
+遊戲伺服器子行程的監管：
+
+  - 每個子行程的 stdout / stderr 由一條 selector 執行緒持續讀走（non-blocking），
+    子行程不會因為 pipe 塞滿（約 64 KB）而卡在 print
+  - 每個子行程只在記憶體保留最後 log_bytes 的輸出（ring buffer），給除錯 / 當機回報用
+  - 子行程結束立刻回收（Linux 用 pidfd，其他平台在 stdout EOF 時 + 每秒 poll 一次），
+    不會留下 zombie，並呼叫 on_exit(key, returncode, tail) 通知呼叫端
+  - 也可以 add() 不是自己 child 的行程（例如 zygote fork 出來的，只要有 Popen 的 pid / stdout / poll()）：
+    退出碼由別人回報，回報時呼叫 reap_soon(key)
+  - 已結束的子行程 log 保留 retain 秒，之後自動清掉
+
+不支援 selector 讀 pipe 的平台（Windows）改成每個子行程一條讀取執行緒。
+"""
+import os, selectors, socket, subprocess, threading, time, traceback
+from collections import deque
+
+class _Proc:
+    def __init__(self, key, proc, log_bytes):
+        self.key = key
+        self.proc = proc
+        self.log = bytearray()
+        self.log_bytes = log_bytes
+        self.pidfd = None
+        self.out_open = True
+        self.exited_at = None
+        self.returncode = None
+
+    def append(self, data):
+        self.log += data
+        if len(self.log) > self.log_bytes:
+            del self.log[:len(self.log) - self.log_bytes]
+
+class ProcessSupervisor:
+    def __init__(self, log_bytes=32 * 1024, on_exit=None, retain=300.0, tag="Supervisor"):
+        self.log_bytes = log_bytes
+        self.on_exit = on_exit
+        self.retain = retain
+        self.tag = tag
+        self._lock = threading.Lock()
+        self._procs = {}       # key -> _Proc
+        self._ops = deque()
+        self._sel = None
+        self._wake = None
+        self.reaped = 0
+
+    # ----------------- 對外 API ----------------- #
+
+    def spawn(self, key, args, **kw) -> subprocess.Popen:
+        """跟 subprocess.Popen 一樣，但 stdout / stderr 固定接到監管的 pipe"""
+        kw["stdout"] = subprocess.PIPE
+        kw["stderr"] = subprocess.STDOUT
+        proc = subprocess.Popen(args, **kw)
+        self.add(key, proc)
+        return proc
+
+    def add(self, key, proc: subprocess.Popen):
+        entry = _Proc(key, proc, self.log_bytes)
+        with self._lock:
+            self._procs[key] = entry
+        if os.name != "posix":
+            threading.Thread(target=self._drain_blocking, args=(entry,),
+                             name=f"drain-{key}", daemon=True).start()
+            return
+        self._post(("add", entry))
+
+    def reap_soon(self, key):
+        """key 的行程已經結束（退出碼由別人回報）：請 selector 執行緒馬上回收，不等每秒的 poll"""
+        with self._lock:
+            entry = self._procs.get(key)
+        if entry is not None and os.name == "posix":
+            self._post(("reap", entry))
+
+    def get(self, key):
+        """key 還在跑的行程；已結束或不存在回傳 None"""
+        with self._lock:
+            entry = self._procs.get(key)
+        return entry.proc if entry is not None and entry.exited_at is None else None
+
+    def log_tail(self, key, max_bytes=None) -> str:
+        with self._lock:
+            entry = self._procs.get(key)
+            if entry is None:
+                return ""
+            data = bytes(entry.log if max_bytes is None else entry.log[-max_bytes:])
+        return data.decode("utf-8", errors="replace")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "running": sum(1 for e in self._procs.values() if e.exited_at is None),
+                "exited": sum(1 for e in self._procs.values() if e.exited_at is not None),
+                "reaped": self.reaped,
+                "log_bytes": sum(len(e.log) for e in self._procs.values()),
+            }
+
+    # ----------------- selector 執行緒 ----------------- #
+
+    def _post(self, op):
+        with self._lock:
+            if self._sel is None:
+                self._sel = selectors.DefaultSelector()
+                self._wake = socket.socketpair()
+                self._wake[0].setblocking(False)
+                self._sel.register(self._wake[0], selectors.EVENT_READ, None)
+                threading.Thread(target=self._loop, name=f"{self.tag.lower()}", daemon=True).start()
+            self._ops.append(op)
+        try:
+            self._wake[1].send(b"\0")
+        except OSError:
+            pass
+
+    def _register(self, entry):
+        out = entry.proc.stdout
+        os.set_blocking(out.fileno(), False)
+        self._sel.register(out.fileno(), selectors.EVENT_READ, ("out", entry))
+        if hasattr(os, "pidfd_open") and isinstance(entry.proc, subprocess.Popen):
+            try:
+                entry.pidfd = os.pidfd_open(entry.proc.pid)
+                self._sel.register(entry.pidfd, selectors.EVENT_READ, ("exit", entry))
+            except OSError:
+                entry.pidfd = None   # 子行程已經結束 / kernel 不支援：靠 EOF + poll
+
+    def _loop(self):
+        sel = self._sel
+        last_sweep = time.monotonic()
+        while True:
+            try:
+                for key, _ in sel.select(timeout=1.0):
+                    if key.data is None:
+                        try:
+                            while key.fileobj.recv(4096):
+                                pass
+                        except (BlockingIOError, OSError):
+                            pass
+                        continue
+                    kind, entry = key.data
+                    if kind == "out":
+                        self._read_out(entry)
+                    else:
+                        self._reap(entry)
+
+                while self._ops:
+                    op, entry = self._ops.popleft()
+                    if op == "add":
+                        self._register(entry)
+                    else:
+                        self._reap(entry)
+
+                now = time.monotonic()
+                if now - last_sweep >= 1.0:
+                    last_sweep = now
+                    self._sweep(now)
+            except Exception as e:
+                print(f"[{self.tag}] loop error: {e}", flush=True)
+                traceback.print_exc()
+
+    def _read_out(self, entry):
+        fd = entry.proc.stdout.fileno()
+        while True:
+            try:
+                data = os.read(fd, 65536)
+            except BlockingIOError:
+                return
+            except OSError:
+                data = b""
+            if not data:
+                self._close_out(entry)
+                if entry.pidfd is None:
+                    # 沒有 pidfd：stdout 關了通常就是結束了；還沒結束的交給 _sweep 每秒 poll
+                    self._reap(entry)
+                return
+            with self._lock:
+                entry.append(data)
+
+    def _close_out(self, entry):
+        if not entry.out_open:
+            return
+        entry.out_open = False
+        try:
+            self._sel.unregister(entry.proc.stdout.fileno())
+        except (KeyError, ValueError):
+            pass
+        entry.proc.stdout.close()
+
+    def _reap(self, entry):
+        if entry.exited_at is not None or entry.proc.poll() is None:
+            return
+        if entry.out_open:
+            self._read_out(entry)   # 把結束前最後的輸出讀完
+            if entry.exited_at is not None:
+                return
+        if entry.pidfd is not None:
+            try:
+                self._sel.unregister(entry.pidfd)
+            except (KeyError, ValueError):
+                pass
+            os.close(entry.pidfd)
+            entry.pidfd = None
+        self._exited(entry)
+
+    def _exited(self, entry):
+        with self._lock:
+            entry.returncode = entry.proc.returncode
+            entry.exited_at = time.monotonic()
+            self.reaped += 1
+            tail = bytes(entry.log[-2048:]).decode("utf-8", errors="replace")
+        if self.on_exit is not None:
+            try:
+                self.on_exit(entry.key, entry.returncode, tail)
+            except Exception as e:
+                print(f"[{self.tag}] on_exit error for {entry.key}: {e}", flush=True)
+
+    def _sweep(self, now):
+        with self._lock:
+            entries = list(self._procs.values())
+        for entry in entries:
+            if entry.exited_at is None:
+                if entry.pidfd is None and entry.proc.poll() is not None:
+                    self._reap(entry)
+            elif now - entry.exited_at > self.retain:
+                with self._lock:
+                    if self._procs.get(entry.key) is entry:
+                        del self._procs[entry.key]
+
+    # ----------------- 沒有 selector 的平台 ----------------- #
+
+    def _drain_blocking(self, entry):
+        out = entry.proc.stdout
+        for chunk in iter(lambda: out.read1(65536), b""):
+            with self._lock:
+                entry.append(chunk)
+        out.close()
+        entry.out_open = False
+        entry.proc.wait()
+        self._exited(entry)
@@ -0,0 +1,74 @@
+# server/common/timers.py
+"""
+以 min-heap 排程的計時器（給房間逾時 / 延遲刪除等用）：
+
+  - call_at / call_later 把 (時間, key) 放進 heap，一條執行緒睡到最早的 deadline 才醒來，
+    每次只處理已經到期的項目（O(到期數 · log n)），不再定期掃過所有房間
+  - 同一個 key 重新排程會取代舊的（舊項目留在 heap 裡，到期時發現版本不符就略過）；cancel(key) 同理
+  - callback 在計時器執行緒上執行，應該很快做完（DB 更新 + 廣播）；丟出的例外只會被記錄
+"""
+import heapq, itertools, threading, time, traceback
+
+class TimerHeap:
+    def __init__(self, tag="Timers"):
+        self.tag = tag
+        self._heap = []            # (when, seq, key, fn, args)
+        self._live = {}            # key -> 目前有效的 seq
+        self._seq = itertools.count()
+        self._cv = threading.Condition()
+        self._thread = None
+        self.fired = 0
+
+    def call_at(self, key, when, fn, *args):
+        """在 time.monotonic() == when 時執行 fn(*args)；key 已經有排程就取代它"""
+        with self._cv:
+            seq = next(self._seq)
+            self._live[key] = seq
+            heapq.heappush(self._heap, (when, seq, key, fn, args))
+            if len(self._heap) > 2 * len(self._live) + 1024:
+                # 被取代的舊項目太多：重建一次 heap
+                self._heap = [e for e in self._heap if self._live.get(e[2]) == e[1]]
+                heapq.heapify(self._heap)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=self.tag.lower(), daemon=True)
+                self._thread.start()
+            if self._heap[0][1] == seq:
+                self._cv.notify()     # 新的最早 deadline：叫醒執行緒重新計算睡眠時間
+
+    def call_later(self, key, delay, fn, *args):
+        self.call_at(key, time.monotonic() + delay, fn, *args)
+
+    def cancel(self, key):
+        with self._cv:
+            self._live.pop(key, None)
+
+    def pending(self, key) -> bool:
+        with self._cv:
+            return key in self._live
+
+    def stats(self) -> dict:
+        with self._cv:
+            return {"pending": len(self._live), "heap": len(self._heap), "fired": self.fired}
+
+    def _loop(self):
+        while True:
+            with self._cv:
+                while True:
+                    # 丟掉已經被取消 / 取代的項目
+                    while self._heap and self._live.get(self._heap[0][2]) != self._heap[0][1]:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cv.wait()
+                        continue
+                    delay = self._heap[0][0] - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cv.wait(delay)
+                _, _, key, fn, args = heapq.heappop(self._heap)
+                del self._live[key]
+                self.fired += 1
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"[{self.tag}] timer {key!r} error: {e}", flush=True)
+                traceback.print_exc()
@@ -0,0 +1,313 @@
+# server/common/zygote.py
+"""
+遊戲伺服器的 zygote（預熱好的 fork server），一個 (遊戲, 版本) 一個：
+
+  - zygote 行程啟動時先 import 常用模組（asyncio / json / socket ...）與 manifest 的 "preload"，
+    並把 entry_server 編譯好；之後每開一個房間只要 fork 一次，
+    不用再付一次直譯器啟動 + import 的時間，import 進來的東西也靠 copy-on-write 共用記憶體
+  - 房間專屬的環境變數（GAME_PORT、ROOM_ID ...）在 fork 之後才套用
+  - lobby 要交給遊戲的 fd（stdout pipe、GAME_READY_FD、GAME_LISTEN_FD）走 SCM_RIGHTS 傳給 zygote，
+    子行程裡的環境變數會改成 zygote 收到的 fd 號碼
+  - 子行程是 zygote 的 child：由 zygote 回收並把退出碼回報給 lobby（ZygoteProc.poll() / wait()）
+
+只支援 POSIX（需要 fork 與 SCM_RIGHTS）；呼叫端失敗時請退回一般的 subprocess.Popen。
+這個檔案同時也是 zygote 行程本身的程式（python zygote.py <entry> [preload ...]）。
+"""
+import json, os, queue, select, signal, socket, subprocess, sys, threading
+
+MAX_MSG = 64 * 1024
+PRELOAD = ("asyncio", "json", "socket", "threading", "selectors", "argparse",
+           "random", "typing", "struct", "dataclasses", "subprocess", "traceback")
+
+# ================= lobby 端 ================= #
+
+class ZygoteProc:
+    """zygote fork 出來的遊戲伺服器，提供 supervisor / lobby 會用到的 subprocess.Popen 介面"""
+
+    def __init__(self, zygote, pid, stdout, on_exit=None):
+        self.zygote = zygote
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+        self.on_exit = on_exit
+        self._done = threading.Event()
+
+    def poll(self):
+        if self.returncode is None and not self.zygote.alive():
+            # zygote 不在了就沒人回報退出碼：行程消失就當成 -1
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self._exited(-1)
+            except PermissionError:
+                pass
+        return self.returncode
+
+    def wait(self, timeout=None):
+        if not self._done.wait(timeout):
+            if self.poll() is None:
+                raise subprocess.TimeoutExpired(f"zygote child {self.pid}", timeout)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def _exited(self, code):
+        if self.returncode is not None:
+            return
+        self.returncode = code
+        self._done.set()
+        if self.on_exit is not None:
+            try:
+                self.on_exit()
+            except Exception as e:
+                print(f"[Zygote] on_exit error for pid {self.pid}: {e}", flush=True)
+
+class Zygote:
+    def __init__(self, cwd, entry, preload=(), tag="Zygote"):
+        self.cwd = str(cwd)
+        self.entry = entry
+        self.tag = tag
+        self.last_used = 0.0
+        self._sock, child = _socketpair()
+        env = os.environ.copy()
+        env["ZYGOTE_FD"] = str(child.fileno())
+        try:
+            self.proc = subprocess.Popen(
+                [sys.executable, os.path.abspath(__file__), entry, *preload],
+                cwd=self.cwd, env=env, stdin=subprocess.DEVNULL, pass_fds=(child.fileno(),),
+            )
+        except Exception:
+            self._sock.close()
+            raise
+        finally:
+            child.close()
+        self._lock = threading.Lock()      # 一次只送一個 spawn，回覆照順序對應
+        self._replies = queue.Queue()
+        self._mu = threading.Lock()
+        self._children = {}                # pid -> ZygoteProc
+        self._early = {}                   # pid -> 退出碼（回報比 spawn() 登記還早到）
+        self._closed = False               # close() 之後不再 fork
+        self._dead = False                 # zygote 已經結束（不會再有退出碼回報）
+        threading.Thread(target=self._reader, name=f"{tag.lower()}-reader", daemon=True).start()
+
+    def alive(self) -> bool:
+        return not self._dead
+
+    def spawn(self, env: dict, fds: dict = None, on_exit=None, timeout=5.0) -> ZygoteProc:
+        """
+        fork 一個遊戲伺服器。env 是要覆蓋的環境變數；fds 是 {環境變數名稱: fd}，
+        子行程裡那個環境變數會改成它拿到的 fd 號碼（呼叫端自己的 fd 照舊由呼叫端關閉）。
+        """
+        fds = dict(fds or {})
+        out_r, out_w = os.pipe()
+        try:
+            msg = json.dumps({"env": env, "fds": list(fds)}).encode("utf-8")
+            with self._lock:
+                if self._closed:
+                    raise OSError("zygote 已結束")
+                socket.send_fds(self._sock, [msg], [out_w, *fds.values()])
+                try:
+                    reply = self._replies.get(timeout=timeout)
+                except queue.Empty:
+                    raise OSError("zygote 沒有回應")
+                if "pid" not in reply:
+                    raise OSError(reply.get("error") or "zygote fork 失敗")
+                proc = ZygoteProc(self, reply["pid"], os.fdopen(out_r, "rb"), on_exit)
+        except Exception:
+            os.close(out_r)
+            raise
+        finally:
+            os.close(out_w)
+        with self._mu:
+            code = self._early.pop(proc.pid, None)
+            if code is None:
+                self._children[proc.pid] = proc
+        if code is not None:
+            proc._exited(code)
+        return proc
+
+    def close(self):
+        """
+        不再 fork 新房間。已經在跑的遊戲不受影響：zygote 收到空訊息後等它們都結束、
+        回報完退出碼才離開。
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            try:
+                self._sock.send(b"")
+            except OSError:
+                pass
+
+    # ---- reader 執行緒：spawn 的回覆照順序交給 spawn()，退出碼交給 ZygoteProc ---- #
+
+    def _reader(self):
+        while True:
+            try:
+                data = self._sock.recv(MAX_MSG)
+            except OSError:
+                data = b""
+            if not data:
+                break
+            try:
+                msg = json.loads(data)
+            except ValueError:
+                continue
+            if "exit" in msg:
+                with self._mu:
+                    proc = self._children.pop(msg["exit"], None)
+                    if proc is None:
+                        self._early[msg["exit"]] = msg["code"]
+                if proc is not None:
+                    proc._exited(msg["code"])
+            else:
+                self._replies.put(msg)
+        self._closed = self._dead = True
+        self._replies.put({"error": "zygote 已結束"})
+        print(f"[{self.tag}] zygote for {self.cwd} exited", flush=True)
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            pass
+        self._sock.close()
+
+def _socketpair():
+    # SOCK_SEQPACKET：保留訊息邊界，對方關閉時也讀得到 EOF。
+    # DGRAM 收不到 EOF（zygote 死掉時 reader 會一直等），不支援的平台（macOS）直接失敗、改用 Popen
+    if not hasattr(socket, "SOCK_SEQPACKET"):
+        raise OSError("平台不支援 SOCK_SEQPACKET，無法使用 zygote")
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+# ================= zygote 行程 ================= #
+
+def _preload(modules):
+    import importlib
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"[Zygote] preload {name} 失敗：{e}", flush=True)
+
+def _serve(ctrl):
+    """
+    fork server 主迴圈。在 fork 出來的子行程裡回傳 (request, fds)；
+    zygote 本身在 lobby 要它結束、且 fork 出去的遊戲都回收完之後回傳 None。
+    """
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *a: None)
+
+    parent = os.getppid()
+    children = set()
+    accepting = True
+    while accepting or children:
+        try:
+            ready, _, _ = select.select([ctrl, wake_r] if accepting else [wake_r], [], [], 5.0)
+        except InterruptedError:
+            ready = []
+        if os.getppid() != parent:
+            return None     # lobby 不在了，沒有人要收退出碼
+        if wake_r in ready:
+            os.read(wake_r, 4096)
+        _reap(ctrl, children)
+        if ctrl not in ready:
+            continue
+
+        try:
+            msg, fds, _, _ = socket.recv_fds(ctrl, MAX_MSG, 16)
+        except OSError:
+            msg, fds = b"", []
+        if not msg:
+            # lobby 不再用這個 zygote：不接新房間，但還在跑的遊戲要等它們結束、回報完退出碼
+            accepting = False
+            continue
+        try:
+            req = json.loads(msg)
+            pid = os.fork()
+        except Exception as e:
+            for fd in fds:
+                os.close(fd)
+            _send(ctrl, {"error": str(e)})
+            continue
+
+        if pid == 0:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            os.close(wake_r)
+            os.close(wake_w)
+            ctrl.close()
+            return req, fds
+        children.add(pid)
+        for fd in fds:
+            os.close(fd)
+        _send(ctrl, {"pid": pid})
+    return None
+
+def _send(ctrl, obj):
+    try:
+        ctrl.send(json.dumps(obj).encode("utf-8"))
+    except OSError:
+        pass
+
+def _reap(ctrl, children):
+    while children:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            children.clear()
+            return
+        if pid == 0:
+            return
+        children.discard(pid)
+        _send(ctrl, {"exit": pid, "code": os.waitstatus_to_exitcode(status)})
+
+def _run_child(req, fds, entry, code):
+    """子行程：stdout / stderr 接到 lobby 的 pipe、套用房間環境變數，然後以 __main__ 執行 entry"""
+    out, rest = fds[0], fds[1:]
+    os.dup2(out, 1)
+    os.dup2(out, 2)
+    os.close(out)
+    os.environ.update(req.get("env") or {})
+    for name, fd in zip(req.get("fds") or [], rest):
+        os.environ[name] = str(fd)
+
+    import types
+    main = types.ModuleType("__main__")
+    main.__file__ = os.path.abspath(entry)
+    sys.modules["__main__"] = main
+    sys.argv = [entry]
+    exec(code, main.__dict__)
+
+def main():
+    entry, preload = sys.argv[1], sys.argv[2:]
+    ctrl = socket.socket(fileno=int(os.environ.pop("ZYGOTE_FD")))
+    # 跟直接執行 entry 一樣：遊戲資料夾放在 sys.path 最前面（不要看到 server/common）
+    sys.path[0] = os.getcwd()
+    _preload(PRELOAD + tuple(preload))
+    with open(entry, "rb") as f:
+        code = compile(f.read(), os.path.abspath(entry), "exec")
+    import gc
+    gc.freeze()     # preload 的物件不再被 GC 掃過，fork 之後比較不會被寫到而複製分頁
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    forked = _serve(ctrl)
+    if forked is None:
+        return
+    _run_child(*forked, entry, code)
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 # server/dev_server.py - 完整修正版（含版本驗證 + version_hint）
 
-import os, json, base64, socket, threading, time, traceback, zipfile, io, shutil
+import os, json, base64, socket, threading, time, traceback, zipfile, io, shutil, struct
 from pathlib import Path
 
 from common import db
 from common import auth
+from common import blobstore
+from common import catalog
+from common import aioserver
 
 ROOT = Path(__file__).resolve().parents[1]   # 專案根目錄
 SERVER_DIR = Path(__file__).resolve().parent # server/ 資料夾
@@ -68,6 +71,36 @@ def ensure_user_db():
         users = {}
         db.save(DEV_USERS_FILE, users)
 
+def migrate_inline_packages():
+    """
+    舊版把整包 zip 以 zip_b64 內嵌在 games.json 的版本紀錄裡。
+    啟動時把它們搬到 blobstore，版本紀錄只留下 {"blob": {sha256, size, path}}。
+    """
+    games = db.load(GAMES_FILE, {})
+    if not isinstance(games, dict):
+        return
+    moved = 0
+    for name, g in games.items():
+        versions = (g or {}).get("versions") or {}
+        if not any(isinstance(v, dict) and "zip_b64" in v for v in versions.values()):
+            continue
+        with db.txn(GAMES_FILE, name) as game:
+            if game is None:
+                continue
+            for ver, info in (game.get("versions") or {}).items():
+                if not isinstance(info, dict) or "zip_b64" not in info:
+                    continue
+                try:
+                    raw = base64.b64decode(info["zip_b64"].encode("utf-8"))
+                except Exception as e:
+                    print(f"[DevServer] {name}@{ver} 的 zip_b64 無法解析，保留原樣: {e}")
+                    continue
+                info["blob"] = blobstore.put_bytes(raw)
+                del info["zip_b64"]
+                moved += 1
+    if moved:
+        print(f"[DevServer] 已把 {moved} 個內嵌的遊戲包搬到 blobstore")
+
 # ----------------- 帳號相關 ----------------- #
 
 def handle_register(payload):
@@ -75,19 +108,18 @@ def handle_register(payload):
     p = payload.get("password","").strip()
     if not u or not p:
         return {"ok": False, "error": "缺少帳號或密碼"}
-    users = db.load(DEV_USERS_FILE, {})
-    if u in users:
-        return {"ok": False, "error": "帳號已被使用"}
-    users[u] = {"password": p}
-    db.save(DEV_USERS_FILE, users)
+    with db.txn(DEV_USERS_FILE, u, default={}) as rec:
+        if rec:
+            return {"ok": False, "error": "帳號已被使用"}
+        rec["password"] = p
     return {"ok": True, "msg": "註冊成功"}
 
 def handle_login(payload):
     u = payload.get("username","").strip()
     p = payload.get("password","").strip()
-    users = db.load(DEV_USERS_FILE, {})
+    rec = db.get(DEV_USERS_FILE, u) if u else None
 
-    if u not in users or users[u].get("password") != p:
+    if not rec or rec.get("password") != p:
         return {"ok": False, "error": "帳號或密碼錯誤"}
 
     token = auth.issue_token(u, role="developer")
@@ -110,121 +142,213 @@ def handle_logout(payload):
 
 # ----------------- 上傳 / 版本管理 ----------------- #
 
-def _extract_upload(name, version, zip_b64):
-    try:
-        raw = base64.b64decode(zip_b64.encode("utf-8"))
-    except Exception as e:
-        return False, f"zip base64 解析失敗: {e}"
+# upload_game_stream：每個 chunk 前面 4 bytes（big-endian）長度，長度 0 代表結束
+STREAM_CHUNK_MAX = 4 * 1024 * 1024
+UPLOAD_MAX_BYTES = 1024 * 1024 * 1024
+# 舊的 upload_game 把整包 base64 放在同一行 request 裡，整行都得先收進記憶體：只接受到這麼大，
+# 更大的遊戲請用 upload_game_stream（developer client 預設就是）
+LEGACY_REQUEST_MAX_BYTES = 64 * 1024 * 1024
+
+def _extract_upload(name, version, src):
+    """src：zip 檔路徑或 file-like（zipfile 會自己分段讀，不需要整包進記憶體）"""
     dst = UPLOADED_DIR / name / version
     if dst.exists():
         shutil.rmtree(dst)
     dst.mkdir(parents=True, exist_ok=True)
     try:
-        with zipfile.ZipFile(io.BytesIO(raw), "r") as z:
+        with zipfile.ZipFile(src, "r") as z:
             z.extractall(dst)
         print(f"[DevServer] 已解壓遊戲到: {dst}")
         return True, str(dst)
     except Exception as e:
         return False, f"zip 解壓失敗: {e}"
 
-def handle_upload_game(payload):
+def _check_upload_header(payload):
     """
-    上傳/更新遊戲：
-      - 版本格式必須是 major.minor.patch（例如 1.0.3）
-      - 若遊戲已存在，新的版本號必須「嚴格大於」目前 latest
+    兩種上傳共用的欄位檢查。
+    回傳 (developer, name, version, manifest, None)，失敗時最後一項是錯誤回應。
     """
     token = payload.get("token")
     tokinfo = auth.verify_token(token, role="developer")
     if not tokinfo:
-        return {"ok": False, "error": "未登入"}
+        return None, None, None, None, {"ok": False, "error": "未登入"}
     developer = tokinfo["user"]
 
     name = payload.get("name","").strip()
     version = payload.get("version","").strip()
     manifest = payload.get("manifest", {})
-    zip_b64 = payload.get("zip_b64","")
 
-    if not name or not version or not manifest or not zip_b64:
-        return {"ok": False, "error": "缺少必要欄位"}
+    if not name or not version or not manifest:
+        return None, None, None, None, {"ok": False, "error": "缺少必要欄位"}
 
-    # 1) 檢查版本格式
+    # 檢查版本格式
     if not parse_version(version):
-        return {
+        return None, None, None, None, {
             "ok": False,
             "error": "版本格式錯誤，需為：major.minor.patch（例如 1.0.3）。",
             "suggested": "1.0.0"
         }
+    return developer, name, version, manifest, None
 
-    games = db.load(GAMES_FILE, {})
-    if not isinstance(games, dict):
-        games = {}
-
-    game = games.get(name)
-
+def _check_update_allowed(game, developer, version):
+    """已存在的遊戲：驗證作者 + 版本必須嚴格遞增。可以上傳回傳 None，否則回傳錯誤回應"""
     if not game:
-        # 全新遊戲
-        game = {
-            "name": name,
-            "author": developer,
-            "status": "active",
-            "versions": {},   # {version_str: {...}}
-            "latest": version,
-            "reviews": []
+        return None
+    if game.get("author") != developer:
+        return {"ok": False, "error": "不是此遊戲作者，無法更新"}
+
+    current_latest = game.get("latest")
+    if current_latest:
+        if not parse_version(current_latest):
+            # DB 裡有奇怪格式，保守處理：禁止更新，請人工修正
+            return {
+                "ok": False,
+                "error": f"目前 DB 中 latest 版本號格式異常：{current_latest}，請聯絡助教或手動修正 games.json。"
+            }
+        # 版本必須嚴格遞增
+        if not version_greater(version, current_latest):
+            suggested = suggest_next_version(current_latest)
+            return {
+                "ok": False,
+                "error": f"目前最新版本為 {current_latest}，新的版本號必須大於目前版本。",
+                "latest": current_latest,
+                "suggested": suggested
+            }
+    return None
+
+def _publish_version(developer, name, version, manifest, blob):
+    """遊戲包已經存進 blobstore 之後：解壓到 uploaded_games 並更新 games.json"""
+    # 只鎖這款遊戲：同一款遊戲的上傳互相排隊，不影響其他遊戲或 rooms.json
+    with db.txn(GAMES_FILE, name, default={}) as game:
+        if not game:
+            # 全新遊戲
+            game.update({
+                "name": name,
+                "author": developer,
+                "status": "active",
+                "versions": {},   # {version_str: {...}}
+                "latest": version,
+                "reviews": []
+            })
+        else:
+            err = _check_update_allowed(game, developer, version)
+            if err:
+                return err
+
+        # 實際解壓 ZIP 檔到 uploaded_games
+        ok, msg = _extract_upload(name, version, blobstore.path_of(blob["sha256"]))
+        # 不論成功與否資料夾都動過了，直接更新 lobby 的遊戲索引
+        catalog.invalidate(UPLOADED_DIR, name)
+        if not ok:
+            # 新遊戲解壓失敗時 game 只是暫存的預設內容，清空後離開 txn 就不會寫入
+            if game.get("versions") == {}:
+                game.clear()
+            return {"ok": False, "error": msg}
+
+        # 一旦有新版本上傳，將遊戲狀態重新設為 active
+        game["status"] = "active"
+
+        # 更新 DB：版本列表 + latest
+        if "versions" not in game or not isinstance(game["versions"], dict):
+            game["versions"] = {}
+
+        # 遊戲包存成 content-addressed 檔案，DB 只記 hash / 大小 / 路徑
+        game["versions"][version] = {
+            "manifest": manifest,
+            "blob": blob,
+            "uploaded_at": int(time.time())
         }
-    else:
-        # 已存在遊戲 → 驗證作者 + 狀態
-        if game.get("author") != developer:
-            return {"ok": False, "error": "不是此遊戲作者，無法更新"}
-
-        if game.get("status") != "active":
-            # 一旦有新版本上傳，將遊戲狀態重新設為 active
-            game["status"] = "active"
-
-        current_latest = game.get("latest")
-        if current_latest:
-            if not parse_version(current_latest):
-                # DB 裡有奇怪格式，保守處理：禁止更新，請人工修正
-                return {
-                    "ok": False,
-                    "error": f"目前 DB 中 latest 版本號格式異常：{current_latest}，請聯絡助教或手動修正 games.json。"
-                }
-            # 版本必須嚴格遞增
-            if not version_greater(version, current_latest):
-                suggested = suggest_next_version(current_latest)
-                return {
-                    "ok": False,
-                    "error": f"目前最新版本為 {current_latest}，新的版本號必須大於目前版本。",
-                    "latest": current_latest,
-                    "suggested": suggested
-                }
-
-    # 2) 實際解壓 ZIP 檔到 uploaded_games
-    ok, msg = _extract_upload(name, version, zip_b64)
-    if not ok:
-        return {"ok": False, "error": msg}
-
-    # 3) 更新 DB：版本列表 + latest
-    if "versions" not in game or not isinstance(game["versions"], dict):
-        game["versions"] = {}
-
-    game["versions"][version] = {
-        "manifest": manifest,
-        "zip_b64": zip_b64
-    }
-    game["latest"] = version
-
-    games[name] = game
-    db.save(GAMES_FILE, games)
+        game["latest"] = version
 
-    print(f"[DevServer] 遊戲 {name}@{version} 上傳成功，status={game['status']}")
+    print(f"[DevServer] 遊戲 {name}@{version} 上傳成功，status={game['status']}, size={blob['size']}")
     return {
         "ok": True,
         "msg": "上傳/更新成功",
         "name": name,
         "latest": version,
-        "status": game["status"]
+        "status": game["status"],
+        "sha256": blob["sha256"]
     }
 
+def handle_upload_game(payload):
+    """
+    上傳/更新遊戲（舊協定：整包 zip 以 base64 放在 JSON 的 zip_b64）：
+      - 版本格式必須是 major.minor.patch（例如 1.0.3）
+      - 若遊戲已存在，新的版本號必須「嚴格大於」目前 latest
+    """
+    developer, name, version, manifest, err = _check_upload_header(payload)
+    if err:
+        return err
+    zip_b64 = payload.get("zip_b64","")
+    if not zip_b64:
+        return {"ok": False, "error": "缺少必要欄位"}
+
+    try:
+        raw = base64.b64decode(zip_b64.encode("utf-8"))
+    except Exception as e:
+        return {"ok": False, "error": f"zip base64 解析失敗: {e}"}
+
+    return _publish_version(developer, name, version, manifest, blobstore.put_bytes(raw))
+
+def _send_json(conn, obj):
+    conn.sendall((json.dumps(obj, ensure_ascii=False) + "\n").encode("utf-8"))
+
+def _recv_exact(conn, n, pending: bytearray):
+    """先用 header 之後多收到的 pending，不夠再從 socket 讀，剛好拿 n bytes"""
+    if len(pending) >= n:
+        out = bytes(pending[:n])
+        del pending[:n]
+        return out
+    out = bytearray(pending)
+    pending.clear()
+    while len(out) < n:
+        chunk = conn.recv(min(n - len(out), 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("上傳中途連線中斷")
+        out += chunk
+    return bytes(out)
+
+def handle_upload_game_stream(payload, conn, pending: bytearray):
+    """
+    串流上傳（不經 base64、不整包放記憶體）：
+      1. client 送 JSON header（kind=upload_game_stream, token, name, version, manifest, 可選 size / sha256）
+      2. server 先檢查帳號 / 版本，回 {"ok": true, "ready": true}（失敗直接回錯誤並結束）
+      3. client 送 [4 bytes 長度][資料] ...，最後送長度 0
+      4. server 邊收邊寫暫存檔、累加 sha256，收完才存進 blobstore 並更新 games.json，回最終結果
+    """
+    developer, name, version, manifest, err = _check_upload_header(payload)
+    if err:
+        return err
+    # 先做一次（不上鎖的）版本檢查，避免收完整包才發現版本號不對；正式寫入時會再檢查一次
+    err = _check_update_allowed(db.get(GAMES_FILE, name), developer, version)
+    if err:
+        return err
+
+    _send_json(conn, {"ok": True, "ready": True})
+
+    with blobstore.BlobWriter() as w:
+        while True:
+            (n,) = struct.unpack(">I", _recv_exact(conn, 4, pending))
+            if n == 0:
+                break
+            if n > STREAM_CHUNK_MAX:
+                raise ValueError(f"chunk 過大：{n} bytes")
+            if w.size + n > UPLOAD_MAX_BYTES:
+                raise ValueError("遊戲包超過大小上限")
+            w.write(_recv_exact(conn, n, pending))
+
+        expect_size = payload.get("size")
+        expect_sha = payload.get("sha256")
+        if expect_size is not None and expect_size != w.size:
+            w.abort()
+            return {"ok": False, "error": f"收到 {w.size} bytes，與宣告的 {expect_size} bytes 不符"}
+        if expect_sha and expect_sha != w.sha256:
+            w.abort()
+            return {"ok": False, "error": "sha256 驗證失敗，檔案在傳輸中損毀"}
+        blob = w.commit()
+
+    return _publish_version(developer, name, version, manifest, blob)
+
 # ----------------- 下架 / 查詢遊戲 ----------------- #
 
 def handle_remove_game(payload):
@@ -235,16 +359,13 @@ def handle_remove_game(payload):
     developer = tokinfo["user"]
     name = payload.get("name","").strip()
 
-    games = db.load(GAMES_FILE, {})
-    if name not in games:
-        return {"ok": False, "error": "遊戲不存在"}
-    game = games[name]
-    if game.get("author") != developer:
-        return {"ok": False, "error": "無權限下架此遊戲"}
+    with db.txn(GAMES_FILE, name) as game:
+        if game is None:
+            return {"ok": False, "error": "遊戲不存在"}
+        if game.get("author") != developer:
+            return {"ok": False, "error": "無權限下架此遊戲"}
+        game["status"] = "removed"
 
-    game["status"] = "removed"
-    games[name] = game
-    db.save(GAMES_FILE, games)
     return {
         "ok": True,
         "msg": "已下架。此遊戲不再出現在商城列表，且無法建立新房間。",
@@ -255,7 +376,7 @@ def handle_remove_game(payload):
 def handle_my_games(payload):
     """
     回傳開發者自己的遊戲列表，並把版本排序好（從小到大）。
-    ⭐ 只回傳精簡資訊，不包含完整 manifest 和 zip_b64。
+    ⭐ 只回傳精簡資訊，不包含完整 manifest 和遊戲包資訊。
     """
     token = payload.get("token")
     tokinfo = auth.verify_token(token, role="developer")
@@ -314,11 +435,7 @@ def handle_version_hint(payload):
     if not name:
         return {"ok": False, "error": "缺少遊戲名稱"}
 
-    games = db.load(GAMES_FILE, {})
-    if not isinstance(games, dict):
-        games = {}
-
-    game = games.get(name)
+    game = db.get(GAMES_FILE, name)
     if not game:
         # 完全沒有這款遊戲 → 視為新遊戲
         return {
@@ -353,42 +470,74 @@ def handle_version_hint(payload):
 
 # ----------------- Server 迴圈 ----------------- #
 
+HANDLERS = {
+    "register": handle_register,
+    "login": handle_login,
+    "upload_game": handle_upload_game,
+    "remove_game": handle_remove_game,
+    "logout": handle_logout,
+    "my_games": handle_my_games,
+    "version_hint": handle_version_hint,
+}
+
+def _dispatch(req):
+    kind = req.get("kind")
+    handler = HANDLERS.get(kind)
+    if handler is None:
+        return {"ok": False, "error": f"unknown kind: {kind}"}
+    return handler(req)
+
+async def _session_request(conn, req):
+    if req.get("kind") == "upload_game_stream":
+        return {"ok": False, "error": "串流上傳請使用獨立連線"}
+    return await conn.run(_dispatch, req)
+
+async def _handle_request_async(conn, line):
+    """serve_async 的單一連線；串流上傳在 header 之後的資料留在 StreamReader 裡，由 conn.recv 讀"""
+    req = json.loads(line.decode("utf-8"))
+    if req.get("kind") == "session":
+        # session 模式：同一條連線上持續收 request（帶 id），回應不保證順序
+        await conn.send_json({"ok": True, "session": True})
+        await aioserver.run_session(conn, lambda r: _session_request(conn, r))
+        return
+    if req.get("kind") == "upload_game_stream":
+        resp = await conn.run(handle_upload_game_stream, req, conn, bytearray())
+    else:
+        resp = await conn.run(_dispatch, req)
+    await conn.send_json(resp)
+
 def _handle_conn(conn, addr):
     try:
-        data = b""
+        # bytearray 累積（避免 bytes += 的重複複製）；換行之後多收到的資料留給串流上傳用
+        data = bytearray()
         while True:
-            chunk = conn.recv(4096)
+            chunk = conn.recv(65536)
             if not chunk:
                 break
             data += chunk
-            if b"\n" in data:
+            if b"\n" in chunk:
                 break
+            if len(data) > LEGACY_REQUEST_MAX_BYTES:
+                _send_json(conn, {"ok": False, "error": f"request 超過 {LEGACY_REQUEST_MAX_BYTES} bytes"})
+                return
         if not data:
             conn.close()
             return
 
-        line = data.split(b"\n",1)[0].decode("utf-8")
+        nl = data.find(b"\n")
+        line = bytes(data[:nl] if nl >= 0 else data).decode("utf-8")
+        pending = data[nl + 1:] if nl >= 0 else bytearray()
         req = json.loads(line)
         kind = req.get("kind")
 
-        if kind == "register":
-            resp = handle_register(req)
-        elif kind == "login":
-            resp = handle_login(req)
-        elif kind == "upload_game":
-            resp = handle_upload_game(req)
-        elif kind == "remove_game":
-            resp = handle_remove_game(req)
-        elif kind == "logout":
-            resp = handle_logout(req)
-        elif kind == "my_games":
-            resp = handle_my_games(req)
-        elif kind == "version_hint":
-            resp = handle_version_hint(req)
+        if kind == "upload_game_stream":
+            resp = handle_upload_game_stream(req, conn, pending)
+        elif kind == "session":
+            resp = {"ok": False, "error": "session 模式需要 server.mode = asyncio"}
         else:
-            resp = {"ok": False, "error": f"unknown kind: {kind}"}
+            resp = _dispatch(req)
 
-        conn.sendall((json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
+        _send_json(conn, resp)
     except Exception as e:
         traceback.print_exc()
         try:
@@ -398,14 +547,32 @@ def _handle_conn(conn, addr):
     finally:
         conn.close()
 
-def serve(host, port, stop_event=None):
+def _startup():
     ensure_user_db()
     ensure_dirs()
+    migrate_inline_packages()
+
+async def serve_async(host, port, stop_event=None, workers=32, sock=None):
+    """event loop 版本的 serve()：連線在 asyncio loop 上，handle_* 在 executor 執行"""
+    _startup()
+    await aioserver.serve_json_lines(
+        host, port, _handle_request_async,
+        tag="DevServer", workers=workers, stop_event=stop_event,
+        sock=sock,
+        # limit 維持預設（串流上傳要靠它做 backpressure）；舊的 upload_game 整行分段讀，上限另外算
+        max_line=LEGACY_REQUEST_MAX_BYTES,
+    )
+
+def serve(host, port, stop_event=None, sock=None):
+    _startup()
 
-    s = socket.socket()
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((host, port))
-    s.listen(128)
+    # main.py 會先 bind 好再交進來；單獨執行時才自己 bind
+    s = sock
+    if s is None:
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(128)
     s.settimeout(0.5)
 
     print(f"[DevServer] listening on {host}:{s.getsockname()[1]}")
@@ -0,0 +1,47 @@
+# server/game_sdk/lobby_game.py
+"""
+遊戲伺服器跟 lobby 溝通用的 helper（所有遊戲共用這一份，不要複製進遊戲資料夾）。
+
+lobby 與 host agent 啟動時會把 server/game_sdk 加進 PYTHONPATH（common/gamesdk.py），
+所以 lobby 開的遊戲伺服器（一般 Popen / zygote / 多房間 host / agent）都可以直接：
+
+    from lobby_game import listen_socket, notify_ready
+
+自己手動測試遊戲伺服器時：PYTHONPATH=server/game_sdk python start_server.py
+"""
+import os, socket
+
+def notify_ready(fd=None):
+    """lobby 有給 GAME_READY_FD（或 host 模式傳進來的 fd）時，listen 完成後寫一行 READY（lobby 就不必探測 port）"""
+    fd = fd if fd is not None else os.getenv("GAME_READY_FD")
+    if not fd:
+        return
+    try:
+        os.write(int(fd), b"READY\n")
+        os.close(int(fd))
+    except (OSError, ValueError):
+        pass
+
+def listen_socket(host=None, port=None, backlog=128, blocking=True):
+    """
+    lobby 有給 GAME_LISTEN_FD 時直接用它預先 bind 好的 socket（不會跟別的房間搶 port），
+    否則自己 bind host / port（預設 GAME_HOST / GAME_PORT）。blocking=False 給 asyncio 的遊戲用。
+    """
+    fd = os.getenv("GAME_LISTEN_FD")
+    if fd:
+        try:
+            sock = socket.socket(fileno=int(fd))
+            sock.setblocking(blocking)
+            return sock
+        except (OSError, ValueError):
+            pass
+    if host is None:
+        host = os.getenv("GAME_HOST", "0.0.0.0")
+    if port is None:
+        port = int(os.getenv("GAME_PORT", "0"))
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(blocking)
+    return sock
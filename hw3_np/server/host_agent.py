@@ -0,0 +1,421 @@
+# server/host_agent.py
+"""
+game host agent：在每台要跑遊戲伺服器的機器上執行，lobby 連進來請它開房（協定見 common/agents.py）。
+
+    python server/host_agent.py [--host 0.0.0.0] [--port 12700] [--public-host 140.113.17.12] [--max-rooms N] [--games-dir DIR]
+
+  - agent 會執行 lobby 送來的程式，所以一定要設定共用密碼（config.json 的 "agent_secret" 或環境變數 AGENT_SECRET），
+    lobby 連上後第一行必須是 {"op": "hello", "secret": ...}，不對就斷線；沒設定密碼 agent 不會啟動。
+    預設只 listen 127.0.0.1，其他機器的 lobby 要連進來時用 --host（或 config.json 的 "agent_host"）指定介面
+  - 連上之後每 REPORT_INTERVAL 秒（以及每次開房 / 關房）回報容量：CPU 數、load average、房間數、可用 port
+  - 遊戲檔案由 lobby 第一次在這台開這個版本時送過來，解壓到 server/agent_games/<sha256>/ 之後重複使用
+  - 開房跟 lobby 在本機開房一樣：bind 好 listening socket（listen_fd）、ready pipe（ready_fd），
+    輸出交給 supervisor；就緒 / 結束（含最後的輸出）回報給 lobby
+  - 跟 lobby 的連線斷掉時，這條連線開的房間全部收掉
+
+同一台機器可以開好幾個 agent（不同 --port）來測試多機分配。
+"""
+import argparse, hashlib, hmac, json, os, random, re, shutil, socket, subprocess, sys, tempfile, threading, time, traceback, zipfile
+from pathlib import Path
+from common import gamesdk, supervisor
+
+ROOT = Path(__file__).resolve().parents[1]
+SERVER_DIR = Path(__file__).resolve().parent
+CONF = json.loads((ROOT / "config.json").read_text(encoding="utf-8"))
+
+AGENT_PORT = 12700
+AGENT_SECRET = os.getenv("AGENT_SECRET") or CONF.get("agent_secret") or ""
+HELLO_TIMEOUT = 5.0           # 秒：連上之後多久內要送出 hello
+MAX_HELLO_BYTES = 4096
+MAX_PACKAGE_BYTES = 2 * 1024 * 1024 * 1024
+REPORT_INTERVAL = 2.0         # 秒
+ROOMS_PER_CPU = 8             # 沒指定 --max-rooms 時的上限
+GAMES_DIR = SERVER_DIR / "agent_games"
+GAME_PORT_MIN, GAME_PORT_MAX = 10000, 65535
+GAME_START_TIMEOUT = 10.0     # 秒：沒有 ready pipe 的遊戲最多探測 port 多久
+GAME_START_POLL = 0.2
+GAME_LOG_BYTES = 32 * 1024
+
+PUBLIC_HOST = None            # None：用 lobby 連進來的那個位址
+MAX_ROOMS = None
+
+SHA256_RE = re.compile(r"[0-9a-f]{64}")
+
+_rooms = {}                   # room_id -> Session
+_rooms_lock = threading.Lock()
+_install_lock = threading.Lock()
+
+def _pick_public_host():
+    manual = (os.getenv("PUBLIC_HOST") or CONF.get("public_host") or "").strip()
+    if manual:
+        return manual
+    for ip in CONF.get("public_hosts") or []:
+        try:
+            with socket.socket() as s:
+                s.bind((ip, 0))
+            return ip
+        except OSError:
+            continue
+    return None
+
+# ----------------- 容量 ----------------- #
+
+def _cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def _load():
+    try:
+        return round(os.getloadavg()[0], 2)
+    except (AttributeError, OSError):
+        return 0.0
+
+def _free_ports():
+    """遊戲 port 範圍裡還沒被 TCP socket 用掉的數量（Linux 讀 /proc/net/tcp，其他平台只扣掉房間數）"""
+    total = GAME_PORT_MAX - GAME_PORT_MIN + 1
+    used = set()
+    for name in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            with open(name) as f:
+                next(f, None)
+                for line in f:
+                    port = int(line.split()[1].rsplit(":", 1)[1], 16)
+                    if GAME_PORT_MIN <= port <= GAME_PORT_MAX:
+                        used.add(port)
+        except (OSError, ValueError, IndexError):
+            with _rooms_lock:
+                return total - len(_rooms)
+    return total - len(used)
+
+def _packages():
+    try:
+        return sorted(p.name for p in GAMES_DIR.iterdir() if p.is_dir() and not p.name.startswith("."))
+    except OSError:
+        return []
+
+def _max_rooms():
+    return MAX_ROOMS or _cpus() * ROOMS_PER_CPU
+
+def _status(host):
+    with _rooms_lock:
+        rooms = len(_rooms)
+    return {
+        "host": host,
+        "cpus": _cpus(),
+        "load": _load(),
+        "rooms": rooms,
+        "max_rooms": _max_rooms(),
+        "free_ports": _free_ports(),
+        "packages": _packages(),
+    }
+
+# ----------------- 遊戲伺服器 ----------------- #
+
+def _on_game_exit(room_id, code, tail):
+    with _rooms_lock:
+        sess = _rooms.pop(room_id, None)
+    print(f"[Agent] Game server of {room_id} exited (code={code})", flush=True)
+    if sess is not None:
+        sess.send({"closed": room_id, "code": code, "tail": tail[-1024:]})
+        sess.report()
+
+game_procs = supervisor.ProcessSupervisor(log_bytes=GAME_LOG_BYTES, on_exit=_on_game_exit, tag="AgentProcs")
+
+def _bind_game_socket():
+    s = socket.socket()
+    s.bind(("0.0.0.0", 0))
+    if GAME_PORT_MIN <= s.getsockname()[1] <= GAME_PORT_MAX:
+        s.listen(128)
+        return s
+    s.close()
+    for _ in range(20):
+        s = socket.socket()
+        try:
+            s.bind(("0.0.0.0", random.randint(GAME_PORT_MIN, GAME_PORT_MAX)))
+        except OSError:
+            s.close()
+            continue
+        s.listen(128)
+        return s
+    raise OSError("找不到可用的 port")
+
+def _watch_ready(sess, room_id, proc, port, ready_r):
+    """就緒就回報 {"ready"}；沒就緒就結束的由 _on_game_exit 回報 closed"""
+    if ready_r is not None:
+        data = b""
+        try:
+            while b"\n" not in data:
+                chunk = os.read(ready_r, 4096)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            os.close(ready_r)
+        ready = b"READY" in data
+    else:
+        ready = False
+        deadline = time.monotonic() + GAME_START_TIMEOUT
+        while not ready and proc.poll() is None and time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", port), timeout=GAME_START_POLL):
+                    ready = True
+            except OSError:
+                time.sleep(GAME_START_POLL)
+    if ready:
+        sess.send({"ready": room_id})
+
+def _install(f, sha256, size):
+    """從連線讀 size bytes 的遊戲 zip，驗證 sha256 後解壓到 GAMES_DIR/<sha256>/"""
+    GAMES_DIR.mkdir(parents=True, exist_ok=True)
+    h = hashlib.sha256()
+    with tempfile.TemporaryFile() as tmp:
+        left = size
+        while left > 0:
+            chunk = f.read(min(left, 1 << 20))
+            if not chunk:
+                raise OSError("遊戲檔案傳到一半連線中斷")
+            h.update(chunk)
+            tmp.write(chunk)
+            left -= len(chunk)
+        if h.hexdigest() != sha256:
+            print(f"[Agent] ✗ 遊戲檔案 sha256 不符，略過 {sha256}", flush=True)
+            return
+        dst = GAMES_DIR / sha256
+        with _install_lock:
+            if dst.exists():
+                return
+            work = Path(tempfile.mkdtemp(dir=GAMES_DIR, prefix=".incoming-"))
+            try:
+                tmp.seek(0)
+                with zipfile.ZipFile(tmp, "r") as z:
+                    z.extractall(work)
+                os.replace(work, dst)
+            except Exception as e:
+                # 解壓失敗只影響這個版本（開房時會回報缺少檔案），連線照常
+                shutil.rmtree(work, ignore_errors=True)
+                print(f"[Agent] ✗ 遊戲檔案解壓失敗 {sha256[:12]}：{e}", flush=True)
+                return
+    print(f"[Agent] 已安裝遊戲檔案 {sha256[:12]}（{size} bytes）", flush=True)
+
+# ----------------- lobby 連線 ----------------- #
+
+class Session:
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        # 沒指定對外位址：用 lobby 連進來的那個位址（lobby 連得到，玩家通常也連得到）
+        self.host = PUBLIC_HOST or conn.getsockname()[0]
+        self._wlock = threading.Lock()
+        self._closed = threading.Event()
+
+    def send(self, obj):
+        data = json.dumps(obj, ensure_ascii=False).encode("utf-8") + b"\n"
+        with self._wlock:
+            try:
+                self.conn.sendall(data)
+            except OSError:
+                pass
+
+    def report(self):
+        self.send({"status": _status(self.host)})
+
+    def run(self):
+        f = self.conn.makefile("rb")
+        if not self._hello(f):
+            print(f"[Agent] ✗ 拒絕 {self.addr}：沒有送出正確的 agent_secret", flush=True)
+            self.conn.close()
+            return
+        print(f"[Agent] lobby 連線：{self.addr}", flush=True)
+        self.report()
+        threading.Thread(target=self._reporter, daemon=True).start()
+        try:
+            for line in f:
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(msg, dict):
+                    continue
+                op = msg.get("op")
+                if op == "install":
+                    sha256, size = msg.get("sha256"), msg.get("size")
+                    if not _valid_sha(sha256) or type(size) is not int or not 0 < size <= MAX_PACKAGE_BYTES:
+                        # 後面跟著的 zip 有多長不知道，連線沒辦法再對齊，只能斷線
+                        print(f"[Agent] ✗ install 欄位不正確，斷開 {self.addr}", flush=True)
+                        break
+                    _install(f, sha256, size)
+                elif op == "open":
+                    self._open(msg)
+                elif op == "close":
+                    proc = self._proc(msg.get("room_id"))
+                    if proc is not None:
+                        proc.kill()
+                elif op == "logs":
+                    log = game_procs.log_tail(msg["room_id"]) if self._proc(msg.get("room_id")) else ""
+                    self.send({"id": msg.get("id"), "ok": True, "log": log})
+        except Exception as e:
+            print(f"[Agent] lobby 連線錯誤：{e}", flush=True)
+            traceback.print_exc()
+        finally:
+            self._closed.set()
+            self.conn.close()
+            self._close_rooms()
+
+    def _hello(self, f) -> bool:
+        """第一行必須是 {"op": "hello", "secret": agent_secret}"""
+        try:
+            self.conn.settimeout(HELLO_TIMEOUT)
+            msg = json.loads(f.readline(MAX_HELLO_BYTES) or b"{}")
+            self.conn.settimeout(None)
+        except (OSError, ValueError):
+            return False
+        secret = msg.get("secret") if isinstance(msg, dict) and msg.get("op") == "hello" else None
+        return isinstance(secret, str) and hmac.compare_digest(secret.encode("utf-8"), AGENT_SECRET.encode("utf-8"))
+
+    def _reporter(self):
+        while not self._closed.wait(REPORT_INTERVAL):
+            self.report()
+
+    def _proc(self, room_id):
+        if not isinstance(room_id, str):
+            return None
+        with _rooms_lock:
+            if _rooms.get(room_id) is not self:
+                return None
+        return game_procs.get(room_id)
+
+    def _close_rooms(self):
+        with _rooms_lock:
+            mine = [rid for rid, sess in _rooms.items() if sess is self]
+        print(f"[Agent] lobby {self.addr} 離線，收掉 {len(mine)} 間房", flush=True)
+        for room_id in mine:
+            proc = game_procs.get(room_id)
+            if proc is not None:
+                proc.kill()
+
+    def _open(self, msg):
+        req_id = msg.get("id")
+        room_id, sha256 = msg.get("room_id"), msg.get("sha256")
+        entry = msg.get("entry") or "start_server.py"
+        supports = msg.get("supports") or []
+        room_env = msg.get("env") or {}
+        if req_id is None:
+            return                      # 沒有 id 沒辦法回覆，lobby 也不會等
+        if not isinstance(room_id, str) or not room_id or not _valid_sha(sha256):
+            self.send({"id": req_id, "ok": False, "error": "open 缺少 room_id / sha256"})
+            return
+        cwd = GAMES_DIR / sha256
+        if (not isinstance(entry, str) or not isinstance(supports, list) or not isinstance(room_env, dict)
+                or not all(isinstance(k, str) and isinstance(v, str) for k, v in room_env.items())):
+            self.send({"id": req_id, "ok": False, "error": "open 欄位格式不正確"})
+            return
+        if not _inside(cwd, entry) or not (cwd / entry).is_file():
+            self.send({"id": req_id, "ok": False, "error": f"agent 缺少遊戲檔案（{entry}）"})
+            return
+        with _rooms_lock:
+            if room_id in _rooms:
+                error = f"房間 {room_id} 已經在這台 agent 上"
+            elif len(_rooms) >= _max_rooms():
+                error = f"agent 房間已滿（{len(_rooms)}/{_max_rooms()}）"
+            else:
+                error = None
+                _rooms[room_id] = self      # 先佔位，同時開房不會超過上限
+        if error:
+            self.send({"id": req_id, "ok": False, "error": error})
+            return
+
+        ready_r = ready_w = None
+        listen_sock = None
+        try:
+            listen_sock = _bind_game_socket()
+            port = listen_sock.getsockname()[1]
+            env = os.environ.copy()
+            env.update(room_env)
+            env["GAME_HOST"] = "0.0.0.0"
+            env["GAME_PORT"] = str(port)
+            child_fds = {}
+            if "ready_fd" in supports and os.name == "posix":
+                ready_r, ready_w = os.pipe()
+                child_fds["GAME_READY_FD"] = ready_w
+            if "listen_fd" in supports and os.name == "posix":
+                child_fds["GAME_LISTEN_FD"] = listen_sock.fileno()
+            else:
+                listen_sock.close()     # 舊遊戲自己 bind GAME_PORT
+                listen_sock = None
+            env.update({name: str(fd) for name, fd in child_fds.items()})
+            proc = game_procs.spawn(room_id, [sys.executable, entry], cwd=str(cwd), env=env,
+                                    stdin=subprocess.DEVNULL, pass_fds=list(child_fds.values()))
+        except Exception as e:
+            with _rooms_lock:
+                _rooms.pop(room_id, None)
+            if ready_r is not None:
+                os.close(ready_r)
+            self.send({"id": req_id, "ok": False, "error": f"遊戲伺服器啟動失敗：{e}"})
+            return
+        finally:
+            if ready_w is not None:
+                os.close(ready_w)
+            if listen_sock is not None:
+                listen_sock.close()
+
+        print(f"[Agent] 啟動遊戲伺服器 {room_id} on port {port}（pid {proc.pid}）", flush=True)
+        self.send({"id": req_id, "ok": True, "port": port, "pid": proc.pid, "host": self.host})
+        threading.Thread(target=_watch_ready, args=(self, room_id, proc, port, ready_r),
+                         name=f"ready-{room_id}", daemon=True).start()
+        self.report()
+
+def _valid_sha(sha256) -> bool:
+    return isinstance(sha256, str) and SHA256_RE.fullmatch(sha256) is not None
+
+def _inside(base, rel) -> bool:
+    """rel 解析後還在 base 底下（不接受 ../ 或絕對路徑）"""
+    try:
+        return (base / rel).resolve().is_relative_to(base.resolve())
+    except (OSError, ValueError):
+        return False
+
+def serve(host, port):
+    s = socket.socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.bind((host, port))
+    s.listen(16)
+    print(f"[Agent] listening on {host}:{s.getsockname()[1]}（public host：{PUBLIC_HOST or '依連線位址'}，"
+          f"{_cpus()} CPU）", flush=True)
+    try:
+        while True:
+            conn, addr = s.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=Session(conn, addr).run, daemon=True).start()
+    except KeyboardInterrupt:
+        print("[Agent] 結束", flush=True)
+    finally:
+        s.close()
+        with _rooms_lock:
+            running = list(_rooms)
+        for room_id in running:
+            proc = game_procs.get(room_id)
+            if proc is not None:
+                proc.kill()
+
+def main():
+    global PUBLIC_HOST, MAX_ROOMS, GAMES_DIR
+    ap = argparse.ArgumentParser(description="game host agent")
+    ap.add_argument("--host", default=CONF.get("agent_host", "127.0.0.1"),
+                    help="listen 的介面（預設 127.0.0.1；其他機器的 lobby 要連進來時改成對應的網卡位址）")
+    ap.add_argument("--port", type=int, default=AGENT_PORT)
+    ap.add_argument("--public-host", default=None, help="玩家連到這台機器的遊戲伺服器用的位址")
+    ap.add_argument("--max-rooms", type=int, default=None)
+    ap.add_argument("--games-dir", default=None, help=f"遊戲檔案放哪裡（預設 {GAMES_DIR}）")
+    args = ap.parse_args()
+    if not AGENT_SECRET:
+        sys.exit("[Agent] ✗ 沒有設定 agent_secret（config.json 或環境變數 AGENT_SECRET），拒絕啟動")
+    if args.games_dir:
+        GAMES_DIR = Path(args.games_dir).resolve()
+    PUBLIC_HOST = args.public_host or _pick_public_host()
+    MAX_ROOMS = args.max_rooms
+    gamesdk.export()          # 遊戲伺服器 import lobby_game 用（跟 lobby 本機開房一樣）
+    serve(args.host, args.port)
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 # server/lobby_server.py - 修正版（版本號一致性 + 遊戲結束自動 reset）
-import os, json, socket, threading, subprocess, time, random, traceback, base64, zipfile, io, re
+import os, json, socket, threading, subprocess, time, random, traceback, base64, zipfile, io, re, selectors
+from collections import deque
 from pathlib import Path
-from common import db, auth
+from common import db, auth, blobstore, catalog, aioserver, pushhub, supervisor, zygote, gamehost, timers, agents, gamesdk
+from common.catalog import normalize_version
+
+# 遊戲伺服器共用的 listen_socket / notify_ready（server/game_sdk/lobby_game.py）：
+# 放進 PYTHONPATH，之後開的遊戲伺服器 / zygote / host 行程都繼承
+gamesdk.export()
 
 # Lobby 自己的對外 host/port（讓遊戲 server 知道要打回哪裡）
 LOBBY_HOST = None
@@ -73,109 +79,243 @@ ROOMS_FILE = "rooms.json"
 UPLOADED = SERVER_DIR / "uploaded_games"
 
 # === SSE 訂閱管理 ===
-room_subscribers = {}
-subscribers_lock = threading.RLock()
+# 訂閱連線由 PushHub 統一管理：EOF / 房間刪除自動退訂，每個訂閱者的送出佇列有上限
+push_hub = pushhub.PushHub()
+
+# 每個房間的事件都有遞增的 seq。訂閱時可以選：
+#   - 完整狀態（預設，舊 client）：{"event": "room_update", "room_id", "seq", "room"}，可合併成最新一份
+#   - delta=True：{"event": "room_delta", "room_id", "seq", "set": {欄位: 新值}, "del": [欄位]}，
+#     只有變動的欄位、依序送出；重新訂閱時帶 since_seq，只補送漏掉的事件
+ROOM_EVENT_BUFFER = 64    # 每個房間保留最近幾筆 delta 給重新訂閱的人補送
+
+_room_streams = {}        # room_id -> {"seq", "room"（最後推播的狀態）, "ring": deque(delta 事件)}
+_streams_lock = threading.Lock()
 
-def subscribe_room(room_id, conn):
-    with subscribers_lock:
-        if room_id not in room_subscribers:
-            room_subscribers[room_id] = []
-        room_subscribers[room_id].append(conn)
+def _delta_topic(room_id):
+    return ("delta", room_id)
+
+def subscribe_room(room_id, conn, dedicated=False, delta=False):
+    push_hub.subscribe(_delta_topic(room_id) if delta else room_id, conn, dedicated=dedicated)
 
 def unsubscribe_room(room_id, conn):
-    with subscribers_lock:
-        if room_id in room_subscribers:
-            try:
-                room_subscribers[room_id].remove(conn)
-            except ValueError:
-                pass
+    push_hub.unsubscribe(room_id, conn)
+    push_hub.unsubscribe(_delta_topic(room_id), conn)
+
+def unsubscribe_all(conn):
+    """session 連線斷掉時，把它從所有房間的訂閱名單移除"""
+    push_hub.drop(conn)
+
+# 房間推播：呼叫端只標記「這個房間變了」，由 room-fanout 執行緒讀最新狀態、序列化一次後交給 push_hub。
+# 同一個房間在 fan-out 之前連續變動好幾次，只會推最後的狀態；handler 不會被任何 client 的 I/O 卡住。
+_dirty_rooms = set()
+_dirty_cv = threading.Condition()
+_fanout_started = False
 
 def broadcast_room_update(room_id):
-    with subscribers_lock:
-        if room_id not in room_subscribers:
-            return
-        
-        rooms = db.load(ROOMS_FILE, {})
-        if room_id not in rooms:
-            return
-        
-        room_data = rooms[room_id]
-        message = json.dumps({"event": "room_update", "room": room_data}, ensure_ascii=False)
-        
-        dead_conns = []
-        for conn in room_subscribers[room_id]:
+    """房間狀態變了（或被刪除）：排進 fan-out，不等推播完成；多行程模式下也通知其他 worker"""
+    if _bus is not None:
+        _bus_publish(room_id)
+    _mark_dirty(room_id)
+
+def _mark_dirty(room_id):
+    global _fanout_started
+    # 有 stream 的房間就算暫時沒人訂閱也要更新，之後帶 since_seq 重新訂閱的人才不會漏事件；
+    # 有人在看大廳列表時，所有房間的變動都要推
+    if room_id not in _room_streams and not push_hub.has_subscribers(room_id) and not _lobby_watched():
+        return
+    with _dirty_cv:
+        _dirty_rooms.add(room_id)
+        _dirty_cv.notify()
+        if not _fanout_started:
+            _fanout_started = True
+            threading.Thread(target=_fanout_loop, name="room-fanout", daemon=True).start()
+
+def _fanout_loop():
+    while True:
+        with _dirty_cv:
+            while not _dirty_rooms:
+                _dirty_cv.wait()
+            room_ids = list(_dirty_rooms)
+            _dirty_rooms.clear()
+        for room_id in room_ids:
             try:
-                conn.sendall((message + "\n").encode("utf-8"))
-            except Exception:
-                dead_conns.append(conn)
-        
-        for conn in dead_conns:
-            room_subscribers[room_id].remove(conn)
-
-# === 版本號處理函數 ===
-def _semver_key(v: str):
-    """改進版：正規化版本號以統一比較"""
-    # 移除所有非數字和點的字元
-    v_clean = re.sub(r'[^0-9.]', '', v)
-    parts = v_clean.split('.')
-    
-    # 補齊到至少3位，並轉換為整數
-    result = []
-    for i in range(3):
-        if i < len(parts) and parts[i]:
-            result.append(int(parts[i]))
-        else:
-            result.append(0)
-    
-    return tuple(result)
-
-def normalize_version(v: str) -> str:
-    """正規化版本號：1.01 → 1.0.1, 1.1 → 1.1.0"""
-    key = _semver_key(v)
-    return f"{key[0]}.{key[1]}.{key[2]}"
+                with _streams_lock:
+                    _advance_room(room_id, create=False)
+            except Exception as e:
+                print(f"[Lobby] fan-out error on room {room_id}: {e}", flush=True)
+
+# === 多行程 lobby（server/lobby_workers.py）===
+# 每個 worker 只推播給連到自己的訂閱者。房間在某個 worker 上變動時，room_id 經 LOBBY_BUS_FD 送到 main，
+# 再轉給其他 worker；收到的 worker 跟本機變動一樣排進 fan-out（從 DB 讀最新狀態，有變才推）。
+# 各 worker 的 seq 從不同的 ROOM_SEQ_BASE 起算：帶著別的 worker 發的 since_seq 重新訂閱，一定拿到完整房間。
+WORKER_ID = None              # None：單一行程
+ROOM_SEQ_BASE = 0
+_bus = None
+
+def attach_worker(worker_id, bus):
+    global WORKER_ID, ROOM_SEQ_BASE, _bus
+    WORKER_ID = worker_id
+    ROOM_SEQ_BASE = worker_id * 10 ** 12
+    _bus = bus
+    threading.Thread(target=_bus_reader, name="lobby-bus", daemon=True).start()
+
+def _bus_publish(room_id):
+    try:
+        _bus.send(room_id.encode("utf-8"))
+    except OSError as e:
+        print(f"[Lobby] worker bus send error: {e}", flush=True)
 
-def _scan_uploaded_games():
+def _bus_reader():
+    while True:
+        try:
+            data = _bus.recv(4096)
+        except OSError:
+            data = b""
+        if not data:
+            # main 不在了：這個 worker 也跟著結束（不然會留下沒人管的 listening socket）
+            print(f"[Lobby] worker {WORKER_ID}: bus closed, exiting", flush=True)
+            os._exit(0)
+        _mark_dirty(data.decode("utf-8", errors="replace"))
+
+def _room_diff(old, new):
+    """第一層欄位的差異：(有變動的欄位 → 新值, 被刪掉的欄位)"""
+    old = old or {}
+    changed = {k: v for k, v in new.items() if old.get(k, object()) != v}
+    removed = [k for k in old if k not in new]
+    return changed, removed
+
+def _encode_event(event):
+    return (json.dumps(event, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _advance_room(room_id, create=True):
     """
-    掃描檔案系統，回傳可用遊戲
-    同時正規化版本號以避免 1.0.1 和 1.01 被視為不同版本
+    讀房間最新狀態，跟上次推播的比較，有變才配下一個 seq 並推給兩種訂閱者（同時更新大廳目錄）。
+    呼叫端要持有 _streams_lock：讀 DB 與配 seq 在同一把鎖裡，seq 的順序就是狀態的先後。
+    回傳 stream；房間不存在（或 create=False 且還沒有 stream）回傳 None。
     """
-    games = {}
-    if not UPLOADED.exists():
-        return games
-    
-    for gdir in UPLOADED.iterdir():
-        if not gdir.is_dir(): 
-            continue
-        
-        versions_raw = []
-        version_map = {}  # {normalized: original_folder_name}
-        
-        for vdir in gdir.iterdir():
-            if vdir.is_dir() and (vdir / "manifest.json").exists():
-                raw_version = vdir.name
-                normalized = normalize_version(raw_version)
-                
-                # 如果正規化版本已存在，保留較新的資料夾
-                if normalized in version_map:
-                    print(f"[Warning] 發現重複版本號：{raw_version} 和 {version_map[normalized]} 都對應到 {normalized}")
-                    # 可選：比較修改時間，保留較新的
-                    old_path = gdir / version_map[normalized]
-                    new_path = vdir
-                    if new_path.stat().st_mtime > old_path.stat().st_mtime:
-                        version_map[normalized] = raw_version
-                else:
-                    version_map[normalized] = raw_version
-                    versions_raw.append(normalized)
-        
-        if versions_raw:
-            versions_raw.sort(key=_semver_key, reverse=True)
-            games[gdir.name] = {
-                "versions": versions_raw,
-                "latest": versions_raw[0],
-                "version_map": version_map  # 保存映射關係
-            }
-    
-    return games
+    room = db.get(ROOMS_FILE, room_id)
+    _update_directory(room_id, room)
+    if room is None:
+        # 房間已經刪除：退訂所有人（專用的訂閱連線送完剩下的事件後會被關閉，client 讀到 EOF）
+        _room_streams.pop(room_id, None)
+        push_hub.close_topic(room_id)
+        push_hub.close_topic(_delta_topic(room_id))
+        return None
+
+    st = _room_streams.get(room_id)
+    if st is None:
+        if not create:
+            return None
+        st = {"seq": ROOM_SEQ_BASE, "room": room, "ring": deque(maxlen=ROOM_EVENT_BUFFER)}
+        _room_streams[room_id] = st
+        return st
+    if room == st["room"]:
+        return st
+
+    changed, removed = _room_diff(st["room"], room)
+    st["seq"] += 1
+    st["room"] = room
+    delta = {"event": "room_delta", "room_id": room_id, "seq": st["seq"], "set": changed, "del": removed}
+    st["ring"].append(delta)
+
+    if push_hub.has_subscribers(room_id):
+        push_hub.publish(room_id, _encode_event(
+            {"event": "room_update", "room_id": room_id, "seq": st["seq"], "room": room}))
+    if push_hub.has_subscribers(_delta_topic(room_id)):
+        push_hub.publish(_delta_topic(room_id), _encode_event(delta), coalesce=False)
+    return st
+
+# === 大廳房間列表訂閱（subscribe_lobby） ===
+# 訂閱後先拿到精簡的房間目錄，之後只收 {"event": "lobby_room", "op": created / changed / closed, ...}；
+# 可以用 game 過濾。目錄只放列表需要的欄位（不含 pid 等內部資料）。
+ROOM_SUMMARY_FIELDS = ("game", "version", "host", "port", "status", "owner",
+                       "players", "ready_players", "max_players", "error")
+
+_lobby_dir = {}     # room_id -> 精簡資料（最後推播給大廳訂閱者的版本）
+_lobby_seq = 0
+_lobby_filters = {None}   # 出現過的 game 過濾條件（None = 不過濾）
+
+def _lobby_topic(game=None):
+    return ("lobby", game)
+
+def _room_summary(room):
+    return {k: room[k] for k in ROOM_SUMMARY_FIELDS if k in room}
+
+def _lobby_watched():
+    return any(push_hub.has_subscribers(_lobby_topic(g)) for g in list(_lobby_filters))
+
+def _update_directory(room_id, room):
+    """呼叫端持有 _streams_lock。精簡資料有變才推 lobby_room 事件"""
+    global _lobby_seq
+    old = _lobby_dir.get(room_id)
+    new = _room_summary(room) if room is not None else None
+    if old == new:
+        return
+    if new is None:
+        _lobby_dir.pop(room_id, None)
+        op = "closed"
+    else:
+        _lobby_dir[room_id] = new
+        op = "created" if old is None else "changed"
+    _lobby_seq += 1
+    game = (new if new is not None else old).get("game")
+    event = {"event": "lobby_room", "op": op, "room_id": room_id, "seq": _lobby_seq, "game": game}
+    if new is not None:
+        event["room"] = new
+    data = _encode_event(event)
+    # 不同房間的事件不能互相取代，所以不 coalesce
+    for topic in (_lobby_topic(), _lobby_topic(game)):
+        if push_hub.has_subscribers(topic):
+            push_hub.publish(topic, data, coalesce=False)
+
+def handle_subscribe_lobby(payload, conn, dedicated=False):
+    """
+    回傳 {"rooms": {room_id: 精簡資料}, "seq"}，之後推送 seq 更大的 lobby_room 事件。
+    payload 可帶 game 只看某款遊戲的房間。
+    """
+    game = (payload.get("game") or "").strip() or None
+    with _streams_lock:
+        # 沒人訂閱的期間目錄不會更新：重新跟 DB 對一次（差異會推給已經在訂閱的人）
+        rooms = db.load(ROOMS_FILE, {})
+        for room_id in set(_lobby_dir) | set(rooms):
+            _update_directory(room_id, rooms.get(room_id))
+        _lobby_filters.add(game)
+        push_hub.subscribe(_lobby_topic(game), conn, dedicated=dedicated)
+        directory = {rid: r for rid, r in _lobby_dir.items() if game is None or r.get("game") == game}
+        seq = _lobby_seq
+    return {"ok": True, "rooms": directory, "seq": seq, "game": game}
+
+def unsubscribe_lobby(conn, game=None):
+    push_hub.unsubscribe(_lobby_topic(game), conn)
+
+def _missed_events(st, since_seq):
+    """since_seq 之後的 delta；ring 已經不夠補（或 since_seq 不合理）回傳 None"""
+    if not isinstance(since_seq, int) or since_seq > st["seq"] or since_seq < 0:
+        return None
+    if since_seq == st["seq"]:
+        return []
+    ring = st["ring"]
+    if not ring or ring[0]["seq"] > since_seq + 1:
+        return None
+    return [ev for ev in ring if ev["seq"] > since_seq]
+
+# === 房間資料的原子更新 ===
+def _room_not_found():
+    return {"ok": False, "error": "房間不存在"}, False
+
+def _update_room(room_id, fn):
+    """
+    所有 rooms.json 的修改都走這裡（db.update：讀副本 → 修改 → 版本號沒變才寫回，否則重跑）。
+    兩個人同時加入 / 就緒不會互相蓋掉，也不需要一把全域鎖。
+
+    fn(r) 修改房間副本（房間不存在時 r 為 None），回傳 (resp, changed)；
+    要關房就 raise db.Remove((resp, changed))。
+    fn 可能被重跑，所以廣播等副作用都在這裡、寫入成功之後才做。
+    """
+    resp, changed = db.update(ROOMS_FILE, room_id, fn)
+    if changed:
+        broadcast_room_update(room_id)
+    return resp
 
 def ensure_user_db():
     users = db.load(PLAYER_USERS_FILE, {})
@@ -188,19 +328,18 @@ def handle_register(payload):
     p = payload.get("password","").strip()
     if not u or not p:
         return {"ok": False, "error": "缺少帳號或密碼"}
-    users = db.load(PLAYER_USERS_FILE, {})
-    if u in users:
-        return {"ok": False, "error": "帳號已被使用"}
-    users[u] = {"password": p}
-    db.save(PLAYER_USERS_FILE, users)
+    with db.txn(PLAYER_USERS_FILE, u, default={}) as rec:
+        if rec:
+            return {"ok": False, "error": "帳號已被使用"}
+        rec["password"] = p
     return {"ok": True, "msg": "註冊成功"}
 
 def handle_login(payload):
     u = payload.get("username","").strip()
     p = payload.get("password","").strip()
-    users = db.load(PLAYER_USERS_FILE, {})
+    rec = db.get(PLAYER_USERS_FILE, u) if u else None
 
-    if u not in users or users[u].get("password") != p:
+    if not rec or rec.get("password") != p:
         return {"ok": False, "error": "帳號或密碼錯誤"}
 
     token = auth.issue_token(u, role="player")
@@ -217,7 +356,7 @@ def handle_login(payload):
 
 def handle_list_games(payload):
     """列出遊戲 - 只顯示檔案系統中實際存在且 active 的遊戲"""
-    fs_games = _scan_uploaded_games()
+    fs_games = catalog.games(UPLOADED)
     db_games = db.load(GAMES_FILE, {})
     
     result = {}
@@ -262,27 +401,25 @@ def handle_player_ready(payload):
     player = t["user"]
     
     room_id = payload.get("room_id","").strip()
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
-    
-    r = rooms[room_id]
-    
-    if player not in r.get("players", []):
-        return {"ok": False, "error": "你不在此房間內"}
-    
-    ready_players = r.get("ready_players", [])
-    if player not in ready_players:
-        ready_players.append(player)
-        r["ready_players"] = ready_players
-        
-        if len(ready_players) == len(r.get("players", [])):
-            r["status"] = "ready"
-            
-        db.save(ROOMS_FILE, rooms)
-        broadcast_room_update(room_id)
-    
-    return {"ok": True, "msg": "已標記為就緒", "ready_players": ready_players}
+
+    def _ready(r):
+        if r is None:
+            return _room_not_found()
+        if player not in r.get("players", []):
+            return {"ok": False, "error": "你不在此房間內"}, False
+
+        ready_players = r.get("ready_players", [])
+        changed = player not in ready_players
+        if changed:
+            ready_players.append(player)
+            r["ready_players"] = ready_players
+
+            if len(ready_players) == len(r.get("players", [])) and r.get("status") != "starting":
+                r["status"] = "ready"
+
+        return {"ok": True, "msg": "已標記為就緒", "ready_players": ready_players}, changed
+
+    return _update_room(room_id, _ready)
 
 def handle_player_unready(payload):
     token = payload.get("token")
@@ -292,24 +429,23 @@ def handle_player_unready(payload):
     player = t["user"]
     
     room_id = payload.get("room_id","").strip()
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
-    
-    r = rooms[room_id]
-    
-    ready_players = r.get("ready_players", [])
-    if player in ready_players:
-        ready_players.remove(player)
-        r["ready_players"] = ready_players
-        
-        if r.get("status") == "ready":
-            r["status"] = "waiting"
-            
-        db.save(ROOMS_FILE, rooms)
-        broadcast_room_update(room_id)
-    
-    return {"ok": True, "msg": "已取消就緒"}
+
+    def _unready(r):
+        if r is None:
+            return _room_not_found()
+
+        ready_players = r.get("ready_players", [])
+        changed = player in ready_players
+        if changed:
+            ready_players.remove(player)
+            r["ready_players"] = ready_players
+
+            if r.get("status") == "ready":
+                r["status"] = "waiting"
+
+        return {"ok": True, "msg": "已取消就緒"}, changed
+
+    return _update_room(room_id, _unready)
 
 def handle_rate_game(payload):
     token = payload.get("token")
@@ -333,8 +469,7 @@ def handle_rate_game(payload):
         return {"ok": False, "error": "評分必須是 1~5 的整數"}
 
     # 檢查是否玩過
-    users = db.load(PLAYER_USERS_FILE, {})
-    played = users.get(user, {}).get("played", {})
+    played = (db.get(PLAYER_USERS_FILE, user) or {}).get("played", {})
     # 若 played 不是 dict（例如 list），也先修正一下
     if not isinstance(played, dict):
         played = {}
@@ -342,37 +477,32 @@ def handle_rate_game(payload):
     if not played_ok:
         return {"ok": False, "error": "必須先玩過此遊戲才能留言/評分"}
 
-    # 讀取遊戲資料
-    games = db.load(GAMES_FILE, {})
-    if name not in games:
-        return {"ok": False, "error": "遊戲不存在"}
-
-    g = games[name]
+    # 讀取遊戲資料（只鎖這款遊戲，其他遊戲的評分可同時進行）
+    with db.txn(GAMES_FILE, name) as g:
+        if g is None:
+            return {"ok": False, "error": "遊戲不存在"}
 
-    # ⭐ 關鍵：reviews 一律用 dict，舊的 list 直接丟掉重建
-    reviews = g.get("reviews")
-    if not isinstance(reviews, dict):
-        reviews = {}
+        # ⭐ 關鍵：reviews 一律用 dict，舊的 list 直接丟掉重建
+        reviews = g.get("reviews")
+        if not isinstance(reviews, dict):
+            reviews = {}
 
-    reviews[user] = {
-        "rating": rating,
-        "text": text,
-        "ts": int(time.time())
-    }
-    g["reviews"] = reviews
-
-    # 重新計算平均分數
-    if reviews:
-        s = sum(r["rating"] for r in reviews.values())
-        n = len(reviews)
-        g["avg_rating"] = round(s / n, 2)
-        g["review_count"] = n
-    else:
-        g["avg_rating"] = None
-        g["review_count"] = 0
-
-    games[name] = g
-    db.save(GAMES_FILE, games)
+        reviews[user] = {
+            "rating": rating,
+            "text": text,
+            "ts": int(time.time())
+        }
+        g["reviews"] = reviews
+
+        # 重新計算平均分數
+        if reviews:
+            s = sum(r["rating"] for r in reviews.values())
+            n = len(reviews)
+            g["avg_rating"] = round(s / n, 2)
+            g["review_count"] = n
+        else:
+            g["avg_rating"] = None
+            g["review_count"] = 0
 
     return {
         "ok": True,
@@ -387,35 +517,51 @@ def handle_logout(payload):
         auth.revoke_token(token)
     return {"ok": True, "msg": "已登出"}
 
-def handle_subscribe_room(payload, conn):
+def handle_subscribe_room(payload, conn, dedicated=False):
+    """
+    dedicated=True：這條連線只用來收推播。訂閱後先暫停推送，
+    呼叫端把這個回應交給 push_hub.release() 送出後才開始送事件。
+
+    delta=True 改收 room_delta；再帶 since_seq（上次收到的 seq）時，
+    ring buffer 還補得到就只回傳漏掉的事件（"events"），否則回傳完整的 room。
+    回應的 seq 是 room / events 對應的最後一個 seq，之後推播的事件從 seq+1 開始。
+    """
     token = payload.get("token")
     t = auth.verify_token(token, role="player")
     if not t:
         return {"ok": False, "error": "未登入"}
     
     room_id = payload.get("room_id","").strip()
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
-    
-    subscribe_room(room_id, conn)
-    # ✅ 這裡多把目前房間狀態回傳給訂閱者
-    return {
+    delta = bool(payload.get("delta"))
+    with _streams_lock:
+        st = _advance_room(room_id)
+        if st is None:
+            return {"ok": False, "error": "房間不存在"}
+        # 在鎖裡訂閱：之後配出的 seq 一定會推給這個訂閱者
+        subscribe_room(room_id, conn, dedicated=dedicated, delta=delta)
+        seq, room = st["seq"], st["room"]
+        missed = _missed_events(st, payload.get("since_seq")) if delta else None
+
+    resp = {
         "ok": True,
         "msg": "已訂閱房間更新",
         "room_id": room_id,
-        "room": rooms[room_id],
+        "seq": seq,
     }
+    if missed is not None:
+        resp["events"] = missed
+    else:
+        # ✅ 這裡多把目前房間狀態回傳給訂閱者
+        resp["room"] = room
+    return resp
 
 def handle_game_details(payload):
     name = payload.get("name","").strip()
-    games = db.load(GAMES_FILE, {})
-    if name not in games:
+    game_data = db.get(GAMES_FILE, name)
+    if game_data is None:
         return {"ok": False, "error": "遊戲不存在"}
     
-    game_data = games[name]
-    
-    # ✅ 關鍵修改：移除 zip_b64，只保留 manifest
+    # ✅ 關鍵修改：不回傳遊戲包，只保留 manifest
     # 避免回傳資料過大導致 framing 錯誤
     cleaned_data = {
         "status": game_data.get("status"),
@@ -427,60 +573,186 @@ def handle_game_details(payload):
         "versions": {}
     }
     
-    # 只複製每個版本的 manifest，不包含 zip_b64
+    # 只複製每個版本的 manifest，不包含遊戲包（blob / 舊資料的 zip_b64）
     for ver, ver_data in game_data.get("versions", {}).items():
         cleaned_data["versions"][ver] = {
             "manifest": ver_data.get("manifest", {}),
             "uploaded_at": ver_data.get("uploaded_at"),
-            # ❌ 不包含 "zip_b64"
         }
     
     return {"ok": True, "details": cleaned_data}
 
-def handle_download_game(payload):
-    name = payload.get("name","").strip()
-    games = db.load(GAMES_FILE, {})
-    if name not in games:
-        return {"ok": False, "error": "遊戲不存在"}
-    g = games[name]
+def _package_blob(pkg):
+    """版本紀錄對應的 blob 資訊；還沒搬走的舊資料（zip_b64）就地存進 blobstore"""
+    blob = pkg.get("blob") or {}
+    if blobstore.exists(blob.get("sha256")):
+        return blob
+    if "zip_b64" in pkg:
+        return blobstore.put_bytes(base64.b64decode(pkg["zip_b64"].encode("utf-8")))
+    return None
+
+def _resolve_download(name, version=None):
+    """回傳 (version, pkg, blob, None)；失敗時最後一項是錯誤回應"""
+    g = db.get(GAMES_FILE, name)
+    if g is None:
+        return None, None, None, {"ok": False, "error": "遊戲不存在"}
     if g.get("status") != "active":
-        return {"ok": False, "error": "此遊戲已下架"}
-    version = g.get("latest")
+        return None, None, None, {"ok": False, "error": "此遊戲已下架"}
+    version = version or g.get("latest")
     if not version or version not in g.get("versions", {}):
-        return {"ok": False, "error": "無可下載版本"}
+        return None, None, None, {"ok": False, "error": "無可下載版本"}
     pkg = g["versions"][version]
-    return {"ok": True, "name": name, "version": version, "manifest": pkg["manifest"], "zip_b64": pkg["zip_b64"]}
+    blob = _package_blob(pkg)
+    if blob is None:
+        return None, None, None, {"ok": False, "error": "遊戲檔案遺失，請聯絡開發者重新上傳"}
+    return version, pkg, blob, None
 
-def _find_free_port(min_port=10000, max_port=65535):
-    """為遊戲房間分配 10000 以上的 port"""
-    import socket
-    import random
-    
-    for _ in range(100):
-        port = random.randint(min_port, max_port)
+def handle_download_game(payload):
+    """舊協定：整包 base64 放在 JSON 回應裡"""
+    name = payload.get("name","").strip()
+    version, pkg, blob, err = _resolve_download(name)
+    if err:
+        return err
+    zip_b64 = base64.b64encode(blobstore.read_bytes(blob["sha256"])).decode("utf-8")
+    return {"ok": True, "name": name, "version": version, "manifest": pkg["manifest"],
+            "zip_b64": zip_b64, "sha256": blob["sha256"]}
+
+def handle_download_game_stream(payload, conn):
+    """
+    二進位下載：
+      - 先回一行 JSON header：{ok, name, version, manifest, size, sha256, offset}
+      - 接著直接用 socket.sendfile() 從 blob 檔送出 [offset, size) 的原始 bytes（kernel 直接複製，不經過 Python）
+    斷線續傳：client 帶上已收到的 bytes 數（offset）與上次 header 的 sha256；
+    若 sha256 不同（中途有新版本），offset 會歸零，client 要重新下載。
+    """
+    name = payload.get("name","").strip()
+    version, pkg, blob, err = _resolve_download(name, payload.get("version") or None)
+    if err:
+        conn.sendall((json.dumps(err, ensure_ascii=False) + "\n").encode("utf-8"))
+        return
+
+    size = blob["size"]
+    offset = payload.get("offset") or 0
+    if payload.get("sha256") != blob["sha256"] or not isinstance(offset, int) or not 0 <= offset <= size:
+        offset = 0
+
+    header = {
+        "ok": True,
+        "name": name,
+        "version": version,
+        "manifest": pkg["manifest"],
+        "size": size,
+        "sha256": blob["sha256"],
+        "offset": offset,
+    }
+    conn.sendall((json.dumps(header, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    # 大檔案傳送時間較長，放寬讀取 request 時設的短 timeout
+    conn.settimeout(60.0)
+    with open(blobstore.path_of(blob["sha256"]), "rb") as f:
+        conn.sendfile(f, offset, size - offset)
+    print(f"[Lobby] 已傳送 {name}@{version} bytes {offset}-{size}", flush=True)
+
+def handle_file_manifest(payload):
+    """某個版本的檔案清單：{path: {size, sha256}}（不指定 version 則為 latest）"""
+    name = payload.get("name","").strip()
+    version, pkg, blob, err = _resolve_download(name, payload.get("version") or None)
+    if err:
+        return err
+    return {"ok": True, "name": name, "version": version, "sha256": blob["sha256"],
+            "files": blobstore.file_manifest(blob["sha256"])}
+
+def handle_download_delta(payload, conn):
+    """
+    差異更新：client 已經有 from_version，要升到 version（預設 latest）。
+      - 先回一行 JSON header：{ok, name, version, from_version, manifest,
+                               files: [{path, size, sha256}, ...], deleted: [path, ...]}
+      - 接著依 files 的順序，把每個新增 / 內容有變的檔案原始 bytes 接續送出（長度就是 size）
+    from_version 找不到時回錯誤，client 改走完整下載。
+    """
+    name = payload.get("name","").strip()
+    from_version = payload.get("from_version","").strip()
+    version, pkg, blob, err = _resolve_download(name, payload.get("version") or None)
+    if err is None:
+        g = db.get(GAMES_FILE, name) or {}
+        old_pkg = (g.get("versions") or {}).get(from_version)
+        old_blob = _package_blob(old_pkg) if old_pkg else None
+        if old_blob is None:
+            err = {"ok": False, "error": f"伺服器上找不到舊版本 {from_version}"}
+    if err:
+        conn.sendall((json.dumps(err, ensure_ascii=False) + "\n").encode("utf-8"))
+        return
+
+    old = blobstore.file_manifest(old_blob["sha256"])
+    new = blobstore.file_manifest(blob["sha256"])
+    changed = [
+        {"path": path, "size": info["size"], "sha256": info["sha256"]}
+        for path, info in sorted(new.items())
+        if old.get(path, {}).get("sha256") != info["sha256"]
+    ]
+    deleted = sorted(path for path in old if path not in new)
+
+    header = {
+        "ok": True,
+        "name": name,
+        "version": version,
+        "from_version": from_version,
+        "manifest": pkg["manifest"],
+        "files": changed,
+        "deleted": deleted,
+    }
+    conn.sendall((json.dumps(header, ensure_ascii=False) + "\n").encode("utf-8"))
+
+    conn.settimeout(60.0)
+    with zipfile.ZipFile(blobstore.path_of(blob["sha256"]), "r") as z:
+        for item in changed:
+            with z.open(item["path"]) as f:
+                for chunk in iter(lambda: f.read(256 * 1024), b""):
+                    conn.sendall(chunk)
+    sent = sum(item["size"] for item in changed)
+    print(f"[Lobby] 差異更新 {name} {from_version} → {version}："
+          f"{len(changed)} 個檔案 / {sent} bytes，刪除 {len(deleted)} 個", flush=True)
+
+GAME_PORT_MIN, GAME_PORT_MAX = 10000, 65535
+
+def _bind_game_socket(min_port=GAME_PORT_MIN, max_port=GAME_PORT_MAX):
+    """
+    為遊戲房間 bind 一個 10000 以上的 listening socket（0.0.0.0，接受外部連線）。
+    先讓 kernel 挑（bind port 0，一次就成功）；kernel 的範圍不在 min_port 以上時才隨機試幾個。
+    socket 一直由 lobby 握著直到交給子行程，期間別的房間不可能拿到同一個 port。
+    """
+    s = socket.socket()
+    s.bind(("0.0.0.0", 0))
+    if min_port <= s.getsockname()[1] <= max_port:
+        s.listen(128)
+        return s
+    s.close()
+
+    for _ in range(20):
+        s = socket.socket()
         try:
-            s = socket.socket()
-            # ✅ 修改：綁定 0.0.0.0 以接受外部連線
-            s.bind(("0.0.0.0", port))
-            actual_port = s.getsockname()[1]
-            s.close()
-            return actual_port
+            s.bind(("0.0.0.0", random.randint(min_port, max_port)))
         except OSError:
+            s.close()
             continue
-    
-    s = socket.socket()
-    s.bind(("0.0.0.0", 0))
+        s.listen(128)
+        return s
+    raise OSError("找不到可用的 port")
+
+def _find_free_port(min_port=GAME_PORT_MIN, max_port=GAME_PORT_MAX):
+    """
+    舊版遊戲（自己 bind GAME_PORT）用：只拿 port 號碼。
+    關掉到子行程 bind 之間仍可能被搶走，支援 listen_fd 的遊戲請改用 _bind_game_socket。
+    """
+    s = _bind_game_socket(min_port, max_port)
     port = s.getsockname()[1]
     s.close()
-    
-    if port < min_port:
-        return _find_free_port(min_port, max_port)
-    
     return port
 
 def handle_list_rooms(payload):
     rooms = db.load(ROOMS_FILE, {})
-    return {"ok": True, "rooms": rooms}
+    # 只回傳列表需要的欄位（pid 等內部資料不外流）
+    return {"ok": True, "rooms": {rid: _room_summary(r) for rid, r in rooms.items()}}
 
 def handle_create_room(payload):
     token = payload.get("token")
@@ -494,13 +766,12 @@ def handle_create_room(payload):
         return {"ok": False, "error": "缺少遊戲名稱"}
 
     # 1) 掃檔案系統：確認這個遊戲真的有被上傳
-    fs_games = _scan_uploaded_games()
+    fs_games = catalog.games(UPLOADED)
     if req_game not in fs_games:
         return {"ok": False, "error": "遊戲不存在或不可用"}
 
     # 2) 檢查 DB：遊戲必須存在，且 status = active
-    db_games = db.load(GAMES_FILE, {})
-    ginfo = db_games.get(req_game)
+    ginfo = db.get(GAMES_FILE, req_game)
     if not ginfo or ginfo.get("status", "active") != "active":
         return {"ok": False, "error": "此遊戲已下架，無法建立新的房間"}
 
@@ -544,83 +815,42 @@ def handle_create_room(payload):
     entry = manifest.get("entry_server", "start_server.py")
     max_players = manifest.get("max_players", 2)
 
-    # ✅ 伺服器綁定和客戶端連線位址要分開處理
-    server_bind_host = "0.0.0.0"  # 伺服器綁定在所有介面
-    client_connect_host = PUBLIC_HOST  # 客戶端用 public_host 連線
-    
-    port = _find_free_port()
     room_id = f"{req_game}-{int(time.time())}-{random.randint(1000, 9999)}"
-
     cwd = game_root
     if not (cwd / entry).exists():
         return {"ok": False, "error": f"缺少 server entry: {entry}"}
 
-    env = os.environ.copy()
     lobby_connect_host = LOBBY_HOST
     if LOBBY_HOST == "0.0.0.0":
         lobby_connect_host = PUBLIC_HOST if PUBLIC_HOST != "127.0.0.1" else "127.0.0.1"
-    
-    env.update({
-        "GAME_HOST": server_bind_host,  # ← 遊戲伺服器綁定用
-        "GAME_PORT": str(port),
+
+    room_env = {
         "ROOM_ID": room_id,
         "GAME_NAME": req_game,
         "GAME_VERSION": version,
         "LOBBY_HOST": LOBBY_HOST,
         "LOBBY_CONNECT_HOST": lobby_connect_host,
         "LOBBY_PORT": str(LOBBY_PORT or 0),
-    })
-
-    print(f"[Lobby] 啟動遊戲伺服器：{req_game}@{version} on {server_bind_host}:{port}", flush=True)
-    
-    # ✅ 啟動遊戲伺服器
-    proc = subprocess.Popen(
-        [__import__("sys").executable, entry],
-        cwd=str(cwd), 
-        env=env,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        bufsize=1
-    )
+    }
 
-    # ✅ 關鍵修改：等待伺服器真正啟動（最多等 10 秒）
-    server_ready = False
-    print(f"[Lobby] 等待遊戲伺服器啟動...", flush=True)
-    
-    for attempt in range(50):  # 50 次 × 0.2 秒 = 10 秒
-        try:
-            test_sock = socket.socket()
-            test_sock.settimeout(0.5)
-            # ✅ 嘗試連線到伺服器綁定的 port
-            test_sock.connect(("127.0.0.1", port))
-            test_sock.close()
-            server_ready = True
-            print(f"[Lobby] ✓ 遊戲伺服器已就緒（嘗試 {attempt + 1} 次，耗時 {(attempt + 1) * 0.2:.1f}秒）", flush=True)
-            break
-        except (ConnectionRefusedError, OSError, socket.timeout):
-            time.sleep(0.2)
-            # 檢查進程是否還活著
-            if proc.poll() is not None:
-                print(f"[Lobby] ✗ 遊戲伺服器進程意外終止（退出碼：{proc.returncode}）", flush=True)
-                break
-    
-    if not server_ready:
-        print(f"[Lobby] ✗ 遊戲伺服器啟動超時或失敗", flush=True)
-        try:
-            proc.kill()
-            proc.wait(timeout=2)
-        except:
-            pass
-        return {"ok": False, "error": "遊戲伺服器啟動失敗，請稍後再試"}
+    # ✅ 有設定 game_agents：先放到負載最低的機器上（agent bind port、啟動遊戲伺服器並回報就緒），
+    # agent 都連不上 / 都滿了才在本機開房
+    proc = _open_remote_room(room_id, req_game, manifest, entry, room_env) if GAME_AGENTS else None
+    if proc is not None:
+        port, ready_r, client_connect_host = proc.port, proc.ready_fd, proc.host
+    else:
+        proc, port, ready_r = _spawn_local_room(room_id, (req_game, actual_folder), cwd, entry,
+                                                manifest, room_env)
+        client_connect_host = PUBLIC_HOST  # 客戶端用 public_host 連線
 
-    # ✅ 伺服器就緒後才儲存房間資訊
-    rooms = db.load(ROOMS_FILE, {})
-    rooms[room_id] = {
+    # ✅ 不在 request 執行緒裡等：先以 starting 狀態建立房間，就緒 / 失敗由 room-starter 執行緒
+    # 透過房間訂閱通知（只寫這一筆，不整份覆寫 rooms.json）
+    room = {
         "game": req_game,
         "version": version,
         "host": client_connect_host,  # ← 客戶端連線用這個
         "port": port,
-        "status": "waiting",
+        "status": "starting",
         "owner": session_user,
         "start": {"state": "idle"},
         "players": [session_user],
@@ -628,23 +858,465 @@ def handle_create_room(payload):
         "max_players": max_players,
         "pid": proc.pid,
     }
-    db.save(ROOMS_FILE, rooms)
+    if isinstance(proc, gamehost.HostedRoom):
+        room["game_host"] = proc.host.key   # 房間跑在哪個 host 行程上（log 也在那裡）
+    elif isinstance(proc, agents.RemoteRoom):
+        room["agent"] = proc.link.addr      # 房間跑在哪台機器的 agent 上
+    if WORKER_ID is not None:
+        room["worker"] = WORKER_ID          # 遊戲伺服器由哪個 lobby worker 管（log 在那裡）
+    db.put(ROOMS_FILE, room_id, room)
+    broadcast_room_update(room_id)
+    _watch_startup(room_id, proc, port, ready_r)
     
-    print(f"[Lobby] ✓ 房間 {room_id} 建立完成", flush=True)
-    return {"ok": True, "room_id": room_id, **rooms[room_id]}
+    print(f"[Lobby] ✓ 房間 {room_id} 建立完成，等待遊戲伺服器啟動...", flush=True)
+    return {"ok": True, "room_id": room_id, **room}
+
+def _spawn_local_room(room_id, key, cwd, entry, manifest, room_env):
+    """在本機啟動遊戲伺服器，回傳 (proc, port, ready_fd)"""
+    # ✅ 伺服器綁定在所有介面；客戶端連線位址另外用 PUBLIC_HOST
+    server_bind_host = "0.0.0.0"
+
+    # ✅ manifest 宣告 "supports": ["listen_fd"] 的遊戲：lobby 先 bind + listen，
+    # 把 socket 透過 GAME_LISTEN_FD 交給子行程（沒有「找到空 port → 子行程再 bind」之間的競爭）；
+    # 其他遊戲照舊只拿 GAME_PORT 號碼自己 bind
+    supports = manifest.get("supports", [])
+    listen_sock = None
+    if "listen_fd" in supports and os.name == "posix":
+        listen_sock = _bind_game_socket()
+        port = listen_sock.getsockname()[1]
+    else:
+        port = _find_free_port()
+    room_env = {"GAME_HOST": server_bind_host, "GAME_PORT": str(port), **room_env}
+
+    # ✅ 就緒通知：manifest 宣告 "supports": ["ready_fd"] 的遊戲，listen 完成後會在
+    # GAME_READY_FD 這個繼承下來的 pipe 寫一行 READY；其他遊戲仍由 lobby 探測 port
+    ready_r = ready_w = None
+    child_fds = {}                 # 環境變數名稱 -> 要交給子行程的 fd
+    if "ready_fd" in supports and os.name == "posix":
+        ready_r, ready_w = os.pipe()
+        child_fds["GAME_READY_FD"] = ready_w
+    if listen_sock is not None:
+        child_fds["GAME_LISTEN_FD"] = listen_sock.fileno()
+
+    print(f"[Lobby] 啟動遊戲伺服器：{key[0]}@{room_env['GAME_VERSION']} on {server_bind_host}:{port}", flush=True)
+
+    # ✅ 啟動遊戲伺服器
+    # manifest 宣告 "host" 的遊戲放到多房間的 host 行程上（需要 listen_fd：每個房間各自的 listening socket）；
+    # 宣告 "zygote" 的遊戲從預熱好的 zygote fork（省掉直譯器啟動與 import）；都失敗才退回 Popen。
+    # stdout / stderr 都交給 game_procs 持續讀走並保留最後一段，結束時立刻回收
+    try:
+        proc = None
+        if "host" in supports and listen_sock is not None and GAME_HOSTS:
+            proc = _open_hosted_room(room_id, key, cwd, entry, room_env, child_fds)
+        if proc is None and "zygote" in supports and GAME_ZYGOTE and os.name == "posix":
+            proc = _spawn_from_zygote(room_id, key, cwd, entry, manifest, room_env, child_fds)
+        if proc is None:
+            env = os.environ.copy()
+            env.update(room_env)
+            env.update({name: str(fd) for name, fd in child_fds.items()})
+            proc = game_procs.spawn(
+                room_id,
+                [__import__("sys").executable, entry],
+                cwd=str(cwd),
+                env=env,
+                pass_fds=list(child_fds.values()),
+            )
+    except Exception:
+        if ready_r is not None:
+            os.close(ready_r)
+        raise
+    finally:
+        if ready_w is not None:
+            os.close(ready_w)   # 只留給子行程；子行程結束時 lobby 會讀到 EOF
+        if listen_sock is not None:
+            listen_sock.close()  # 子行程已經有自己的一份；lobby 不留，房間結束 port 就釋放
+    return proc, port, ready_r
+
+# === 跨機器開房（game host agent）===
+# config.json 的 "game_agents" 列出各台機器上 server/host_agent.py 的位址（"host:port"）。
+# 有設定時新房間放到負載最低的 agent（common/agents.py），agent 沒有這個版本就先把上傳包送過去；
+# agent 都連不上或都滿了才在本機開。沒設定就跟以前一樣全部在本機。
+GAME_AGENTS = list(CONF.get("game_agents") or [])
+AGENT_SECRET = os.getenv("AGENT_SECRET") or CONF.get("agent_secret") or ""
+AGENT_RETRY = 5.0             # 秒：連不上的 agent 隔多久再試
+
+_agent_pool = None
+_agent_lock = threading.Lock()
+
+def _get_agent_pool():
+    global _agent_pool
+    with _agent_lock:
+        if _agent_pool is None:
+            if not AGENT_SECRET:
+                print("[Lobby] ⚠️ 有設定 game_agents 但沒有 agent_secret，agent 會拒絕連線", flush=True)
+            _agent_pool = agents.AgentPool(GAME_AGENTS, AGENT_SECRET, retry=AGENT_RETRY)
+        return _agent_pool
+
+def _open_remote_room(room_id, game, manifest, entry, room_env):
+    """把房間放到某台機器的 agent 上；沒有可用的 agent 或失敗回傳 None（呼叫端改在本機開）"""
+    link = _get_agent_pool().place()
+    if link is None:
+        return None
+    version, pkg, blob, err = _resolve_download(game)
+    if err:
+        return None
+    # 遊戲伺服器從 agent 那台機器連回 lobby：用 lobby 連到 agent 時的本機位址
+    env = {**room_env, "LOBBY_CONNECT_HOST": link.lobby_ip}
+    try:
+        proc = link.open_room(room_id, blob["sha256"], blob["size"], blobstore.path_of(blob["sha256"]),
+                              entry, env, manifest.get("supports", []),
+                              on_exit=lambda code, tail: _on_game_exit(room_id, code, tail))
+    except Exception as e:
+        print(f"[Lobby] ⚠️ agent {link.addr} 無法開房：{room_id}，改在本機開：{e}", flush=True)
+        return None
+    print(f"[Lobby] 遊戲伺服器放到 agent {link.addr}：{game}@{version} on {proc.host}:{proc.port}", flush=True)
+    return proc
+
+# === 遊戲伺服器 zygote ===
+# 每個 (遊戲, 版本資料夾) 一個預熱好的 fork server（common/zygote.py），第一次開房時建立。
+# 開房只用最新版本，所以同一款遊戲的舊版本 zygote 會被收掉；閒置太久的也一樣
+# （收掉只是不再 fork，已經在跑的房間不受影響）。
+GAME_ZYGOTE = True
+ZYGOTE_IDLE_TTL = 600.0       # 秒
+
+_zygotes = {}                 # (game, folder) -> zygote.Zygote
+_zygote_lock = threading.Lock()
+
+def _get_zygote(key, cwd, entry, manifest):
+    now = time.monotonic()
+    with _zygote_lock:
+        for k, z in list(_zygotes.items()):
+            stale = k != key and (k[0] == key[0] or now - z.last_used > ZYGOTE_IDLE_TTL)
+            if stale or not z.alive():
+                z.close()
+                del _zygotes[k]
+        z = _zygotes.get(key)
+        if z is None:
+            print(f"[Lobby] 建立 zygote：{key[0]}@{key[1]}", flush=True)
+            z = zygote.Zygote(cwd, entry, preload=manifest.get("preload", []), tag=f"Zygote:{key[0]}")
+            _zygotes[key] = z
+        z.last_used = now
+        return z
+
+def _spawn_from_zygote(room_id, key, cwd, entry, manifest, room_env, child_fds):
+    """從 zygote fork 遊戲伺服器並交給 game_procs 監管；失敗回傳 None（呼叫端改用 Popen）"""
+    try:
+        z = _get_zygote(key, cwd, entry, manifest)
+        proc = z.spawn(room_env, child_fds, on_exit=lambda: game_procs.reap_soon(room_id))
+    except Exception as e:
+        print(f"[Lobby] ⚠️ zygote 無法啟動 {room_id}，改用一般方式：{e}", flush=True)
+        return None
+    game_procs.add(room_id, proc)
+    return proc
+
+# === 多房間遊戲 host ===
+# manifest 宣告 "host" 的遊戲（common/gamehost.py）：每個 (遊戲, 版本資料夾) 一組 host 行程，
+# 最多 GAME_HOSTS_MAX 個（預設 CPU 核心數，各綁一個核心），新房間放到房間數最少的 host；
+# 房間數都到 GAME_HOST_ROOMS 才再開一個。舊版本的 host 不再放新房間，閒置的多餘 host 會被收掉。
+GAME_HOSTS = True
+GAME_HOSTS_MAX = None         # None：CPU 核心數
+GAME_HOST_ROOMS = 8
+GAME_HOST_IDLE_TTL = 300.0    # 秒
+
+_host_pools = {}              # (game, folder) -> gamehost.GameHostPool
+_host_lock = threading.Lock()
+
+def _get_host_pool(key, cwd, entry):
+    with _host_lock:
+        for k, pool in list(_host_pools.items()):
+            if k != key and k[0] == key[0]:
+                pool.close()
+                del _host_pools[k]
+            else:
+                pool.retire_idle(GAME_HOST_IDLE_TTL)
+        pool = _host_pools.get(key)
+        if pool is None:
+            pool = gamehost.GameHostPool(
+                key[0], cwd, entry, max_hosts=GAME_HOSTS_MAX, rooms_per_host=GAME_HOST_ROOMS,
+                spawn=game_procs.spawn,
+            )
+            _host_pools[key] = pool
+        return pool
+
+def _open_hosted_room(room_id, key, cwd, entry, room_env, child_fds):
+    """把房間放到 host 行程上；失敗回傳 None（呼叫端改用其他方式）"""
+    try:
+        return _get_host_pool(key, cwd, entry).place(
+            room_id, room_env, child_fds,
+            on_exit=lambda room, code: _on_hosted_room_exit(room_id, room.host.key, code))
+    except Exception as e:
+        print(f"[Lobby] ⚠️ 無法放到 game host：{room_id}，改用一般方式：{e}", flush=True)
+        return None
+
+def _on_hosted_room_exit(room_id, host_key, code):
+    _on_game_exit(room_id, code, game_procs.log_tail(host_key, 2048))
+
+# === 遊戲伺服器行程監管 ===
+GAME_LOG_BYTES = 32 * 1024    # 每個房間保留的遊戲伺服器輸出
+
+def _on_game_exit(room_id, code, tail):
+    """game_procs 回收到遊戲伺服器結束：異常結束就通知房間的訂閱者"""
+    print(f"[Lobby] Game server of {room_id} exited (code={code})", flush=True)
+    if code == 0:
+        return   # 正常結束（對局結束 → game_finished 已經處理房間）
+
+    def _crash(r):
+        # starting 的房間由 room-starter 處理；已經結束 / 關閉的房間不用再報
+        if r is None or r.get("status") in ("starting", "failed", "crashed", "closed"):
+            return False, False
+        r["status"] = "crashed"
+        r["error"] = f"遊戲伺服器異常結束（退出碼 {code}）"
+        r["log_tail"] = tail[-1024:]
+        return True, True
+
+    if _update_room(room_id, _crash):
+        print(f"[Lobby] ✗ Room {room_id} game server crashed (code={code})", flush=True)
+        _schedule_room_removal(room_id)
+
+game_procs = supervisor.ProcessSupervisor(log_bytes=GAME_LOG_BYTES, on_exit=_on_game_exit, tag="GameProcs")
+
+def handle_room_logs(payload):
+    """除錯用：房間內的玩家可以看遊戲伺服器最後的輸出"""
+    t = auth.verify_token(payload.get("token"), role="player")
+    if not t:
+        return {"ok": False, "error": "未登入"}
+    room_id = (payload.get("room_id") or "").strip()
+    room = db.get(ROOMS_FILE, room_id)
+    if room is None:
+        return {"ok": False, "error": "房間不存在"}
+    if t["user"] not in room.get("players", []):
+        return {"ok": False, "error": "你不在此房間內"}
+    # 跑在別台機器上的房間跟 agent 要；跑在 host 上的房間沒有自己的行程：回傳整個 host 的輸出
+    link = _get_agent_pool().get(room["agent"]) if room.get("agent") else None
+    if link is not None:
+        return {"ok": True, "room_id": room_id, "log": link.logs(room_id)}
+    if room.get("worker", WORKER_ID) != WORKER_ID:
+        return {"ok": False, "error": "這個房間的遊戲伺服器由另一個 lobby worker 管理，無法讀取輸出"}
+    return {"ok": True, "room_id": room_id, "log": game_procs.log_tail(room.get("game_host") or room_id)}
+
+# === 房間計時器 ===
+# 房間的 deadline（啟動逾時、對局逾時）與延遲刪除都排進同一個 min-heap（common/timers.py），
+# 到期當下才執行，每次只處理到期的房間；request 執行緒只負責排程，不會 sleep。
+# key：("start" / "game" / "remove", room_id)，同一個 key 重新排程會取代舊的。
+ROOM_GAME_TIMEOUT = 300       # 秒：in_game 超過這麼久就強制關房（遊戲伺服器沒回報 game_finished）
+ROOM_CLOSE_GRACE = 0.5        # 秒：關房後保留多久讓訂閱者收到 closed 再刪除
+
+room_timers = timers.TimerHeap(tag="RoomTimers")
+
+def _schedule_game_timeout(room_id, ts):
+    """對局開始（start.ts = ts）後 ROOM_GAME_TIMEOUT 秒還沒結束就強制關房"""
+    delay = max(0.0, ts + ROOM_GAME_TIMEOUT - time.time())
+    room_timers.call_later(("game", room_id), delay, _game_timeout, room_id, ts)
+
+def _game_timeout(room_id, ts):
+    def _force_close(r):
+        # 同一局（start.ts 相同）而且還在 in_game 才關；中間重新開局就不是這一局的 deadline
+        if r is None or r.get("status") != "in_game" or r.get("start", {}).get("ts") != ts:
+            return None, False
+        r["players"] = []
+        r["ready_players"] = []
+        r["status"] = "closed"
+        return "closed", True
+
+    if _update_room(room_id, _force_close) == "closed":
+        print(f"[Lobby] ⚠ Room {room_id} timeout ({ROOM_GAME_TIMEOUT}s), force closing", flush=True)
+        _schedule_room_removal(room_id, ROOM_CLOSE_GRACE)
+
+# === 遊戲伺服器啟動監看 ===
+# 一條 room-starter 執行緒用 selector 等所有 starting 房間的 ready pipe：子行程寫出 READY
+# 的當下就改成 waiting，延遲就是遊戲本身的初始化時間；同時啟動很多房間也不佔任何 request 執行緒。
+# 沒有支援 ready_fd 的遊戲才退回每 GAME_START_POLL 秒探測一次 port（loopback 的 connect 立刻有結果）。
+# 啟動逾時由 room_timers 在 deadline 當下觸發。
+GAME_START_TIMEOUT = 10.0     # 秒
+GAME_START_POLL = 0.2
+FAILED_ROOM_TTL = 5.0         # 啟動失敗的房間保留幾秒讓訂閱者看到，再刪除
+
+_starting = {}                # room_id -> {"proc", "port", "ready_fd", "deadline", "started_at"}
+_starter_lock = threading.Lock()
+_starter_wake = None          # (r, w) socketpair：有新房間時叫醒 selector
+
+def _watch_startup(room_id, proc, port, ready_fd=None):
+    now = time.monotonic()
+    with _starter_lock:
+        _starting[room_id] = {"proc": proc, "port": port, "ready_fd": ready_fd,
+                              "started_at": now, "deadline": now + GAME_START_TIMEOUT}
+    room_timers.call_at(("start", room_id), now + GAME_START_TIMEOUT, _startup_timeout, room_id)
+    _ensure_starter()
+
+def _startup_timeout(room_id):
+    with _starter_lock:
+        info = _starting.get(room_id)
+    if info is None:
+        return
+    print(f"[Lobby] ✗ 遊戲伺服器啟動超時：{room_id}", flush=True)
+    _startup_failed(room_id, info, "遊戲伺服器啟動逾時，請稍後再試")
+    _wake_starter()   # 讓 room-starter 關掉這個房間的 ready pipe
+
+def _ensure_starter():
+    global _starter_wake
+    with _starter_lock:
+        if _starter_wake is None:
+            _starter_wake = socket.socketpair()
+            _starter_wake[0].setblocking(False)
+            threading.Thread(target=_starter_loop, name="room-starter", daemon=True).start()
+    _wake_starter()
+
+def _wake_starter():
+    try:
+        _starter_wake[1].send(b"\0")
+    except OSError:
+        pass
+
+def _port_open(port) -> bool:
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=GAME_START_POLL):
+            return True
+    except OSError:
+        return False
+
+def _starter_loop():
+    sel = selectors.DefaultSelector()
+    sel.register(_starter_wake[0], selectors.EVENT_READ, None)
+    registered = {}           # ready_fd -> room_id
+
+    while True:
+        with _starter_lock:
+            pending = dict(_starting)
+
+        # 只有 ready pipe 的房間不用定時醒來（事件到了才處理）；有要探測 port 的房間才每 GAME_START_POLL 秒醒一次
+        probing = {rid: info for rid, info in pending.items() if info["ready_fd"] is None}
+        for room_id, info in pending.items():
+            fd = info["ready_fd"]
+            if fd is not None and fd not in registered:
+                sel.register(fd, selectors.EVENT_READ, room_id)
+                registered[fd] = room_id
+
+        for key, _ in sel.select(GAME_START_POLL if probing else None):
+            if key.data is None:
+                try:
+                    while key.fileobj.recv(4096):
+                        pass
+                except (BlockingIOError, OSError):
+                    pass
+                continue
+            room_id = key.data
+            info = pending.get(room_id)
+            try:
+                data = os.read(key.fd, 4096)
+            except OSError:
+                data = b""
+            if b"READY" in data or not data:
+                sel.unregister(key.fd)
+                registered.pop(key.fd, None)
+                os.close(key.fd)
+                if info is not None and room_id in _starting:
+                    info["ready_fd"] = None
+                    _on_ready_signal(room_id, info, ready=b"READY" in data)
+
+        for room_id, info in probing.items():
+            if room_id not in _starting:
+                continue
+            try:
+                _check_startup(room_id, info)
+            except Exception as e:
+                print(f"[Lobby] room-starter error on {room_id}: {e}", flush=True)
+                _startup_failed(room_id, info, "遊戲伺服器啟動失敗，請稍後再試")
+
+        # 已經不在等的房間（逾時 / 房間被刪）：關掉還沒讀到結果的 pipe
+        for fd, room_id in list(registered.items()):
+            if room_id not in _starting:
+                sel.unregister(fd)
+                del registered[fd]
+                os.close(fd)
+
+def _on_ready_signal(room_id, info, ready):
+    if ready:
+        _startup_done(room_id, info)
+    else:
+        # 子行程沒寫 READY 就關掉了 pipe（通常是已經結束）
+        code = info["proc"].poll()
+        print(f"[Lobby] ✗ 遊戲伺服器沒有回報就緒就結束了（退出碼：{code}）", flush=True)
+        _startup_failed(room_id, info, "遊戲伺服器啟動失敗，請稍後再試")
+
+def _startup_done(room_id, info):
+    _finish_watch(room_id)
+    if db.get(ROOMS_FILE, room_id) is None:
+        # 還沒啟動好房間就沒了（房主離開）：收掉遊戲伺服器
+        print(f"[Lobby] Room {room_id} removed while starting, stopping game server", flush=True)
+        _kill_proc(info["proc"])
+        return
+    elapsed = time.monotonic() - info["started_at"]
+    print(f"[Lobby] ✓ 遊戲伺服器已就緒：{room_id}（耗時 {elapsed:.2f}秒）", flush=True)
+    _update_room(room_id, _mark_started)
+
+def _check_startup(room_id, info):
+    proc = info["proc"]
+    if db.get(ROOMS_FILE, room_id) is None:
+        # 還沒啟動好房間就沒了（房主離開）：收掉遊戲伺服器
+        print(f"[Lobby] Room {room_id} removed while starting, stopping game server", flush=True)
+        _finish_watch(room_id)
+        _kill_proc(proc)
+        return
+    if info["ready_fd"] is None and _port_open(info["port"]):
+        _startup_done(room_id, info)
+        return
+    if proc.poll() is not None:
+        print(f"[Lobby] ✗ 遊戲伺服器進程意外終止（退出碼：{proc.returncode}）", flush=True)
+        _startup_failed(room_id, info, "遊戲伺服器啟動失敗，請稍後再試")
+
+def _mark_started(r):
+    if r is None or r.get("status") != "starting":
+        return None, False
+    players = r.get("players", [])
+    all_ready = players and len(r.get("ready_players", [])) == len(players)
+    r["status"] = "ready" if all_ready else "waiting"
+    return None, True
+
+def _finish_watch(room_id):
+    with _starter_lock:
+        _starting.pop(room_id, None)
+    room_timers.cancel(("start", room_id))
+
+def _kill_proc(proc):
+    try:
+        proc.kill()
+        proc.wait(timeout=2)
+    except Exception:
+        pass
+
+def _startup_failed(room_id, info, error):
+    _finish_watch(room_id)
+    _kill_proc(info["proc"])
+
+    def _fail(r):
+        if r is None:
+            return None, False
+        r["status"] = "failed"
+        r["error"] = error
+        return None, True
+
+    _update_room(room_id, _fail)
+    _schedule_room_removal(room_id)
+
+def _schedule_room_removal(room_id, delay=None):
+    """
+    失敗 / 當機 / 已結束的房間先保留 delay 秒（預設 FAILED_ROOM_TTL）讓訂閱者看到最後狀態，
+    時間到由 room_timers 刪除；呼叫端（request 執行緒）不用等
+    """
+    room_timers.call_later(("remove", room_id), FAILED_ROOM_TTL if delay is None else delay,
+                           _remove_room, room_id)
+
+def _remove_room(room_id):
+    room_timers.cancel(("game", room_id))
+    db.delete(ROOMS_FILE, room_id)
+    broadcast_room_update(room_id)
 
 def _mark_played(game_name: str, players: list[str]):
-    users = db.load(PLAYER_USERS_FILE, {})
-    changed = False
     for u in players:
-        rec = users.get(u, {})
-        played = rec.get("played", {})
-        played[game_name] = int(played.get(game_name, 0)) + 1
-        rec["played"] = played
-        users[u] = rec
-        changed = True
-    if changed:
-        db.save(PLAYER_USERS_FILE, users)
+        with db.txn(PLAYER_USERS_FILE, u, default={}) as rec:
+            played = rec.get("played", {})
+            played[game_name] = int(played.get(game_name, 0)) + 1
+            rec["played"] = played
 
 def handle_join_room(payload):
     token = payload.get("token")
@@ -653,31 +1325,31 @@ def handle_join_room(payload):
         return {"ok": False, "error": "未登入"}
     player = t["user"]
     room_id = payload.get("room_id","").strip()
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
-    
-    r = rooms[room_id]
-    
-    # ✅ 檢查人數上限
-    current_players = r.get("players", [])
-    max_players = r.get("max_players", 2)
-    
-    # 如果玩家已經在房間裡，允許重新加入（斷線重連）
-    if player not in current_players:
+
+    def _join(r):
+        if r is None:
+            return _room_not_found()
+
+        # ✅ 檢查人數上限
+        current_players = r.get("players", [])
+        max_players = r.get("max_players", 2)
+
+        # 如果玩家已經在房間裡，允許重新加入（斷線重連）
+        if player in current_players:
+            return {"ok": True, "room_id": room_id, **r}, False
+
         if len(current_players) >= max_players:
             return {
                 "ok": False, 
                 "error": f"房間已滿 ({len(current_players)}/{max_players} 人)"
-            }
-        
+            }, False
+
         # 有空位才加入
         current_players.append(player)
         r["players"] = current_players
-        db.save(ROOMS_FILE, rooms)
-        broadcast_room_update(room_id)
-    
-    return {"ok": True, "room_id": room_id, **r}
+        return {"ok": True, "room_id": room_id, **r}, True
+
+    return _update_room(room_id, _join)
 
 def handle_leave_room(payload):
     token = payload.get("token")
@@ -688,48 +1360,42 @@ def handle_leave_room(payload):
     player = t["user"]
     room_id = (payload.get("room_id") or "").strip()
 
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
+    def _leave(r):
+        if r is None:
+            return _room_not_found()
 
-    r = rooms[room_id]
-    players = r.get("players", [])
-    ready_players = r.get("ready_players", [])
+        players = r.get("players", [])
+        ready_players = r.get("ready_players", [])
 
-    if player not in players:
-        return {"ok": True, "msg": "已離開房間"}
+        if player not in players:
+            return {"ok": True, "msg": "已離開房間"}, False
 
-    if player in players:
         players.remove(player)
-    if player in ready_players:
-        ready_players.remove(player)
-
-    r["players"] = players
-    r["ready_players"] = ready_players
-
-    # ✅ 如果沒人，關房
-    if not players:
-        rooms.pop(room_id, None)
-        db.save(ROOMS_FILE, rooms)
-        return {"ok": True, "msg": "房間已關閉"}
-
-    # ✅ NEW：如果離開的是房主，把房主換成剩下的第一個人
-    if r.get("owner") == player:
-        new_owner = players[0]
-        r["owner"] = new_owner
-        # 房主換人時，把開始提議狀態清空比較安全
-        r["start"] = {"state": "idle"}
+        if player in ready_players:
+            ready_players.remove(player)
 
-    # ✅ 若原本在 in_game，有人離開就視為本局結束
-    if r.get("status") == "in_game":
-        r["status"] = "waiting"
-        r["start"] = {"state": "idle"}
+        r["players"] = players
+        r["ready_players"] = ready_players
 
-    rooms[room_id] = r
-    db.save(ROOMS_FILE, rooms)
-    broadcast_room_update(room_id)
+        # ✅ 如果沒人，關房（changed=True：廣播時發現房間已刪除，會順便退訂所有訂閱者）
+        if not players:
+            raise db.Remove(({"ok": True, "msg": "房間已關閉"}, True))
+
+        # ✅ NEW：如果離開的是房主，把房主換成剩下的第一個人
+        if r.get("owner") == player:
+            new_owner = players[0]
+            r["owner"] = new_owner
+            # 房主換人時，把開始提議狀態清空比較安全
+            r["start"] = {"state": "idle"}
+
+        # ✅ 若原本在 in_game，有人離開就視為本局結束
+        if r.get("status") == "in_game":
+            r["status"] = "waiting"
+            r["start"] = {"state": "idle"}
+
+        return {"ok": True, "msg": "已離開房間"}, True
 
-    return {"ok": True, "msg": "已離開房間"}
+    return _update_room(room_id, _leave)
 
 def handle_game_finished(payload):
     """遊戲 server 呼叫：某個 room 的一局已經結束了"""
@@ -737,105 +1403,89 @@ def handle_game_finished(payload):
     if not room_id:
         return {"ok": False, "error": "缺少 room_id"}
 
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
-
-    r = rooms[room_id]
-
     # ✅ 若有要求 kick_all：直接踢 & 關房
     if bool(payload.get("kick_all")):
-        print(f"[Lobby] Kicking all players from room {room_id}", flush=True)
-
-        # 1) 清空玩家並標記為 closed
-        r["players"] = []
-        r["ready_players"] = []
-        r["status"] = "closed"
-        rooms[room_id] = r
-        db.save(ROOMS_FILE, rooms)
-        broadcast_room_update(room_id)
+        def _kick_all(r):
+            if r is None:
+                return _room_not_found()
+            # 1) 清空玩家並標記為 closed
+            r["players"] = []
+            r["ready_players"] = []
+            r["status"] = "closed"
+            return {"ok": True, "msg": "room closed (kicked all)"}, True
 
-        # 2) 給 SSE 一點時間推送
-        time.sleep(0.5)
+        print(f"[Lobby] Kicking all players from room {room_id}", flush=True)
+        resp = _update_room(room_id, _kick_all)
+        if not resp.get("ok"):
+            return resp
 
-        # 3) 刪除房間
-        rooms.pop(room_id, None)
-        db.save(ROOMS_FILE, rooms)
+        # 2) 給訂閱者一點時間收到 closed，再由 room_timers 刪除房間（不佔著 request 執行緒）
+        room_timers.cancel(("game", room_id))
+        _schedule_room_removal(room_id, ROOM_CLOSE_GRACE)
 
-        print(f"[Lobby] Room {room_id} closed and removed", flush=True)
-        return {"ok": True, "msg": "room closed (kicked all)"}
+        print(f"[Lobby] Room {room_id} closed, removing in {ROOM_CLOSE_GRACE}s", flush=True)
+        return resp
 
     # 沒帶 kick_all：僅重設
-    print(f"[Lobby] Resetting room {room_id}", flush=True)
-    r["status"] = "waiting"
-    r["start"] = {"state": "idle"}
-    r["ready_players"] = []
-    rooms[room_id] = r
-    db.save(ROOMS_FILE, rooms)
-    broadcast_room_update(room_id)
-
-    return {"ok": True, "msg": "room reset"}
+    def _reset(r):
+        if r is None:
+            return _room_not_found()
+        r["status"] = "waiting"
+        r["start"] = {"state": "idle"}
+        r["ready_players"] = []
+        return {"ok": True, "msg": "room reset"}, True
 
-def start_room_monitor():
-    """後臺線程：監控長時間未結束的房間"""
-    def monitor():
-        while True:
-            try:
-                time.sleep(10)  # 每 10 秒檢查一次
-                
-                rooms = db.load(ROOMS_FILE, {})
-                now = time.time()
-                
-                for room_id, r in list(rooms.items()):
-                    status = r.get("status")
-                    
-                    # ✅ 檢查 in_game 狀態的房間是否超時
-                    if status == "in_game":
-                        # 假設遊戲最長 5 分鐘
-                        start_ts = r.get("start", {}).get("ts", now)
-                        if now - start_ts > 300:  # 5 分鐘
-                            print(f"[Lobby] ⚠ Room {room_id} timeout (5min), force closing", flush=True)
-                            
-                            # 強制關閉房間
-                            r["players"] = []
-                            r["ready_players"] = []
-                            r["status"] = "closed"
-                            rooms[room_id] = r
-                            db.save(ROOMS_FILE, rooms)
-                            broadcast_room_update(room_id)
-                            
-                            time.sleep(0.5)
-                            rooms.pop(room_id, None)
-                            db.save(ROOMS_FILE, rooms)
-                    
-                    # ✅ 檢查空房間（沒有玩家的房間）
-                    elif len(r.get("players", [])) == 0:
-                        print(f"[Lobby] Removing empty room {room_id}", flush=True)
-                        rooms.pop(room_id, None)
-                        db.save(ROOMS_FILE, rooms)
-            
-            except Exception as e:
-                print(f"[Lobby] Monitor error: {e}", flush=True)
-    
-    t = threading.Thread(target=monitor, daemon=True)
-    t.start()
-    print("[Lobby] Room monitor started", flush=True)
+    print(f"[Lobby] Resetting room {room_id}", flush=True)
+    return _update_room(room_id, _reset)
 
-def serve(host, port, stop_event=None):
+def _schedule_existing_rooms():
+    """
+    啟動時掃一次上次留下來的房間：in_game 的排上對局逾時，沒有玩家的直接刪除。
+    之後房間的 deadline 都在狀態改變時排進 room_timers，不再定期掃描。
+    """
+    rooms = db.load(ROOMS_FILE, {})
+    for room_id, r in list(rooms.items()):
+        if r.get("status") == "in_game":
+            _schedule_game_timeout(room_id, r.get("start", {}).get("ts", int(time.time())))
+        elif len(r.get("players", [])) == 0:
+            print(f"[Lobby] Removing empty room {room_id}", flush=True)
+            _remove_room(room_id)
+    print(f"[Lobby] Room timers scheduled for {len(rooms)} existing rooms", flush=True)
+
+def _startup(host, port):
     global LOBBY_HOST, LOBBY_PORT
     LOBBY_HOST = host
     LOBBY_PORT = port
 
     ensure_user_db()
     
-    # ✅ 新增：啟動房間監控
-    start_room_monitor()
+    # ✅ 上次留下來的房間排上計時器（之後不再定期掃描）；多行程時只由 worker 0 做
+    if WORKER_ID in (None, 0):
+        _schedule_existing_rooms()
     print(f"[Lobby] Running with server_host={host}, PUBLIC_HOST={PUBLIC_HOST}", flush=True)
 
-    s = socket.socket()
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((host, port))
-    s.listen(128)
+async def serve_async(host, port, stop_event=None, workers=32, sock=None):
+    """
+    event loop 版本的 serve()：所有連線共用一個 asyncio loop，
+    handle_* 在最多 workers 條執行緒的 executor 裡執行；閒置的房間訂閱不佔執行緒。
+    """
+    _startup(host, port)
+    await aioserver.serve_json_lines(
+        host, port, _handle_request_async,
+        tag="LobbyServer", workers=workers, stop_event=stop_event,
+        sock=sock,
+    )
+
+def serve(host, port, stop_event=None, sock=None):
+    _startup(host, port)
+
+    # main.py 會先 bind 好再交進來；單獨執行時才自己 bind
+    s = sock
+    if s is None:
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind((host, port))
+        s.listen(128)
 
     # 短 timeout：避免 accept 永遠卡住
     s.settimeout(0.5)
@@ -879,29 +1529,30 @@ def handle_propose_start(payload):
     user = t["user"]
 
     room_id = (payload.get("room_id") or "").strip()
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
 
-    r = rooms[room_id]
-    if r.get("owner") != user:
-        return {"ok": False, "error": "只有房主可以發起開始"}
+    def _propose(r):
+        if r is None:
+            return _room_not_found()
+        if r.get("owner") != user:
+            return {"ok": False, "error": "只有房主可以發起開始"}, False
+        if r.get("status") in ("starting", "failed"):
+            return {"ok": False, "error": "遊戲伺服器尚未就緒"}, False
 
-    players = r.get("players", [])
-    max_players = r.get("max_players", 2)  # ✅ 讀取房間的 max_players
-    
-    # ✅ 修改：使用動態人數檢查，而非寫死 2
-    if len(players) < max_players:
-        return {
-            "ok": False, 
-            "error": f"人數不足，需要 {max_players} 人才能開始（目前 {len(players)} 人）"
-        }
+        players = r.get("players", [])
+        max_players = r.get("max_players", 2)  # ✅ 讀取房間的 max_players
 
-    r["start"] = {"state": "proposed", "by": user, "ts": int(time.time())}
-    r["status"] = "waiting"
-    db.save(ROOMS_FILE, rooms)
-    broadcast_room_update(room_id)
-    return {"ok": True, "msg": "已送出開始提議"}
+        # ✅ 修改：使用動態人數檢查，而非寫死 2
+        if len(players) < max_players:
+            return {
+                "ok": False, 
+                "error": f"人數不足，需要 {max_players} 人才能開始（目前 {len(players)} 人）"
+            }, False
+
+        r["start"] = {"state": "proposed", "by": user, "ts": int(time.time())}
+        r["status"] = "waiting"
+        return {"ok": True, "msg": "已送出開始提議"}, True
+
+    return _update_room(room_id, _propose)
 
 def handle_respond_start(payload):
     token = payload.get("token")
@@ -912,76 +1563,187 @@ def handle_respond_start(payload):
 
     room_id = (payload.get("room_id") or "").strip()
     accept = bool(payload.get("accept"))
-    rooms = db.load(ROOMS_FILE, {})
-    if room_id not in rooms:
-        return {"ok": False, "error": "房間不存在"}
+    started = {}
+
+    def _respond(r):
+        started.clear()
+        if r is None:
+            return _room_not_found()
+
+        if r.get("owner") == user:
+            return {"ok": False, "error": "房主不需要回覆開始提議"}, False
+
+        if r.get("start", {}).get("state") != "proposed":
+            return {"ok": False, "error": "目前沒有開始提議"}, False
+
+        # ❌ 拒絕：立即結束提議
+        if not accept:
+            r["start"] = {
+                "state": "rejected", 
+                "by": r.get("owner"), 
+                "rejected_by": user,  # ✅ 記錄誰拒絕的
+                "ts": int(time.time())
+            }
+            return {"ok": True, "msg": "已拒絕開始"}, True  # ✅ 確保廣播
 
-    r = rooms[room_id]
-    
-    if r.get("owner") == user:
-        return {"ok": False, "error": "房主不需要回覆開始提議"}
-
-    if r.get("start", {}).get("state") != "proposed":
-        return {"ok": False, "error": "目前沒有開始提議"}
-
-    # ❌ 拒絕：立即結束提議
-    if not accept:
-        r["start"] = {
-            "state": "rejected", 
-            "by": r.get("owner"), 
-            "rejected_by": user,  # ✅ 記錄誰拒絕的
-            "ts": int(time.time())
-        }
-        db.save(ROOMS_FILE, rooms)
-        broadcast_room_update(room_id)  # ✅ 確保廣播
-        return {"ok": True, "msg": "已拒絕開始"}
-
-    # ✅ 同意：記錄此玩家的同意狀態
-    start_data = r.get("start", {})
-    if "responses" not in start_data:
-        start_data["responses"] = {}
-    
-    start_data["responses"][user] = True
-    r["start"] = start_data
-    
-    # ✅ 檢查是否所有房客都同意了
-    players = r.get("players", [])
-    owner = r.get("owner")
-    guests = [p for p in players if p != owner]
-    
-    responses = start_data.get("responses", {})
-    all_agreed = all(responses.get(guest, False) for guest in guests)
-    
-    if all_agreed:
-        # ✅ 所有房客都同意了，可以開始
-        r["start"] = {"state": "agreed", "by": owner, "ts": int(time.time())}
-        r["status"] = "in_game"
-        r["ready_players"] = []
-        db.save(ROOMS_FILE, rooms)
-        broadcast_room_update(room_id)
+        # ✅ 同意：記錄此玩家的同意狀態
+        start_data = r.get("start", {})
+        if "responses" not in start_data:
+            start_data["responses"] = {}
 
-        try:
-            _mark_played(r["game"], players)
-        except Exception:
-            pass
+        start_data["responses"][user] = True
+        r["start"] = start_data
+
+        # ✅ 檢查是否所有房客都同意了
+        players = r.get("players", [])
+        owner = r.get("owner")
+        guests = [p for p in players if p != owner]
+
+        responses = start_data.get("responses", {})
+        all_agreed = all(responses.get(guest, False) for guest in guests)
+
+        if all_agreed:
+            # ✅ 所有房客都同意了，可以開始
+            r["start"] = {"state": "agreed", "by": owner, "ts": int(time.time())}
+            r["status"] = "in_game"
+            r["ready_players"] = []
+            started.update(game=r["game"], players=list(players), ts=r["start"]["ts"])
+            return {"ok": True, "msg": "對局開始"}, True
 
-        return {"ok": True, "msg": "對局開始"}
-    else:
         # ✅ 關鍵修正：即使還沒全部同意，也要廣播更新
-        db.save(ROOMS_FILE, rooms)
-        broadcast_room_update(room_id)  # ⭐ 這裡是關鍵！
-        
         not_responded = [g for g in guests if not responses.get(g, False)]
         agreed_count = len(guests) - len(not_responded)
         total_guests = len(guests)
-        
+
         return {
             "ok": True, 
             "msg": f"已記錄你的同意，等待其他玩家回應（{agreed_count}/{total_guests}）\n等待中：{', '.join(not_responded)}"
-        }
+        }, True  # ⭐ 這裡是關鍵！
+
+    resp = _update_room(room_id, _respond)
+
+    # 只有真正寫入成功的那一次才記錄遊玩次數（mutator 可能被重跑）
+    if started:
+        _schedule_game_timeout(room_id, started["ts"])
+        try:
+            _mark_played(started["game"], started["players"])
+        except Exception:
+            pass
+
+    return resp
+
+# 一般 request → response
+def handle_server_stats(payload):
+    """監控用：目前的訂閱者數量、遊戲伺服器行程數等 gauge"""
+    with _host_lock:
+        hosts = {f"{g}@{v}": pool.stats() for (g, v), pool in _host_pools.items()}
+    return {"ok": True, "worker": WORKER_ID, "push": push_hub.stats(), "games": game_procs.stats(), "hosts": hosts,
+            "agents": _get_agent_pool().stats() if GAME_AGENTS else {},
+            "timers": room_timers.stats()}
+
+HANDLERS = {
+    "register": handle_register,
+    "login": handle_login,
+    "list_games": handle_list_games,
+    "game_details": handle_game_details,
+    "download_game": handle_download_game,
+    "file_manifest": handle_file_manifest,
+    "list_rooms": handle_list_rooms,
+    "create_room": handle_create_room,
+    "join_room": handle_join_room,
+    "leave_room": handle_leave_room,
+    "player_ready": handle_player_ready,
+    "player_unready": handle_player_unready,
+    "propose_start": handle_propose_start,
+    "respond_start": handle_respond_start,
+    "logout": handle_logout,
+    "rate_game": handle_rate_game,
+    "game_finished": handle_game_finished,
+    "server_stats": handle_server_stats,
+    "room_logs": handle_room_logs,
+}
+
+# 自己對連線送 header + 二進位內容的 kind：handler(req, conn)
+# 訂閱類 request：回應之後連線（或 session）繼續收推播
+SUBSCRIBE_HANDLERS = {
+    "subscribe_room": handle_subscribe_room,
+    "subscribe_lobby": handle_subscribe_lobby,
+}
+
+STREAM_HANDLERS = {
+    "download_game_stream": handle_download_game_stream,
+    "download_delta": handle_download_delta,
+}
+
+def _dispatch(req):
+    kind = req.get("kind")
+    if kind == "game_finished":
+        print(f"[LobbyServer] Processing game_finished: {req}", flush=True)
+    handler = HANDLERS.get(kind)
+    if handler is None:
+        return {"ok": False, "error": f"unknown kind: {kind}"}
+    return handler(req)
+
+async def _session_request(conn, req):
+    """
+    session 模式下的單一 request。房間事件直接推到這條 session 連線上，
+    連線斷掉時由 unsubscribe_all 清掉訂閱。
+    """
+    kind = req.get("kind")
+    print(f"[LobbyServer] Session request from {conn.addr}: id={req.get('id')} kind={kind}", flush=True)
+    if kind in STREAM_HANDLERS:
+        return {"ok": False, "error": "二進位下載請使用獨立連線"}
+    if kind in SUBSCRIBE_HANDLERS:
+        return await conn.run(SUBSCRIBE_HANDLERS[kind], req, conn)
+    if kind == "unsubscribe_room":
+        unsubscribe_room(req.get("room_id", ""), conn)
+        return {"ok": True}
+    if kind == "unsubscribe_lobby":
+        unsubscribe_lobby(conn, (req.get("game") or "").strip() or None)
+        return {"ok": True}
+    return await conn.run(_dispatch, req)
+
+async def _handle_request_async(conn, line):
+    """serve_async 的單一連線：跟 _handle_conn 相同的流程，handler 丟到 executor 執行"""
+    text = line.decode("utf-8", errors="ignore").strip()
+    print(f"[LobbyServer] Received from {conn.addr}: {text[:120]}", flush=True)
+
+    try:
+        req = json.loads(text)
+    except json.JSONDecodeError as e:
+        print(f"[LobbyServer] ✗ JSON decode error from {conn.addr}: {e}", flush=True)
+        await conn.send_json({"ok": False, "error": "Invalid JSON"})
+        return
+
+    kind = req.get("kind")
+    if kind == "session":
+        await conn.send_json({"ok": True, "session": True})
+        try:
+            await aioserver.run_session(conn, lambda r: _session_request(conn, r))
+        finally:
+            unsubscribe_all(conn)
+        return
+
+    if kind in STREAM_HANDLERS:
+        await conn.run(STREAM_HANDLERS[kind], req, conn)
+        return
+
+    if kind in SUBSCRIBE_HANDLERS:
+        resp = await conn.run(SUBSCRIBE_HANDLERS[kind], req, conn, True)
+        if not resp.get("ok"):
+            await conn.send_json(resp)
+            return
+        # ✅ 保持連線作為 SSE 通道：只是一個等待 EOF 的 coroutine，不佔執行緒
+        push_hub.release(conn, (json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
+        await conn.wait_eof()
+        push_hub.drop(conn)
+        return
+
+    await conn.send_json(await conn.run(_dispatch, req))
 
 def _handle_conn(conn, addr):
     data = b""
+    handed_off = False   # 訂閱連線交給 push_hub 後不能在這裡關閉
     try:
         timeout_count = 0
         max_timeout = 3
@@ -1025,53 +1787,28 @@ def _handle_conn(conn, addr):
 
         kind = req.get("kind")
 
-        if kind == "register":
-            resp = handle_register(req)
-        elif kind == "login":
-            resp = handle_login(req)
-        elif kind == "list_games":
-            resp = handle_list_games(req)
-        elif kind == "game_details":
-            resp = handle_game_details(req)
-        elif kind == "download_game":
-            resp = handle_download_game(req)
-        elif kind == "list_rooms":
-            resp = handle_list_rooms(req)
-        elif kind == "create_room":
-            resp = handle_create_room(req)
-        elif kind == "join_room":
-            resp = handle_join_room(req)
-        elif kind == "leave_room":
-            resp = handle_leave_room(req)
-        elif kind == "player_ready":
-            resp = handle_player_ready(req)
-        elif kind == "player_unready":
-            resp = handle_player_unready(req)
-        elif kind == "propose_start":
-            resp = handle_propose_start(req)
-        elif kind == "respond_start":
-            resp = handle_respond_start(req)
-        elif kind == "logout":
-            resp = handle_logout(req)
-        elif kind == "rate_game":
-            resp = handle_rate_game(req)
-
-        elif kind == "game_finished":
-            print(f"[LobbyServer] Processing game_finished: {req}", flush=True)
-            resp = handle_game_finished(req)
-
-        elif kind == "subscribe_room":
-            resp = handle_subscribe_room(req, conn)
+        if kind in STREAM_HANDLERS:
+            STREAM_HANDLERS[kind](req, conn)
+            return
+
+        if kind == "session":
+            resp = {"ok": False, "error": "session 模式需要 server.mode = asyncio"}
             conn.sendall((json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
-            if resp.get("ok"):
-                # ✅ 保持連線作為 SSE 通道
-                while True:
-                    time.sleep(10)
             return
 
-        else:
-            resp = {"ok": False, "error": f"unknown kind: {kind}"}
+        if kind in SUBSCRIBE_HANDLERS:
+            resp = SUBSCRIBE_HANDLERS[kind](req, conn, dedicated=True)
+            line = (json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8")
+            if not resp.get("ok"):
+                conn.sendall(line)
+                return
+            # ✅ 連線交給 PushHub 的 selector 執行緒當 SSE 通道，這條執行緒直接結束
+            conn.settimeout(None)
+            push_hub.release(conn, line)
+            handed_off = True
+            return
 
+        resp = _dispatch(req)
         conn.sendall((json.dumps(resp, ensure_ascii=False) + "\n").encode("utf-8"))
 
     except Exception as e:
@@ -1083,7 +1820,8 @@ def _handle_conn(conn, addr):
             pass
 
     finally:
-        try:
-            conn.close()
-        except Exception:
-            pass
+        if not handed_off:
+            try:
+                conn.close()
+            except Exception:
+                pass
@@ -0,0 +1,178 @@
+# server/lobby_workers.py
+"""
+多行程 lobby（config.json "server": {"lobby_processes": N}，需要 POSIX 的 SO_REUSEPORT 與 db.backend = sqlite）：
+
+  - main.py 用 SO_REUSEPORT bind 好 lobby port（不 listen，只是佔住 port 號碼），再啟動 N 個 worker 行程；
+    每個 worker 自己用 SO_REUSEPORT bind + listen 同一個 port，新連線由 kernel 分給各 worker，
+    每個 worker 都有自己的 GIL 與 asyncio loop
+  - 房間 / 遊戲 / 使用者本來就在 SQLite（跨行程的版本號 CAS），登入 session 也改存 SQLite（auth.configure(shared=True)）
+  - 房間變動的通知：每個 worker 跟 main 之間一條 AF_UNIX SOCK_SEQPACKET（環境變數 LOBBY_BUS_FD），
+    worker 送出變動的 room_id，main 轉給其他 worker（lobby_server.attach_worker）
+  - worker 意外結束時 main 會重新啟動它；main 結束時 worker 讀到 bus EOF 也會跟著結束
+
+這個檔案同時也是 worker 行程本身的程式（python lobby_workers.py，參數都在環境變數裡）。
+"""
+import asyncio, json, os, selectors, signal, socket, subprocess, sys, threading, time
+from pathlib import Path
+
+SERVER_DIR = Path(__file__).resolve().parent
+MAX_MSG = 4096
+RESTART_DELAY = 1.0           # 秒：worker 結束後至少隔這麼久才重新啟動（避免一直當掉時狂開）
+
+def supported(db_backend) -> bool:
+    return hasattr(socket, "SO_REUSEPORT") and os.name == "posix" and db_backend == "sqlite"
+
+def reuseport_socket(host, port, listen=True):
+    s = socket.socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    try:
+        s.bind((host, port))
+        if listen:
+            s.listen(128)
+    except OSError:
+        s.close()
+        raise
+    return s
+
+def _socketpair():
+    # 跟 zygote 一樣只用 SOCK_SEQPACKET：DGRAM 收不到 EOF，worker 掛掉時 main 不會發現
+    if not hasattr(socket, "SOCK_SEQPACKET"):
+        raise OSError("平台不支援 SOCK_SEQPACKET，無法使用多行程 lobby")
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+# ================= main 端 ================= #
+
+class LobbyWorkers:
+    def __init__(self, host, port, count, threads=32, db_conf=None):
+        self.host = host
+        self.port = port
+        self.count = count
+        self.threads = threads
+        self.db_conf = dict(db_conf or {})
+        from common import db
+        self.data_dir = db.DATA_DIR
+        self.procs = {}                    # worker id -> Popen
+        self.bus = {}                      # worker id -> main 這端的 bus socket
+        self.started = {}                  # worker id -> 啟動時間
+        self.relayed = 0
+        self._sel = selectors.DefaultSelector()
+        self._stopping = False
+
+    def start(self):
+        for i in range(self.count):
+            self._spawn(i)
+        threading.Thread(target=self._relay, name="lobby-bus", daemon=True).start()
+        print(f"[LobbyWorkers] {self.count} 個 lobby worker 共用 port {self.port}（SO_REUSEPORT）", flush=True)
+
+    def stop(self):
+        self._stopping = True
+        procs = list(self.procs.values())
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+        for proc in procs:
+            try:
+                proc.wait(timeout=3)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    async def serve(self, stop_event):
+        """給 main.py 的 asyncio.gather 用：啟動 worker，等到 stop_event 才收掉"""
+        loop = asyncio.get_running_loop()
+        self.start()
+        try:
+            await loop.run_in_executor(None, stop_event.wait)
+        finally:
+            await loop.run_in_executor(None, self.stop)
+
+    def _spawn(self, i):
+        mine, child = _socketpair()
+        mine.settimeout(0.5)               # 某個 worker 卡住時不要拖住整條 bus
+        env = os.environ.copy()
+        env.update({
+            "LOBBY_WORKER_ID": str(i),
+            "LOBBY_BUS_FD": str(child.fileno()),
+            "LOBBY_LISTEN": f"{self.host}:{self.port}",
+            "LOBBY_THREADS": str(self.threads),
+            "LOBBY_DB": json.dumps(self.db_conf),
+            "LOBBY_DATA_DIR": str(self.data_dir),
+        })
+        try:
+            proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)], cwd=str(SERVER_DIR),
+                                    env=env, stdin=subprocess.DEVNULL, pass_fds=(child.fileno(),))
+        except Exception:
+            mine.close()
+            raise
+        finally:
+            child.close()
+        old = self.bus.pop(i, None)
+        if old is not None:
+            try:
+                self._sel.unregister(old)
+            except (KeyError, ValueError):
+                pass
+            old.close()
+        self.bus[i] = mine
+        self.procs[i] = proc
+        self.started[i] = time.monotonic()
+        self._sel.register(mine, selectors.EVENT_READ, i)
+
+    def _relay(self):
+        # 只有這條執行緒會動 selector / 重啟 worker（start() 在它開始之前就把第一批 worker 開好了）
+        while not self._stopping:
+            for key, _ in self._sel.select(timeout=RESTART_DELAY):
+                try:
+                    data = key.fileobj.recv(MAX_MSG)
+                except OSError:
+                    data = b""
+                if not data:
+                    self._sel.unregister(key.fileobj)   # worker 結束了：下面重新啟動
+                    continue
+                self.relayed += 1
+                for j, s in list(self.bus.items()):
+                    if j == key.data:
+                        continue
+                    try:
+                        s.send(data)
+                    except OSError as e:
+                        print(f"[LobbyWorkers] worker {j} bus send error: {e}", flush=True)
+
+            now = time.monotonic()
+            for i, proc in list(self.procs.items()):
+                if self._stopping or proc.poll() is None or now - self.started[i] < RESTART_DELAY:
+                    continue
+                print(f"[LobbyWorkers] worker {i} exited (code={proc.returncode})，重新啟動", flush=True)
+                try:
+                    self._spawn(i)
+                except Exception as e:
+                    print(f"[LobbyWorkers] worker {i} 重新啟動失敗：{e}", flush=True)
+                    self.started[i] = now
+
+# ================= worker 行程 ================= #
+
+def worker_main():
+    # Ctrl+C 由 main 處理（main 收到後 terminate 所有 worker）。不用 SIG_IGN：那會被遊戲伺服器繼承
+    signal.signal(signal.SIGINT, lambda *a: None)
+    worker_id = int(os.environ.pop("LOBBY_WORKER_ID"))
+    bus = socket.socket(fileno=int(os.environ.pop("LOBBY_BUS_FD")))
+    host, _, port = os.environ.pop("LOBBY_LISTEN").rpartition(":")
+    threads = int(os.environ.pop("LOBBY_THREADS", "32"))
+    db_conf = json.loads(os.environ.pop("LOBBY_DB", "{}"))
+
+    from common import db, auth
+    db.DATA_DIR = Path(os.environ.pop("LOBBY_DATA_DIR", str(db.DATA_DIR)))
+    db.configure(db_conf.pop("backend", "sqlite"), **db_conf)
+    auth.configure(shared=True)
+    import lobby_server
+    lobby_server.attach_worker(worker_id, bus)
+
+    sock = reuseport_socket(host, int(port))
+    print(f"[LobbyWorkers] worker {worker_id} (pid {os.getpid()}) listening on {host}:{port}", flush=True)
+    try:
+        asyncio.run(lobby_server.serve_async(host, int(port), workers=threads, sock=sock))
+    finally:
+        db.flush()
+
+if __name__ == "__main__":
+    worker_main()
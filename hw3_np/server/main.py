@@ -1,8 +1,10 @@
 # server/main.py - 修正 IP 偵測與連線問題
 import json, asyncio, threading, urllib.request, socket, re
 from pathlib import Path
-from dev_server import serve as serve_dev_sync
-from lobby_server import serve as serve_lobby_sync
+from dev_server import serve as serve_dev_sync, serve_async as serve_dev_async
+from lobby_server import serve as serve_lobby_sync, serve_async as serve_lobby_async
+from lobby_workers import LobbyWorkers, supported as lobby_workers_supported
+from common import db, auth
 
 ROOT = Path(__file__).resolve().parents[1]
 CONF = json.loads((ROOT / "config.json").read_text(encoding="utf-8"))
@@ -73,40 +75,61 @@ def get_public_ip():
     print("[Main] ⚠️  IP 偵測失敗，使用 127.0.0.1")
     return "127.0.0.1"
 
-def _pick_free_port(min_port=10000, max_port=65535):
-    """在指定範圍內尋找可用 port"""
+def _listen_socket(host, port=None, min_port=10000, max_port=65535, reuse_port=False):
+    """
+    直接 bind + listen 好 server 要用的 socket 再交給 server，
+    不再「找空 port → 關掉 → server 再 bind」（中間可能被別人搶走）。
+    port 沒指定或已被占用時讓 kernel 挑一個（一次就成功），不在範圍內才隨機試幾個。
+    reuse_port=True：設 SO_REUSEPORT 但不 listen，只佔住 port 號碼給多個 lobby worker 各自 bind + listen。
+    """
     import random
-    
-    for _ in range(100):
-        port = random.randint(min_port, max_port)
+
+    candidates = [port] if port else []
+    candidates.append(0)
+    candidates += [random.randint(min_port, max_port) for _ in range(20)]
+    for p in candidates:
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
-            s = socket.socket()
-            s.bind(("0.0.0.0", port))
-            actual_port = s.getsockname()[1]
-            s.close()
-            return actual_port
+            s.bind((host, p))
         except OSError:
+            s.close()
             continue
-    
-    s = socket.socket()
-    s.bind(("0.0.0.0", 0))
-    port = s.getsockname()[1]
-    s.close()
-    
-    if port < min_port:
-        return _pick_free_port(min_port, max_port)
-    
-    return port
+        if p == 0 and not (min_port <= s.getsockname()[1] <= max_port):
+            s.close()
+            continue
+        if not reuse_port:
+            s.listen(128)
+        return s
+    raise OSError(f"找不到可用的 port（{min_port}-{max_port}）")
 
-async def run_dev_server(host, port, stop_event):
+async def run_dev_server(host, port, stop_event, sock=None):
     loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, serve_dev_sync, host, port, stop_event)
+    await loop.run_in_executor(None, serve_dev_sync, host, port, stop_event, sock)
 
-async def run_lobby_server(host, port, stop_event):
+async def run_lobby_server(host, port, stop_event, sock=None):
     loop = asyncio.get_running_loop()
-    await loop.run_in_executor(None, serve_lobby_sync, host, port, stop_event)
+    await loop.run_in_executor(None, serve_lobby_sync, host, port, stop_event, sock)
 
 async def main():
+    # 資料庫儲存模式（config.json 的 "db" 區塊，沒寫就用舊的整檔覆寫）
+    db_conf = dict(CONF.get("db") or {})
+    db_backend = db_conf.pop("backend", "json")
+    db.configure(db_backend, **db_conf)
+
+    # 伺服器模式（config.json 的 "server" 區塊）：
+    #   asyncio（預設）：所有連線共用 event loop，handler 在固定大小的 executor 執行
+    #   threads       ：舊版，每條連線一個執行緒
+    #   lobby_processes > 1：lobby 改成多個 worker 行程共用同一個 port（lobby_workers.py）
+    server_conf = CONF.get("server") or {}
+    workers = int(server_conf.get("workers", 32))
+    lobby_procs = int(server_conf.get("lobby_processes", 1))
+    if lobby_procs > 1 and not lobby_workers_supported(db_backend):
+        print("[Main] ⚠️  多行程 lobby 需要 SO_REUSEPORT（Linux / BSD）與 db.backend = sqlite，改用單一行程")
+        lobby_procs = 1
+
     runtime_data = {}
     if RUNTIME_FILE.exists():
         try:
@@ -114,17 +137,15 @@ async def main():
         except:
             runtime_data = {}
     
-    # 動態分配 port
-    dev_port = runtime_data.get("developer_port")
-    lobby_port = runtime_data.get("lobby_port")
-    
-    if not dev_port:
-        dev_port = _pick_free_port(10000, 65535)
-    if not lobby_port:
-        lobby_port = _pick_free_port(10000, 65535)
-    
-    if dev_port == lobby_port:
-        lobby_port = _pick_free_port(10000, 65535)
+    # Server 綁定的 IP（接受所有來源）
+    host_dev = CONF.get("developer_endpoint", {}).get("host", "0.0.0.0")
+    host_lobby = CONF.get("lobby_endpoint", {}).get("host", "0.0.0.0")
+
+    # 動態分配 port：沿用上次的 port（被占用就換一個），socket 直接 bind 好交給 server
+    dev_sock = _listen_socket(host_dev, runtime_data.get("developer_port"))
+    lobby_sock = _listen_socket(host_lobby, runtime_data.get("lobby_port"), reuse_port=lobby_procs > 1)
+    dev_port = dev_sock.getsockname()[1]
+    lobby_port = lobby_sock.getsockname()[1]
 
     picked = pick_public_ip_from_list(CONF)
     if picked:
@@ -146,10 +167,6 @@ async def main():
         print(f"[Main] 如果 Client 在同一台機器，將使用 127.0.0.1")
         public_ip = "127.0.0.1"
 
-    # Server 綁定的 IP（接受所有來源）
-    host_dev = CONF.get("developer_endpoint", {}).get("host", "0.0.0.0")
-    host_lobby = CONF.get("lobby_endpoint", {}).get("host", "0.0.0.0")
-
     # 保存 runtime ports
     runtime_data = {
         "developer_port": dev_port, 
@@ -181,16 +198,30 @@ async def main():
 
     stop_event = threading.Event()
 
+    if server_conf.get("mode", "asyncio") == "threads":
+        dev = run_dev_server(host_dev, dev_port, stop_event, dev_sock)
+    else:
+        dev = serve_dev_async(host_dev, dev_port, stop_event, workers=workers, sock=dev_sock)
+    if lobby_procs > 1:
+        # 登入 session 改存 SQLite（每個 worker 都看得到），上次留下的先清掉；
+        # main 手上的 lobby_sock 只是佔住 port，連線都由 worker 接
+        auth.configure(shared=True, reset=True)
+        lobby = LobbyWorkers(host_lobby, lobby_port, lobby_procs, threads=workers,
+                             db_conf={"backend": db_backend, **db_conf}).serve(stop_event)
+    elif server_conf.get("mode", "asyncio") == "threads":
+        lobby = run_lobby_server(host_lobby, lobby_port, stop_event, lobby_sock)
+    else:
+        lobby = serve_lobby_async(host_lobby, lobby_port, stop_event, workers=workers, sock=lobby_sock)
+    servers = [dev, lobby]
+
     try:
-        await asyncio.gather(
-            run_dev_server(host_dev, dev_port, stop_event),
-            run_lobby_server(host_lobby, lobby_port, stop_event),
-        )
+        await asyncio.gather(*servers)
     except (asyncio.CancelledError, KeyboardInterrupt):
         print("\n[Main] Ctrl+C detected, stopping servers...")
         stop_event.set()
         await asyncio.sleep(1.0)
     finally:
+        db.flush()
         print("[Main] Bye.")
 
 if __name__ == "__main__":
@@ -0,0 +1,23 @@
+# server/tests/conftest.py
+"""
+測試共用設定：在 server/ 底下執行 python -m pytest -q。
+server/ 放進 sys.path（跟 main.py 一樣用 from common import ... 匯入），
+資料庫一律寫到每個測試自己的暫存資料夾，不碰 server/data。
+"""
+import sys
+from pathlib import Path
+
+import pytest
+
+SERVER_DIR = Path(__file__).resolve().parents[1]
+if str(SERVER_DIR) not in sys.path:
+    sys.path.insert(0, str(SERVER_DIR))
+
+from common import db
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    """db.DATA_DIR 換成暫存資料夾；測試結束時關掉測試開的 store、換回預設的 json backend"""
+    monkeypatch.setattr(db, "DATA_DIR", tmp_path)
+    yield tmp_path
+    db.configure("json")
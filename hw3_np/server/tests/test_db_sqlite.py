@@ -0,0 +1,100 @@
+# server/tests/test_db_sqlite.py
+"""sqlite backend：JSON → SQLite 匯入、版本號不重複使用、非 dict 的 collection"""
+import json
+
+from common import db
+
+COLLECTIONS = {
+    "games.json": {
+        "rps": {
+            "author": "dev", "status": "active", "latest": "1.1.0", "avg_rating": 4.5, "review_count": 2,
+            "versions": {"1.0.0": {"path": "rps/1.0.0"}, "1.1.0": {"path": "rps/1.1.0"}},
+            "reviews": {"alice": {"rating": 5, "text": "好玩", "ts": 1}, "bob": {"rating": 4, "text": "", "ts": 2}},
+        },
+        "tetris": {"author": "dev", "status": "inactive", "latest": "1.0.0", "versions": {}, "reviews": {}},
+    },
+    "rooms.json": {"r1": {"game": "rps", "status": "waiting", "owner": "alice", "players": ["alice"]}},
+    "dev_users.json": {"dev": {"password": "x"}},
+    "player_users.json": {"alice": {"password": "y"}, "bob": {"password": "z"}},
+    "tokens.json": {"t1": {"username": "alice", "role": "player"}},
+    "history.json": [{"room": "r0", "winner": "bob"}],
+}
+
+def _write_json(data_dir):
+    for name, data in COLLECTIONS.items():
+        (data_dir / name).write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+
+def test_migrate_round_trip(data_dir):
+    _write_json(data_dir)
+    # wal 模式還沒 compaction 的 log 也要一起匯入
+    (data_dir / "rooms.json.wal").write_text(
+        json.dumps({"op": "set", "key": "r2", "value": {"game": "rps", "status": "playing"}}) + "\n"
+        + json.dumps({"op": "del", "key": "r1"}) + "\n",
+        encoding="utf-8",
+    )
+    s = db._SqliteStore()
+    try:
+        for name, data in COLLECTIONS.items():
+            if name != "rooms.json":
+                assert s.load(name) == data, name
+        assert s.load("rooms.json") == {"r2": {"game": "rps", "status": "playing"}}
+        assert s.get("games.json", "rps")["reviews"]["alice"]["text"] == "好玩"
+        # 舊 JSON 檔留著當備份
+        assert json.loads((data_dir / "games.json").read_text(encoding="utf-8")) == COLLECTIONS["games.json"]
+    finally:
+        s.close()
+
+def test_migrate_runs_once(data_dir):
+    _write_json(data_dir)
+    s = db._SqliteStore()
+    s.delete("rooms.json", "r1")
+    s.close()
+    s = db._SqliteStore()       # 已經匯入過：不會把 JSON 裡的 r1 再匯進來
+    try:
+        assert s.load("rooms.json") == {}
+    finally:
+        s.close()
+
+def test_migrate_force_reimports(data_dir):
+    _write_json(data_dir)
+    s = db._SqliteStore()
+    try:
+        s.delete("rooms.json", "r1")
+        db.migrate_json_to_sqlite(s, force=True)
+        assert s.load("rooms.json") == COLLECTIONS["rooms.json"]
+    finally:
+        s.close()
+
+def test_versions_are_not_reused_after_delete(data_dir):
+    s = db._SqliteStore()
+    try:
+        s.put("rooms.json", "r1", {"status": "waiting"})
+        old, ver = s.get_versioned("rooms.json", "r1")
+        s.delete("rooms.json", "r1")
+        s.put("rooms.json", "r1", {"status": "waiting"})
+        # 同一個 key 刪掉再建立：舊的讀取結果不能寫進新資料（ABA）
+        assert s.get_versioned("rooms.json", "r1")[1] != ver
+        assert not s.cas("rooms.json", "r1", ver, dict(old, status="playing"))
+    finally:
+        s.close()
+
+    s = db._SqliteStore()       # 重開之後計數器接著算
+    try:
+        s.put("rooms.json", "r2", {})
+        assert s.get_versioned("rooms.json", "r2")[1] > ver
+    finally:
+        s.close()
+
+def test_non_dict_collections(data_dir):
+    s = db._SqliteStore()
+    try:
+        s.save("history.json", [1, 2, 3])
+        assert s.load("history.json") == [1, 2, 3]
+        s.save("history.json", {"a": 1})
+        assert s.load("history.json") == {"a": 1}
+        s.save("history.json", ["x"])
+        assert s.load("history.json") == ["x"]
+        s.put("history.json", "b", 2)       # 逐筆寫入把整份換成 dict（跟記憶體 backend 一樣）
+        assert s.load("history.json") == {"b": 2}
+    finally:
+        s.close()
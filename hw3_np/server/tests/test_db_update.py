@@ -0,0 +1,113 @@
+# server/tests/test_db_update.py
+"""db.update()：compare-and-swap 的重試、Remove、Conflict（每種 backend 都跑一次）"""
+import threading
+
+import pytest
+
+from common import db
+
+NAME = "rooms.json"
+
+@pytest.fixture(params=sorted(db.BACKENDS))
+def backend(request, data_dir):
+    db.configure(request.param)
+    return request.param
+
+def test_update_writes_and_returns_result(backend):
+    db.put(NAME, "r1", {"players": []})
+
+    def _join(room):
+        room["players"].append("alice")
+        return {"ok": True}
+
+    assert db.update(NAME, "r1", _join) == {"ok": True}
+    assert db.get(NAME, "r1") == {"players": ["alice"]}
+
+def test_update_without_change_does_not_write(backend):
+    db.put(NAME, "r1", {"n": 1})
+    _, ver = db.get_versioned(NAME, "r1")
+    assert db.update(NAME, "r1", lambda room: "unchanged") == "unchanged"
+    assert db.get_versioned(NAME, "r1") == ({"n": 1}, ver)
+
+def test_update_missing_key_uses_default(backend):
+    assert db.update(NAME, "r1", lambda room: room is None) is True
+    assert db.get(NAME, "r1") is None
+
+    def _init(room):
+        room["n"] += 1
+    db.update(NAME, "r1", _init, default={"n": 0})
+    assert db.get(NAME, "r1") == {"n": 1}
+
+def test_update_retries_after_concurrent_write(backend):
+    db.put(NAME, "r1", {"n": 0, "tags": []})
+    calls = []
+
+    def _bump(room):
+        calls.append(dict(room))
+        if len(calls) == 1:
+            # 讀完之後、寫回之前別人改了這筆資料 → 這次 cas 失敗，要用新資料重跑
+            db.put(NAME, "r1", {"n": 10, "tags": ["other"]})
+        room["n"] += 1
+        room["tags"].append("mine")
+
+    db.update(NAME, "r1", _bump)
+    assert len(calls) == 2
+    assert calls[1]["n"] == 10
+    assert db.get(NAME, "r1") == {"n": 11, "tags": ["other", "mine"]}
+
+def test_update_remove(backend):
+    db.put(NAME, "r1", {"n": 1})
+
+    def _close(room):
+        raise db.Remove({"ok": True, "closed": room["n"]})
+
+    assert db.update(NAME, "r1", _close) == {"ok": True, "closed": 1}
+    assert db.get(NAME, "r1") is None
+    assert db.update(NAME, "r1", _close_missing) == "gone"     # 已經不存在：不用寫入
+
+def _close_missing(room):
+    assert room is None
+    raise db.Remove("gone")
+
+def test_update_remove_loses_to_concurrent_write(backend):
+    db.put(NAME, "r1", {"n": 1})
+    seen = []
+
+    def _close_if_one(room):
+        seen.append(room["n"])
+        if len(seen) == 1:
+            db.put(NAME, "r1", {"n": 2})
+        if room["n"] == 1:
+            raise db.Remove("removed")
+        return "kept"
+
+    assert db.update(NAME, "r1", _close_if_one) == "kept"
+    assert seen == [1, 2]
+    assert db.get(NAME, "r1") == {"n": 2}
+
+def test_update_gives_up_with_conflict(backend):
+    db.put(NAME, "r1", {"n": 0})
+
+    def _always_raced(room):
+        db.put(NAME, "r1", {"n": room["n"] + 100})
+        room["n"] += 1
+
+    with pytest.raises(db.Conflict):
+        db.update(NAME, "r1", _always_raced, retries=3)
+
+def test_concurrent_updates_do_not_lose_writes(backend):
+    db.put(NAME, "counter", {"n": 0})
+
+    def _inc(room):
+        room["n"] += 1
+
+    def _worker():
+        for _ in range(50):
+            db.update(NAME, "counter", _inc, retries=10000)
+
+    threads = [threading.Thread(target=_worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db.get(NAME, "counter") == {"n": 400}
@@ -0,0 +1,93 @@
+# server/tests/test_db_wal.py
+"""wal backend：重播 log、compaction，以及 compaction 失敗後留下的 .wal.1"""
+import json
+
+from common import db
+
+NAME = "rooms.json"
+
+def _reopen(store):
+    store.close()
+    return db._WalStore(compact_records=10 ** 9)
+
+def test_replay_after_reopen(data_dir):
+    s = db._WalStore(compact_records=10 ** 9)
+    s.put(NAME, "r1", {"status": "waiting"})
+    s.put(NAME, "r2", {"status": "playing"})
+    s.delete(NAME, "r1")
+    s.save(NAME, {"r2": {"status": "finished"}, "r3": {"status": "waiting"}})
+    s = _reopen(s)
+    try:
+        assert s.load(NAME) == {"r2": {"status": "finished"}, "r3": {"status": "waiting"}}
+        assert not (data_dir / NAME).exists()      # 還沒 compaction：只有 log
+    finally:
+        s.close()
+
+def test_torn_last_line_is_ignored(data_dir):
+    s = db._WalStore(compact_records=10 ** 9)
+    s.put(NAME, "r1", {"n": 1})
+    s.close()
+    with open(data_dir / (NAME + ".wal"), "a", encoding="utf-8") as f:
+        f.write('{"op": "set", "key": "r2", "val')      # crash 在寫到一半
+    s = db._WalStore(compact_records=10 ** 9)
+    try:
+        assert s.load(NAME) == {"r1": {"n": 1}}
+    finally:
+        s.close()
+
+def test_compaction_writes_snapshot_and_resets_log(data_dir):
+    s = db._WalStore(compact_records=5)
+    for i in range(5):
+        s.put(NAME, f"r{i}", {"n": i})
+    s.close()       # 等背景 compaction 做完
+    expected = {f"r{i}": {"n": i} for i in range(5)}
+    assert json.loads((data_dir / NAME).read_text(encoding="utf-8")) == expected
+    assert not (data_dir / (NAME + ".wal.1")).exists()
+    assert (data_dir / (NAME + ".wal")).read_text(encoding="utf-8") == ""
+
+    s = db._WalStore(compact_records=5)
+    try:
+        assert s.load(NAME) == expected
+    finally:
+        s.close()
+
+def _fail_snapshot(name, snap):
+    raise OSError("disk full")
+
+def test_failed_compaction_keeps_old_log_for_replay(data_dir):
+    s = db._WalStore(compact_records=10 ** 9)
+    s.put(NAME, "a", 1)
+    s._write_snapshot = _fail_snapshot
+    s._compact(NAME)
+    assert (data_dir / (NAME + ".wal.1")).exists()
+    assert not (data_dir / NAME).exists()
+
+    s.put(NAME, "b", 2)
+    s = _reopen(s)
+    try:
+        assert s.load(NAME) == {"a": 1, "b": 2}
+    finally:
+        s.close()
+
+def test_compaction_appends_to_leftover_old_log(data_dir):
+    s = db._WalStore(compact_records=10 ** 9)
+    s.put(NAME, "a", 1)
+    s._write_snapshot = _fail_snapshot
+    s._compact(NAME)
+
+    # 下一次 compaction 在寫 snapshot 前又失敗：.wal.1 裡的 "a" 不能被新的 log 蓋掉
+    s.put(NAME, "b", 2)
+    s._compact(NAME)
+    del s._write_snapshot
+    lines = (data_dir / (NAME + ".wal.1")).read_text(encoding="utf-8").splitlines()
+    assert [json.loads(l)["key"] for l in lines] == ["a", "b"]
+
+    s.put(NAME, "c", 3)
+    s._compact(NAME)
+    assert json.loads((data_dir / NAME).read_text(encoding="utf-8")) == {"a": 1, "b": 2, "c": 3}
+    assert not (data_dir / (NAME + ".wal.1")).exists()
+    s = _reopen(s)
+    try:
+        assert s.load(NAME) == {"a": 1, "b": 2, "c": 3}
+    finally:
+        s.close()
@@ -0,0 +1,64 @@
+# server/tests/test_gamehost.py
+"""GameHostPool：place() 回傳前房間已經登記在 host 上，retire_idle() 不會收掉它"""
+import socket
+
+import pytest
+
+from common import gamehost
+
+# 最小的 host：收控制訊息、照 lobby 的要求回報房間結束，控制通道關閉就離開
+HOST_SCRIPT = """
+import json, os, socket
+ctrl = socket.socket(fileno=int(os.environ["GAME_HOST_FD"]))
+while True:
+    msg, fds, _, _ = socket.recv_fds(ctrl, 65536, 4)
+    for fd in fds:
+        os.close(fd)
+    if not msg:
+        break
+    req = json.loads(msg)
+    if req["op"] == "close":
+        ctrl.send(json.dumps({"closed": req["room_id"], "code": 0}).encode())
+"""
+
+@pytest.fixture
+def pool(tmp_path):
+    (tmp_path / "host.py").write_text(HOST_SCRIPT, encoding="utf-8")
+    p = gamehost.GameHostPool("test", tmp_path, "host.py", max_hosts=2, rooms_per_host=1)
+    yield p
+    p.close()
+
+def _open(pool, room_id, exits):
+    lsock = socket.socket()
+    try:
+        return pool.place(room_id, {"ROOM_ID": room_id}, {"GAME_LISTEN_FD": lsock.fileno()},
+                          on_exit=lambda room, code: exits.append((room.room_id, code)))
+    finally:
+        lsock.close()
+
+def test_place_registers_room_before_returning(pool):
+    exits = []
+    r1 = _open(pool, "r1", exits)
+    r2 = _open(pool, "r2", exits)
+    assert r1.host is not r2.host       # rooms_per_host=1：第二個房間開新的 host
+    assert pool.stats() == {r1.host.key: 1, r2.host.key: 1}
+
+    pool.retire_idle(0)                 # 兩個 host 都有房間：一個都不能收
+    assert r1.host.alive() and r2.host.alive()
+
+    r2.kill()
+    assert r2.wait(5) == 0
+    assert exits == [("r2", 0)]
+    pool.retire_idle(0)                 # 空下來的多餘 host 才收掉
+    assert not r2.host.alive()
+    assert r1.host.alive()
+
+def test_closed_pool_refuses_rooms(pool):
+    pool.close()
+    with pytest.raises(OSError):
+        _open(pool, "r1", [])
+
+def test_no_datagram_fallback(monkeypatch):
+    monkeypatch.delattr(socket, "SOCK_SEQPACKET")
+    with pytest.raises(OSError):
+        gamehost._socketpair()
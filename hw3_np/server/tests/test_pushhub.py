@@ -0,0 +1,124 @@
+# server/tests/test_pushhub.py
+"""PushHub（threads 模式的 socket 訂閱者）：合併、送出順序、慢的訂閱者斷線、EOF 退訂"""
+import socket
+import time
+
+import pytest
+
+from common import pushhub
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    b.settimeout(2.0)
+    yield a, b
+    a.close()
+    b.close()
+
+def _read_until_eof(sock):
+    chunks = []
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return b"".join(chunks)
+        chunks.append(data)
+
+def _read_lines(sock, n):
+    buf = b""
+    while buf.count(b"\n") < n:
+        data = sock.recv(4096)
+        if not data:
+            break
+        buf += data
+    return buf.splitlines()
+
+def _wait(cond, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+def test_held_subscriber_only_gets_latest_state(pair):
+    a, b = pair
+    hub = pushhub.PushHub()
+    hub.subscribe("r1", a, dedicated=True)
+    for i in range(5):
+        hub.publish("r1", b"state %d\n" % i)
+    assert hub.stats()["coalesced"] == 4
+    assert hub.stats()["queued"] == 1
+
+    hub.release(a, b"subscribed\n")
+    assert _read_lines(b, 2) == [b"subscribed", b"state 4"]
+
+def test_coalescing_is_per_topic_and_keeps_order(pair):
+    a, b = pair
+    hub = pushhub.PushHub()
+    hub.subscribe("r1", a, dedicated=True)
+    hub.subscribe("r2", a, dedicated=True)
+    hub.publish("r1", b"r1 old\n")
+    hub.publish("r2", b"r2 old\n")
+    hub.publish("r1", b"r1 new\n")
+    hub.publish("r2", b"r2 new\n")
+    hub.release(a, b"ok\n")
+    # 被取代的訊息留在原本的位置，送出的是最新的內容
+    assert _read_lines(b, 3) == [b"ok", b"r1 new", b"r2 new"]
+
+def test_events_without_coalesce_are_all_sent(pair):
+    a, b = pair
+    hub = pushhub.PushHub()
+    hub.subscribe("r1", a)
+    for i in range(20):
+        hub.publish("r1", b"ev %d\n" % i, coalesce=False)
+    assert _read_lines(b, 20) == [b"ev %d" % i for i in range(20)]
+    assert hub.stats()["coalesced"] == 0
+
+def test_slow_subscriber_is_dropped(pair):
+    a, b = pair
+    hub = pushhub.PushHub(max_queue=3)
+    hub.subscribe("r1", a, dedicated=True)
+    for i in range(5):
+        hub.publish("r1", b"ev %d\n" % i, coalesce=False)
+    assert hub.stats()["dropped"] == 1
+    assert hub.live_subscribers() == 0
+    assert not hub.has_subscribers("r1")
+    assert _read_until_eof(b) == b""
+
+def test_close_topic_flushes_then_closes_dedicated_conn(pair):
+    a, b = pair
+    hub = pushhub.PushHub()
+    hub.subscribe("r1", a, dedicated=True)
+    hub.release(a, b"ok\n")
+    hub.publish("r1", b"last\n")
+    hub.close_topic("r1")
+    assert _read_until_eof(b) == b"ok\nlast\n"
+    assert hub.live_subscribers() == 0
+
+def test_client_eof_unsubscribes(pair):
+    a, b = pair
+    hub = pushhub.PushHub()
+    hub.subscribe("r1", a, dedicated=True)
+    hub.release(a, b"ok\n")
+    assert _read_lines(b, 1) == [b"ok"]
+    b.close()
+    assert _wait(lambda: hub.live_subscribers() == 0)
+    assert not hub.has_subscribers("r1")
+
+def test_conn_closed_without_drop_does_not_stop_the_hub(pair):
+    a, b = pair
+    hub = pushhub.PushHub()
+    hub.subscribe("r1", a)
+    a.close()       # 呼叫端先關了連線、還沒 drop()
+    hub.publish("r1", b"lost\n", coalesce=False)
+    assert _wait(lambda: hub.live_subscribers() == 0)
+
+    c, d = socket.socketpair()
+    d.settimeout(2.0)
+    try:
+        hub.subscribe("r1", c)
+        hub.publish("r1", b"still here\n", coalesce=False)
+        assert _read_lines(d, 1) == [b"still here"]
+    finally:
+        c.close()
+        d.close()
@@ -0,0 +1,106 @@
+# server/tests/test_room_events.py
+"""房間 delta 事件：seq 遞增、重新訂閱帶 since_seq 補送漏掉的事件、ring 不夠補時退回完整房間"""
+import socket
+
+import pytest
+
+from common import auth, db, pushhub
+import lobby_server as L
+
+@pytest.fixture
+def lobby(data_dir, monkeypatch):
+    monkeypatch.setattr(L, "push_hub", pushhub.PushHub())
+    monkeypatch.setattr(L, "_room_streams", {})
+    monkeypatch.setattr(L, "_lobby_dir", {})
+    monkeypatch.setattr(L, "ROOM_EVENT_BUFFER", 4)
+    monkeypatch.setattr(auth, "SESSIONS", {})
+    monkeypatch.setattr(auth, "USER_ACTIVE", {})
+    conns = []
+
+    def subscribe(room_id, **extra):
+        # 專用的訂閱連線、不 release：事件只排在佇列裡，不做 I/O
+        a, b = socket.socketpair()
+        conns.extend((a, b))
+        payload = {"token": token, "room_id": room_id, "delta": True, **extra}
+        return L.handle_subscribe_room(payload, a, dedicated=True)
+
+    token = auth.issue_token("alice", "player")
+    yield subscribe
+    for c in conns:
+        c.close()
+
+def _change(room_id, **fields):
+    room = db.get(L.ROOMS_FILE, room_id)
+    room.update(fields)
+    db.put(L.ROOMS_FILE, room_id, room)
+    with L._streams_lock:
+        L._advance_room(room_id)
+
+def _apply(room, event):
+    room = dict(room)
+    room.update(event["set"])
+    for k in event["del"]:
+        room.pop(k, None)
+    return room
+
+def test_resubscribe_replays_missed_deltas(lobby):
+    db.put(L.ROOMS_FILE, "r1", {"game": "rps", "status": "waiting", "players": ["alice"]})
+    first = lobby("r1")
+    assert first["ok"] and "room" in first and "events" not in first
+
+    _change("r1", players=["alice", "bob"])
+    _change("r1", status="playing")
+    _change("r1", status="finished", winner="bob")
+
+    again = lobby("r1", since_seq=first["seq"])
+    events = again["events"]
+    assert [ev["seq"] for ev in events] == [first["seq"] + 1, first["seq"] + 2, first["seq"] + 3]
+    assert again["seq"] == events[-1]["seq"]
+    room = first["room"]
+    for ev in events:
+        room = _apply(room, ev)
+    assert room == db.get(L.ROOMS_FILE, "r1")
+
+def test_resubscribe_up_to_date_gets_no_events(lobby):
+    db.put(L.ROOMS_FILE, "r1", {"status": "waiting"})
+    first = lobby("r1")
+    _change("r1", status="playing")
+    latest = lobby("r1", since_seq=first["seq"])["seq"]
+    assert lobby("r1", since_seq=latest) == {"ok": True, "msg": "已訂閱房間更新", "room_id": "r1",
+                                             "seq": latest, "events": []}
+
+def test_unchanged_room_does_not_advance_seq(lobby):
+    db.put(L.ROOMS_FILE, "r1", {"status": "waiting"})
+    seq = lobby("r1")["seq"]
+    with L._streams_lock:
+        L._advance_room("r1")
+    assert lobby("r1")["seq"] == seq
+
+def test_too_old_since_seq_falls_back_to_full_room(lobby):
+    db.put(L.ROOMS_FILE, "r1", {"n": 0})
+    first = lobby("r1")
+    for i in range(1, L.ROOM_EVENT_BUFFER + 2):
+        _change("r1", n=i)
+    resp = lobby("r1", since_seq=first["seq"])
+    assert "events" not in resp
+    assert resp["room"] == {"n": L.ROOM_EVENT_BUFFER + 1}
+    assert resp["seq"] == first["seq"] + L.ROOM_EVENT_BUFFER + 1
+
+@pytest.mark.parametrize("since_seq", [-1, 10 ** 15, "3", None])
+def test_bad_since_seq_gets_full_room(lobby, since_seq):
+    db.put(L.ROOMS_FILE, "r1", {"status": "waiting"})
+    lobby("r1")
+    _change("r1", status="playing")
+    resp = lobby("r1", since_seq=since_seq)
+    assert "events" not in resp and resp["room"] == {"status": "playing"}
+
+def test_deleted_room_drops_stream(lobby):
+    db.put(L.ROOMS_FILE, "r1", {"status": "waiting"})
+    lobby("r1")
+    assert L.push_hub.has_subscribers(L._delta_topic("r1"))
+    db.delete(L.ROOMS_FILE, "r1")
+    with L._streams_lock:
+        assert L._advance_room("r1") is None
+    assert "r1" not in L._room_streams
+    assert not L.push_hub.has_subscribers(L._delta_topic("r1"))
+    assert lobby("r1") == {"ok": False, "error": "房間不存在"}
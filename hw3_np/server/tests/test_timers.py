@@ -0,0 +1,81 @@
+# server/tests/test_timers.py
+"""TimerHeap：到期順序、同一個 key 重新排程 / 取消、callback 例外"""
+import threading
+import time
+
+from common import timers
+
+def _recorder():
+    fired = []
+    done = threading.Event()
+
+    def record(name, last=False):
+        fired.append(name)
+        if last:
+            done.set()
+    return fired, done, record
+
+def test_fires_in_deadline_order():
+    t = timers.TimerHeap()
+    fired, done, record = _recorder()
+    t.call_later("c", 0.06, record, "c", True)
+    t.call_later("a", 0.02, record, "a")
+    t.call_later("b", 0.04, record, "b")
+    assert done.wait(2)
+    assert fired == ["a", "b", "c"]
+    assert t.stats() == {"pending": 0, "heap": 0, "fired": 3}
+
+def test_reschedule_replaces_previous_deadline():
+    t = timers.TimerHeap()
+    fired, done, record = _recorder()
+    t.call_later("room", 0.02, record, "old")
+    t.call_later("room", 0.08, record, "new", True)
+    t0 = time.monotonic()
+    assert done.wait(2)
+    assert time.monotonic() - t0 >= 0.07
+    time.sleep(0.05)
+    assert fired == ["new"]
+    assert t.stats()["fired"] == 1
+
+def test_reschedule_earlier_wakes_the_timer_thread():
+    t = timers.TimerHeap()
+    fired, done, record = _recorder()
+    t.call_later("room", 60, record, "late")
+    time.sleep(0.02)        # 執行緒已經在等 60 秒後的 deadline
+    t.call_later("room", 0.01, record, "soon", True)
+    assert done.wait(2)
+    assert fired == ["soon"]
+    assert not t.pending("room")
+
+def test_cancel():
+    t = timers.TimerHeap()
+    fired, done, record = _recorder()
+    t.call_later("x", 0.02, record, "x")
+    t.call_later("y", 0.05, record, "y", True)
+    assert t.pending("x")
+    t.cancel("x")
+    t.cancel("missing")     # 沒排程的 key 取消也沒事
+    assert not t.pending("x")
+    assert done.wait(2)
+    assert fired == ["y"]
+
+def test_callback_error_does_not_stop_timers():
+    t = timers.TimerHeap()
+    fired, done, record = _recorder()
+
+    def boom():
+        raise RuntimeError("boom")
+
+    t.call_later("bad", 0.01, boom)
+    t.call_later("good", 0.03, record, "good", True)
+    assert done.wait(2)
+    assert fired == ["good"]
+    assert t.stats()["fired"] == 2
+
+def test_heap_is_rebuilt_after_many_reschedules():
+    t = timers.TimerHeap()
+    for i in range(5000):
+        t.call_later("room", 60 + i, lambda: None)
+    stats = t.stats()
+    assert stats["pending"] == 1
+    assert stats["heap"] <= 2 * stats["pending"] + 1024 + 1